@@ -0,0 +1,146 @@
+#
+# Manifest generation benchmark for iiotedge.py
+#
+# Synthesizes a siteconfig with a number of services and an extrahosts file and runs the local generation functions of the
+# gw subcommand for a number of sites. No Azure access is needed. The stages are timed by the spans of the functions:
+#   extrahosts - read the extrahosts file and create the host index (once per run)
+#   compile    - compile the siteconfig template (once per run)
+#   render     - render the siteconfig template for a site
+#   yaml       - parse the rendered siteconfig
+#   compose    - write the docker compose file of a site
+#   modules    - translate the services into the IoT Edge modules configuration and createOptions
+#   deployment - create the deployment manifest and write it as compact JSON
+#   scripts    - create the script commands of a site
+#   write      - write the init/deinit/start/stop scripts of each site
+#
+import sys
+import os
+import json
+import argparse
+import tempfile
+import time
+import platform
+
+_scriptDir = os.path.dirname(os.path.abspath(__file__))
+_repoDir = os.path.dirname(_scriptDir)
+sys.path.insert(0, _repoDir)
+import iiotedge
+
+parser = argparse.ArgumentParser(description="Measures the manifest generation of iiotedge.py at fleet scale")
+parser.add_argument('--sites', default='10,100,1000',
+    help="Comma separated list of the number of sites to generate, e.g. 10,100,1000,5000.")
+parser.add_argument('--services', type=int, default=4,
+    help="The number of services in the synthesized siteconfig.")
+parser.add_argument('--extrahosts', type=int, default=20,
+    help="The number of entries in the synthesized extrahosts file. Each entry has two hostnames, which are added to the createOptions of each service, so IoT Edge limits them to about 50.")
+parser.add_argument('--json', default=None,
+    help="Write the results as JSON to this file.")
+
+STAGES = [ 'extrahosts', 'compile', 'render', 'yaml', 'compose', 'modules', 'deployment', 'scripts', 'write' ]
+# the spans of the gw functions, which time a stage
+STAGE_SPANS = { 'siteconfig render': 'render', 'siteconfig parse': 'yaml', 'siteconfig write': 'compose', 'modules config': 'modules',
+    'deployment write': 'deployment', 'site scripts': 'scripts', 'script write': 'write' }
+
+def createSiteConfig(fileName, serviceCount):
+    # a siteconfig with OPC PLC services, each using all features translated into createOptions
+    with open(fileName, 'w') as siteConfigFile:
+        siteConfigFile.write("version: '3'\n\nservices:\n")
+        for service in range(serviceCount):
+            port = 50000 + service
+            siteConfigFile.write("""    plc{0}:
+        image: ${{OPCPLC_CONTAINER}}
+        restart: always
+        container_name: plc{0}-${{SITE}}
+        hostname: plc{0}-${{SITE}}
+        extra_hosts:
+            ${{EXTRAHOSTS}}
+        volumes:
+            - "${{BINDSOURCE}}:/d"
+        environment:
+            - "SITE=${{SITE}}"
+        expose:
+            - "{1}"
+        ports:
+            - "{1}:{1}"
+        command: --pn={1} --lf /d/${{SITE}}-plc{0}.log --tp /d/trusted --rp /d/rejected --ip /d/issuer --to --aa
+
+""".format(service, port))
+
+def createExtraHosts(fileName, hostCount):
+    with open(fileName, 'w') as extraHostsFile:
+        extraHostsFile.write("# synthesized extrahosts\n")
+        for host in range(hostCount):
+            extraHostsFile.write("10.{0}.{1}.{2} plc-host-{3} plc-host-{3}.plant.contoso\n".format(host // 65536 % 256, host // 256 % 256, host % 256, host))
+
+def configure(workDir, outDir):
+    # configure the module globals, which are set by main() for a gw run
+    iiotedge._args = iiotedge.parser.parse_args([ 'gw', 'benchmarksite', '--iothubname', 'benchmarkhub', '--targetplatform', 'linux',
+        '--outdir', outDir, '--siteconfig', 'benchmark-site.yml', '--hubbackend', 'replay' ])
+    iiotedge._scriptDir = workDir
+    iiotedge.configureTargetPlatform('linux')
+    iiotedge._containerOs = 'linux'
+    iiotedge._dockerBindSource = '/d'
+    iiotedge._iotHubOwnerConnectionString = 'HostName=benchmarkhub.azure-devices.net;SharedAccessKeyName=iothubowner;SharedAccessKey=YmVuY2htYXJr'
+    iiotedge._templateCache.clear()
+    iiotedge._tracer = iiotedge.Tracer()
+
+def runBenchmark(siteCount, serviceCount, hostCount):
+    timings = dict((stage, 0.0) for stage in STAGES)
+    manifestBytes = 0
+    with tempfile.TemporaryDirectory() as workDir:
+        outDir = os.path.join(workDir, 'out')
+        os.mkdir(outDir)
+        createSiteConfig(os.path.join(workDir, 'benchmark-site.yml'), serviceCount)
+        createExtraHosts(os.path.join(workDir, 'extrahosts'), hostCount)
+        configure(workDir, outDir)
+
+        startTime = time.perf_counter()
+        iiotedge._extraHosts = iiotedge.createExtraHostsIndex(iiotedge.getExtraHosts())
+        timings['extrahosts'] += time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        iiotedge.compileTemplate(os.path.join(workDir, 'benchmark-site.yml'))
+        timings['compile'] += time.perf_counter() - startTime
+
+        # the sites are generated by the functions, which main() uses for each site
+        iiotedge._edgeSites = [ { 'site': 'site{0:05d}'.format(siteIndex), 'nodesconfig': None, 'telemetryconfig': None, 'timings': {} } for siteIndex in range(siteCount) ]
+        siteScriptsList = []
+        for site in iiotedge._edgeSites:
+            siteName = site['site']
+            iiotedge.createEdgeSiteDeploymentManifest(site, 'iiot-deployment-{0}'.format(siteName))
+            manifestBytes += site['manifestSize']
+            siteScripts = iiotedge.timedStep(site, 'site scripts', iiotedge.createSiteScripts, site, '{0}-edge-init.yml'.format(siteName),
+                'HostName=benchmarkhub.azure-devices.net;DeviceId=iiot-edge-{0};SharedAccessKey=YmVuY2htYXJr'.format(siteName))
+            siteScriptsList.append((siteName, siteScripts))
+        iiotedge.writeSiteScripts(siteScriptsList)
+
+        for span in iiotedge._tracer.spans:
+            if span['name'] in STAGE_SPANS:
+                timings[STAGE_SPANS[span['name']]] += span['duration']
+
+    return {
+        'sites': siteCount,
+        'services': serviceCount,
+        'extrahosts': hostCount,
+        'total_s': sum(timings.values()),
+        'stages_s': timings,
+        'per_site_us': dict((stage, timings[stage] * 1e6 / siteCount) for stage in STAGES),
+        'manifest_bytes_per_site': manifestBytes // siteCount,
+    }
+
+def main():
+    args = parser.parse_args()
+    # the deployment content template is read relative to the working directory
+    os.chdir(_repoDir)
+    results = []
+    print("{0:>6} {1:>9} {2}".format('sites', 'total[s]', " ".join("{0:>12}".format(stage + '[us]') for stage in STAGES)))
+    for siteCount in [ int(sites) for sites in args.sites.split(',') ]:
+        result = runBenchmark(siteCount, args.services, args.extrahosts)
+        results.append(result)
+        print("{0:>6} {1:>9.3f} {2}".format(siteCount, result['total_s'], " ".join("{0:>12.1f}".format(result['per_site_us'][stage]) for stage in STAGES)))
+    if args.json:
+        with open(args.json, 'w') as jsonFile:
+            json.dump({ 'python': sys.version, 'platform': platform.platform(), 'results': results }, jsonFile, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#
+# Startup benchmark for iiotedge.py
+#
+# Runs the command line in a fresh interpreter with -X importtime for a set of scenarios, which do not need Azure access,
+# and reports the wall time and the most expensive imports of each scenario. The dryrun scenario generates a site with
+# the offline replay IoTHub backend.
+#
+import sys
+import os
+import json
+import argparse
+import subprocess
+import statistics
+import tempfile
+import time
+
+_scriptDir = os.path.dirname(os.path.abspath(__file__))
+_repoDir = os.path.dirname(_scriptDir)
+_iiotedgeScript = os.path.join(_repoDir, 'iiotedge.py')
+
+# the scenarios and the command line arguments used for them, {outdir} is replaced by a temporary directory
+SCENARIOS = {
+    'help': [ '--help' ],
+    'gw-help': [ 'gw', '--help' ],
+    'validation': [ 'gw', 'benchmarksite' ],
+    'dryrun': [ 'gw', 'benchmarksite', '--iothubname', 'benchmarkhub', '--hubbackend', 'replay', '--targetplatform', 'linux', '--force', '--outdir', '{outdir}' ],
+}
+
+parser = argparse.ArgumentParser(description="Measures the startup time of iiotedge.py")
+parser.add_argument('--runs', type=int, default=5,
+    help="The number of runs per scenario.")
+parser.add_argument('--top', type=int, default=10,
+    help="The number of most expensive imports to report per scenario.")
+parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS.keys()), default=None,
+    help="The scenario to run. Can be specified multiple times. Default: all scenarios.")
+parser.add_argument('--json', default=None,
+    help="Write the results as JSON to this file.")
+
+def parseImportTime(stderr):
+    # parse the -X importtime output, which is: 'import time: <self us> | <cumulative us> | <indented package>'
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        package = fields[2].rstrip()
+        imports.append({ 'package': package.strip(), 'self': int(fields[0]), 'cumulative': int(fields[1]), 'toplevel': package[1:2] != ' ' })
+    return imports
+
+def runScenario(name, args, runs, top):
+    wallTimes = []
+    imports = []
+    for run in range(runs):
+        with tempfile.TemporaryDirectory() as outdir:
+            runArgs = [ arg.format(outdir=outdir) for arg in args ]
+            startTime = time.perf_counter()
+            result = subprocess.run([ sys.executable, '-X', 'importtime', _iiotedgeScript ] + runArgs, cwd=_repoDir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            wallTimes.append(time.perf_counter() - startTime)
+        imports = parseImportTime(result.stderr)
+    topImports = sorted([ i for i in imports if i['toplevel'] ], key=lambda i: i['cumulative'], reverse=True)[:top]
+    return {
+        'scenario': name,
+        'args': args,
+        'exitcode': result.returncode,
+        'runs': runs,
+        'wall_median_s': statistics.median(wallTimes),
+        'wall_min_s': min(wallTimes),
+        'import_total_us': sum(i['cumulative'] for i in imports if i['toplevel']),
+        'top_imports': [ { 'package': i['package'], 'cumulative_us': i['cumulative'] } for i in topImports ],
+    }
+
+def main():
+    args = parser.parse_args()
+    results = []
+    for name in args.scenario or sorted(SCENARIOS.keys()):
+        result = runScenario(name, SCENARIOS[name], args.runs, args.top)
+        results.append(result)
+        print("{0}: median {1:.3f}s, min {2:.3f}s, imports {3:.3f}s (exit code {4})".format(name, result['wall_median_s'], result['wall_min_s'], result['import_total_us'] / 1e6, result['exitcode']))
+        for topImport in result['top_imports']:
+            print("    {0:>10.3f}ms  {1}".format(topImport['cumulative_us'] / 1e3, topImport['package']))
+    if args.json:
+        with open(args.json, 'w') as jsonFile:
+            json.dump({ 'python': sys.version, 'results': results }, jsonFile, indent=4)
+
+if __name__ == '__main__':
+    main()
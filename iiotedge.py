@@ -11,12 +11,19 @@ import argparse
 import time
 import shutil
 import socket
-import yaml
+import ipaddress
 import logging
-from azure.mgmt.resource import ResourceManagementClient
-from azure.common.client_factory import get_client_from_cli_profile
+import concurrent.futures
 import stat
-import requests
+import base64
+import hmac
+import hashlib
+import threading
+import urllib.parse
+import re
+import contextlib
+import datetime
+import gzip
 
 PLATFORM_CPU = 'amd64'
 OPCPUBLISHER_CONTAINER_IMAGE = 'mcr.microsoft.com/iotedge/opc-publisher'
@@ -29,13 +36,70 @@ OPCTWIN_CONTAINER_IMAGE = 'mcr.microsoft.com/iotedge/opc-twin'
 OPCTWIN_CONTAINER_VERSION = ''
 OPCPLC_CONTAINER_IMAGE = 'mcr.microsoft.com/iotedge/opc-plc'
 OPCPLC_CONTAINER_VERSION = ''
+# the OPC Publisher telemetry configuration: the fields of each section and the defaults of OPC Publisher for all fields
+TELEMETRY_FIELD_SCHEMA = { 'Publish': bool, 'Name': str, 'Pattern': str }
+TELEMETRY_CONFIG_SCHEMA = {
+    'EndpointUrl': TELEMETRY_FIELD_SCHEMA,
+    'NodeId': TELEMETRY_FIELD_SCHEMA,
+    'MonitoredItem': { 'Flat': bool, 'ApplicationUri': TELEMETRY_FIELD_SCHEMA, 'DisplayName': TELEMETRY_FIELD_SCHEMA },
+    'Value': { 'Flat': bool, 'Value': TELEMETRY_FIELD_SCHEMA, 'SourceTimestamp': TELEMETRY_FIELD_SCHEMA, 'StatusCode': TELEMETRY_FIELD_SCHEMA, 'Status': TELEMETRY_FIELD_SCHEMA } }
+TELEMETRY_CONFIG_DEFAULTS = {
+    'EndpointUrl': { 'Publish': False, 'Name': 'EndpointUrl' },
+    'NodeId': { 'Publish': True, 'Name': 'NodeId' },
+    'MonitoredItem': { 'Flat': True, 'ApplicationUri': { 'Publish': True, 'Name': 'ApplicationUri' }, 'DisplayName': { 'Publish': True, 'Name': 'DisplayName' } },
+    'Value': { 'Flat': True, 'Value': { 'Publish': True, 'Name': 'Value' }, 'SourceTimestamp': { 'Publish': True, 'Name': 'SourceTimestamp' },
+        'StatusCode': { 'Publish': False, 'Name': 'StatusCode' }, 'Status': { 'Publish': False, 'Name': 'Status' } } }
+# typical values of the telemetry fields to estimate the size of a message
+TELEMETRY_SAMPLE_VALUES = { 'EndpointUrl': 'opc.tcp://plc-site:50000', 'NodeId': 'ns=2;s=Machine.Sensor.Temperature', 'ApplicationUri': 'urn:plc-site:OpcPlc',
+    'DisplayName': 'Temperature', 'Value': 1234.5678, 'SourceTimestamp': '2019-01-01T00:00:00.0000000Z', 'StatusCode': 0, 'Status': 'Good' }
+# the priority of the layered deployment of a site, which overrides the modules of its deployment or of the base deployment
+LAYERED_DEPLOYMENT_PRIORITY = 10
+# IoT Edge limits the length of each createOptions property, longer createOptions are split into createOptions01..07
+CREATE_OPTIONS_CHUNK_SIZE = 512
+CREATE_OPTIONS_MAX_CHUNKS = 8
+# the IoTHub limits the size of the desired properties of the edgeAgent twin, which receives the deployment
+DEPLOYMENT_SIZE_LIMIT = 32 * 1024
+# the publisher and proxy logs: the file name of a log is <site>-<pub|prx>[-<shard>].log, rotated files have a suffix.
+# the lines start with a timestamp, lines without timestamp belong to the last timestamp. the counters are written by the
+# publisher diagnostics (--di) as totals since the start of the publisher, the events are counted per line.
+# a line is only matched with the pattern of a metric if it contains one of its markers
+LOG_FILE_PATTERN = re.compile(r'^(?P<site>.+)-(?P<log>pub(?:-\d+)?|prx)\.log')
+LOG_TIMESTAMP_PATTERN = re.compile(rb'^\[?(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2})')
+LOG_COUNTERS = {
+    'messagesSent': ((b'messages sent to IoTHub:',), re.compile(rb'messages sent to IoTHub: (\d+)')),
+    'bytesSent': ((b'bytes sent to IoTHub:',), re.compile(rb'bytes sent to IoTHub: (\d+)')),
+    'notifications': ((b'notifications enqueued:',), re.compile(rb'monitored item notifications enqueued: (\d+)')),
+    'sendFailures': ((b'msg send failures:',), re.compile(rb'msg send failures: (\d+)')),
+}
+LOG_EVENTS = {
+    'reconnects': ((b'econnect',), re.compile(rb'[Rr]econnect')),
+    'errors': ((b'ERR]', b'FTL]', b'Error]', b'Fatal]'), re.compile(rb'[\[ ](?:ERR|FTL|Error|Fatal)\]')),
+}
+LOG_SEND_LATENCY = ((b' ms', b'ms '), re.compile(rb'(?i)\b(?:send|sent|upstream)\b.*?\b(?:took|in|latency:?)\s+(\d+(?:\.\d+)?)\s*ms\b'))
+LOG_METRICS = list(LOG_COUNTERS) + list(LOG_EVENTS)
+# the lines without any marker are skipped with one search
+LOG_MARKER_PATTERN = re.compile(b'|'.join(re.escape(marker) for markers, pattern in list(LOG_COUNTERS.values()) + list(LOG_EVENTS.values()) + [ LOG_SEND_LATENCY ] for marker in markers))
+# the port of OPC UA endpoints, which do not specify a port
+OPCUA_DEFAULT_PORT = 4840
+# the port of the OPC UA server of the OPC PLC
+OPCPLC_PORT = 50000
+# the format of the generated script commands, the recorded scripts of a site with another format are regenerated
+SITE_SCRIPTS_FORMAT = 2
+# the deployment with the system modules shared by all sites
+BASE_DEPLOYMENT_NAME = 'iiot-base'
+# the placeholders supported in the siteconfig and site-edge-init.yml templates
+TEMPLATE_PLACEHOLDERS = [ 'OPCPUBLISHER_CONTAINER', 'OPCPROXY_CONTAINER', 'OPCTWIN_CONTAINER', 'OPCPLC_CONTAINER', 'TELEMETRYCONFIG_OPTION',
+    'IOTHUB_CONNECTIONSTRING', 'OPCTWIN_DEVICECONNECTIONSTRING_OPTION', 'SITE', 'BINDSOURCE', 'EXTRAHOSTS' ]
 
 # set module globals
+_args = None
+_scriptDir = os.path.dirname(os.path.abspath(__file__))
 _targetPlatform = ''
-_startScript = []
-_stopScript = []
-_initScript = []
-_deinitScript = []
+_containerOs = ''
+_targetNewline = '\n'
+_startScriptFileName = _stopScriptFileName = _initScriptFileName = _deinitScriptFileName = ''
+_startScriptCmdPrefix = _stopScriptCmdPrefix = _initScriptCmdPrefix = _deinitScriptCmdPrefix = ''
+_startScriptCmdPostfix = _stopScriptCmdPostfix = _initScriptCmdPostfix = _deinitScriptCmdPostfix = ''
 _iotHubOwnerConnectionString = ''
 _hostDirHost = ''
 _opcPublisherContainer = OPCPUBLISHER_CONTAINER_IMAGE
@@ -43,22 +107,96 @@ _opcProxyContainer = OPCPROXY_CONTAINER_IMAGE
 _opcTwinContainer = OPCTWIN_CONTAINER_IMAGE
 _opcPlcContainer = OPCPLC_CONTAINER_IMAGE
 _platformCpu = PLATFORM_CPU
-_edgeSite = ''
+_edgeSites = []
 _dockerBindSource = ''
 _outdirConfig = ''
+_additionalHosts = []
+_extraHosts = {}
+_hubBackend = None
+_siteStates = {}
+_stateFileName = ''
+_templateCache = {}
+_tracer = None
+_hubCache = None
+_baseDeploymentContent = None
+
+# error raised when the provisioning of a single site fails
+class SiteError(Exception):
+    pass
+
+# records spans of the external calls and generation stages of a run with their site, command and outcome
+class Tracer:
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._startTime = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, site=None, command=None):
+        # the outcome is 'ok', the name of the exception raised in the span or can be set by the caller
+        span = { 'name': name, 'site': site, 'command': command, 'outcome': 'ok', 'thread': threading.get_ident() }
+        startTime = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span['outcome'] = type(e).__name__
+            raise
+        finally:
+            span['start'] = startTime - self._startTime
+            span['duration'] = time.perf_counter() - startTime
+            with self._lock:
+                self.spans.append(span)
+
+    def logSummary(self):
+        # log the count, outcomes and durations of the spans aggregated by name, the slowest first.
+        # IoTHub operations without a result (e.g. a device which does not exist yet) are counted as empty
+        summary = {}
+        with self._lock:
+            for span in self.spans:
+                entry = summary.setdefault(span['name'], { 'count': 0, 'empty': 0, 'failed': 0, 'total': 0.0, 'max': 0.0 })
+                entry['count'] += 1
+                entry['empty'] += 1 if span['outcome'] == 'no result' else 0
+                entry['failed'] += 0 if span['outcome'] in [ 'ok', 'skipped', 'no result' ] else 1
+                entry['total'] += span['duration']
+                entry['max'] = max(entry['max'], span['duration'])
+        logging.info('')
+        logging.info("{0:<32} {1:>6} {2:>6} {3:>6} {4:>10} {5:>10} {6:>10}".format('span', 'count', 'empty', 'failed', 'total[s]', 'mean[s]', 'max[s]'))
+        for name, entry in sorted(summary.items(), key=lambda item: item[1]['total'], reverse=True):
+            logging.info("{0:<32} {1:>6} {2:>6} {3:>6} {4:>10.3f} {5:>10.3f} {6:>10.3f}".format(name, entry['count'], entry['empty'], entry['failed'], entry['total'], entry['total'] / entry['count'], entry['max']))
+        logging.info("{0:<32} {1:>6} {2:>6} {3:>6} {4:>10.3f}".format('wall time', '', '', '', time.perf_counter() - self._startTime))
+        logging.info('')
+
+    def save(self, traceFileName):
+        # write the spans in the Chrome trace event format, which can be viewed with chrome://tracing or Perfetto
+        traceEvents = []
+        with self._lock:
+            for span in self.spans:
+                traceEvents.append({ 'name': span['name'], 'cat': span['command'] or span['name'], 'ph': 'X', 'pid': os.getpid(), 'tid': span['thread'],
+                    'ts': int(span['start'] * 1e6), 'dur': int(span['duration'] * 1e6),
+                    'args': { 'site': span['site'], 'command': span['command'], 'outcome': span['outcome'] } })
+        with open(traceFileName, 'w') as traceFile:
+            json.dump({ 'traceEvents': traceEvents, 'displayTimeUnit': 'ms' }, traceFile, indent=1)
 
 # command line parsing
 parser = argparse.ArgumentParser(description="Installs an Industrial IoT gateway based on IoT Edge")
 
 # site to handle
 siteParser = argparse.ArgumentParser(add_help=False)
-siteParser.add_argument('site', metavar='SITE', default=None,
-    help="The site (factory/production line) of the installation. This is not a DNS domain, but a topology site used to address hosts with identical IP addresses from the cloud or build reduntant systems.")
+siteParser.add_argument('site', metavar='SITE', nargs='*', default=[],
+    help="The site(s) (factory/production line) of the installation. This is not a DNS domain, but a topology site used to address hosts with identical IP addresses from the cloud or build reduntant systems.")
+siteParser.add_argument('--sitesfile', default=None,
+    help="A JSON file with a list of sites to handle. Each entry is either a site name or an object with a 'site' name and optional 'nodesconfig' and 'telemetryconfig' files, which override the command line settings for this site.")
+siteParser.add_argument('--parallel', type=int, default=4,
+    help="The maximal number of sites, which are provisioned concurrently.")
+siteParser.add_argument('--bulkdevices', action='store_true',
+    help="Create the device identities of all sites with bulk registry operations of up to 100 devices and read their connection strings with one device list, instead of four IoTHub operations per site. Not supported with --hubbackend az.")
 
 # publisher configuration files
 publisherConfigParser = argparse.ArgumentParser(add_help=False)
 publisherConfigParser.add_argument('--nodesconfig', default=None,
     help="The configuration file specifying the OPC UA nodes to publish. Requires the hostdir parameter to be set to a directory.")
+publisherConfigParser.add_argument('--publishershards', type=int, default=1,
+    help="Split the nodesconfig of a site by endpoint into this number of publisher modules 'pub-<site>-<k>' with their own nodes configuration 'pn-<site>-<k>.json', balanced by the estimated message rate of the endpoints. The host ports of the shards are consecutive. Default: 1")
 publisherConfigParser.add_argument('--telemetryconfig', default=None,
     help="The configuration file specifying the format of the telemetry to be ingested by OPC Publisher. Requires the hostdir parameter to be set to a directory.")
 
@@ -71,6 +209,8 @@ iothubArgsParser.add_argument('--iothubname', default=None, required=True,
 commonOptArgsParser = argparse.ArgumentParser(add_help=False)
 commonOptArgsParser.add_argument('--dockerregistry', default=None,
     help="The container registry for all used containers.")
+commonOptArgsParser.add_argument('--pinimages', action='store_true',
+    help="Resolve the tags of the OPC container images to their digests with the registry and pin the images in the deployments and scripts. The digests are cached like the IoTHub metadata.")
 commonOptArgsParser.add_argument('--hostdir', default=None,
     help="A directory on the host machine, which containers use for log, config and certificate files. Use the syntax of your targetplatform to specify (for WSL use Windows syntax) If not specified everything is kept in Docker volumes.")
 commonOptArgsParser.add_argument('--outdir', default='./out',
@@ -81,6 +221,10 @@ commonOptArgsParser.add_argument('--lcow', action='store_true',
     help="Forces to use Linux Containers On Windows. Only valid for a Windows target platform.")
 commonOptArgsParser.add_argument('--force', action='store_true',
     help="Forces deletion of existing IoT Edge deployment and device if they exist.")
+commonOptArgsParser.add_argument('--layered', action='store_true',
+    help="Push only the modules, which differ from the existing IoT Edge deployment of a site, as a layered deployment 'iiot-layer-<site>' with higher priority, instead of replacing the deployment. Unchanged modules keep running. Changes of the system modules and removed modules still replace the deployment.")
+commonOptArgsParser.add_argument('--basedeployment', action='store_true',
+    help="Deploy the system modules of all sites with one deployment 'iiot-base' targeting all Industrial IoT devices. The deployment of a site is a layered deployment, which contains only the modules of the site. Not allowed with --layered.")
 commonOptArgsParser.add_argument('--proxyschema', default="http",
     help="Schema for the proxy.")
 commonOptArgsParser.add_argument('--proxyhost', default=None,
@@ -105,6 +249,23 @@ commonOptArgsParser.add_argument('-t', '--tenantid',
 commonOptArgsParser.add_argument('-a', '--appid',
     help="AppId of the Azure service principal to login.")
 
+commonOptArgsParser.add_argument('--hubbackend', choices=['http', 'az', 'replay'], default='http',
+    help="The backend used for IoTHub operations. 'http' uses one pooled in-process HTTPS session, 'az' runs the Azure CLI for each operation. If 'http' is not available, 'az' is used. 'replay' works offline with the IoTHub state recorded in --replayfile and does not login to Azure.")
+commonOptArgsParser.add_argument('--replayfile', default=None,
+    help="The JSON file with the recorded IoTHub state used by the replay backend. Default: an empty IoTHub.")
+commonOptArgsParser.add_argument('--replaylatency', type=int, default=0,
+    help="The latency in milliseconds the replay backend adds to each IoTHub operation, unless the replay file specifies a latency for the operation.")
+commonOptArgsParser.add_argument('--recordfile', default=None,
+    help="Record the IoTHub state seen by the 'http' or 'az' backend to this file, to be used as --replayfile.")
+
+commonOptArgsParser.add_argument('--cachefile', default=os.path.join(os.path.expanduser('~'), '.iiotedge', 'cache.json'),
+    help="The file to cache the IoTHub metadata and the IoTHub owner and device connection strings between runs. It is only readable by the user. Default: ~/.iiotedge/cache.json")
+commonOptArgsParser.add_argument('--cachettl', type=int, default=3600,
+    help="The time in seconds the cached IoTHub metadata and connection strings are used. The cache is dropped with --force or if the IoTHub rejects the credentials. 0 disables the cache.")
+
+commonOptArgsParser.add_argument('--tracefile', default=None,
+    help="Write the spans of all IoTHub operations, generation stages and file operations of the run to this file in the Chrome trace event format (chrome://tracing, Perfetto).")
+
 commonOptArgsParser.add_argument('--loglevel', default='info',
     help="The log level. Allowed: debug, info, warning, error, critical")
 
@@ -112,204 +273,1141 @@ commonOptArgsParser.add_argument('--loglevel', default='info',
 subParsers = parser.add_subparsers(dest='subcommand')
 subParsers.required = True
 gwParser = subParsers.add_parser('gw', parents=[siteParser, commonOptArgsParser, iothubArgsParser, publisherConfigParser], help='Generates scripts for an Azure Industrial IoT gateway deployment.')
+gwParser.add_argument('--pullparallel', type=int, default=4,
+    help="The maximal number of container images, which the init script pulls at the same time. Default: 4")
+topologyParser = subParsers.add_parser('topology', parents=[commonOptArgsParser], help='Generates the OPC Publisher nodes configuration pn-<site>.json for each factory of a topology description.')
+topologyParser.add_argument('topologyfile', metavar='TOPOLOGYFILE',
+    help="The topology description (see testdata/ContosoTopologyDescription.json). The site of a factory is its Domain.")
+topologyParser.add_argument('--publishinginterval', type=int, default=None,
+    help="The OPC UA publishing interval in milliseconds to configure for all nodes. Default: the OPC Publisher default.")
+topologyParser.add_argument('--samplinginterval', type=int, default=None,
+    help="The OPC UA sampling interval in milliseconds to configure for all nodes. Default: the OPC Publisher default.")
+analyzeParser = subParsers.add_parser('analyze', parents=[commonOptArgsParser], help='Estimates the publishing load of OPC Publisher nodes configurations per endpoint and interval.')
+analyzeParser.add_argument('nodesconfigs', metavar='NODESCONFIG', nargs='+',
+    help="The OPC Publisher nodes configuration files (publishednodes.json format) to analyze.")
+analyzeParser.add_argument('--telemetryconfig', default=None,
+    help="The OPC Publisher telemetry configuration used to estimate the message sizes. Default: the OPC Publisher defaults.")
+analyzeParser.add_argument('--publishinginterval', type=int, default=1000,
+    help="The OPC UA publishing interval in milliseconds of nodes, which do not configure it. Default: 1000")
+analyzeParser.add_argument('--samplinginterval', type=int, default=1000,
+    help="The OPC UA sampling interval in milliseconds of nodes, which do not configure it. Default: 1000")
+analyzeParser.add_argument('--json', default=None,
+    help="Write the analysis as JSON to this file.")
+probeParser = subParsers.add_parser('probe', parents=[commonOptArgsParser], help='Checks that the OPC UA endpoints of nodes configurations and topology descriptions can be reached from this host.')
+probeParser.add_argument('configfiles', metavar='CONFIGFILE', nargs='+',
+    help="The OPC Publisher nodes configurations (publishednodes.json format) or topology descriptions with the endpoints to probe.")
+probeParser.add_argument('--concurrency', type=int, default=256,
+    help="The maximal number of endpoints, which are probed at the same time. Default: 256")
+probeParser.add_argument('--timeout', type=float, default=3.0,
+    help="The timeout in seconds to resolve the hostname and to connect to an endpoint. Default: 3")
+probeParser.add_argument('--json', default=None,
+    help="Write the probe results as JSON to this file.")
+logsParser = subParsers.add_parser('logs', parents=[commonOptArgsParser], help='Analyzes the publisher and proxy logs and reports the throughput, reconnects and send latency over time.')
+logsParser.add_argument('logpaths', metavar='LOGPATH', nargs='+',
+    help="The log files (<site>-pub.log, <site>-prx.log) or the directories with the log files to analyze. The rotated files of a log are analyzed too.")
+logsParser.add_argument('--bucket', type=int, default=60,
+    help="The length of the time buckets of the metrics in seconds. Default: 60")
+logsParser.add_argument('--parallel', type=int, default=os.cpu_count() or 1,
+    help="The maximal number of logs, which are analyzed concurrently. Default: the number of CPUs")
+logsParser.add_argument('--csv', default=None,
+    help="Write the metrics of all time buckets as CSV to this file.")
+logsParser.add_argument('--json', default=None,
+    help="Write the metrics of all time buckets as JSON to this file.")
+loadTestParser = subParsers.add_parser('loadtest', parents=[commonOptArgsParser], help='Generates a siteconfig with simulated OPC PLC modules and the nodes configuration to publish all their nodes to measure the publisher throughput.')
+loadTestParser.add_argument('loadtestsite', metavar='SITE',
+    help="The name of the site, the siteconfig and nodes configuration are used with the gw subcommand for this site.")
+loadTestParser.add_argument('--plcs', type=int, default=10,
+    help="The number of OPC PLC modules. Default: 10")
+loadTestParser.add_argument('--rate', type=int, default=10000,
+    help="The number of value changes per second of all nodes, which is used to calculate the number of nodes of each PLC. Default: 10000")
+loadTestParser.add_argument('--nodes', type=int, default=None,
+    help="The number of changing nodes of each PLC. Overrides --rate.")
+loadTestParser.add_argument('--changeperiod', type=int, default=1,
+    help="The period in seconds in which the value of each node changes. Default: 1")
+loadTestParser.add_argument('--samplinginterval', type=int, default=None,
+    help="The OPC UA sampling interval in milliseconds of all nodes. Default: the change period")
+loadTestParser.add_argument('--publishinginterval', type=int, default=1000,
+    help="The OPC UA publishing interval in milliseconds of all nodes. Default: 1000")
+
+#
+# IoTHub backends
+# all backends implement the same operations and return the parsed JSON result or None if the operation failed.
+# backends with supportsBulk implement listDevices and bulkUpdateDevices, which take the devices in the IoTHub bulk registry format:
+#   { "id": "<device id>", "importMode": "create|delete", "capabilities": { "iotEdge": true }, "authentication": { ... }, "tags": { ... } }
+# loginRequired tells if the backend needs an Azure login, authFailed is set if the IoTHub rejected the credentials
+#
+class AzCliHubBackend:
+    # runs the Azure CLI for each operation
+    supportsBulk = False
+    loginRequired = True
+    authFailed = False
+
+    def __init__(self, iotHubName):
+        self.iotHubName = iotHubName
+
+    def _run(self, cmd):
+        result = os.popen(cmd).read()
+        return json.loads(result) if result else None
+
+    def showIotHub(self):
+        return self._run("az iot hub show --name {0}".format(self.iotHubName))
+
+    def getIotHubConnectionString(self):
+        result = self._run("az iot hub show-connection-string --hub-name {0}".format(self.iotHubName))
+        return result['cs'] if result else None
+
+    def getDeployment(self, deploymentName):
+        result = self._run("az iot edge deployment list --hub-name {0} --query \"[?id=='{1}']\"".format(self.iotHubName, deploymentName))
+        return result[0] if result else None
+
+    def deleteDeployment(self, deploymentName):
+        os.popen("az iot edge deployment delete --hub-name {0} --config-id {1}".format(self.iotHubName, deploymentName)).read()
+
+    def createDeployment(self, deploymentName, deploymentFileName, targetCondition, priority=0, layered=False):
+        return self._run("az iot edge deployment create --config-id {0} --hub-name {1}  --content {2} --target-condition \"{3}\" --priority {4}{5}".format(deploymentName, self.iotHubName, deploymentFileName, targetCondition, priority, ' --layered' if layered else ''))
+
+    def showDevice(self, deviceId):
+        return self._run("az iot hub device-identity show --hub-name {0} --device-id {1}".format(self.iotHubName, deviceId))
+
+    def deleteDevice(self, deviceId):
+        os.popen("az iot hub device-identity delete --hub-name {0} --device-id {1}".format(self.iotHubName, deviceId)).read()
+
+    def createEdgeDevice(self, deviceId):
+        return self._run("az iot hub device-identity create --hub-name {0} --device-id {1} --edge-enabled".format(self.iotHubName, deviceId))
+
+    def updateDeviceTags(self, deviceId, tags):
+        # todo need to fix escape and strings for Linux
+        tagsJsonOs = json.dumps(tags).replace('\"', '\\"').replace(' ', '')
+        return self._run("az iot hub device-twin update --hub-name {0} --device-id {1} --set tags={2}".format(self.iotHubName, deviceId, tagsJsonOs))
+
+    def getDeviceConnectionString(self, deviceId):
+        result = self._run("az iot hub device-identity show-connection-string --hub-name {0} --device-id {1}".format(self.iotHubName, deviceId))
+        return result['cs'] if result else None
+
+
+class HttpHubBackend:
+    # talks to the IoTHub service REST API via one authenticated HTTPS session with keep-alive,
+    # the IoTHub itself and its owner connection string are read via the Azure management SDK.
+    # endpoint allows to redirect the REST calls, e.g. to a local HTTP stand-in for testing.
+    API_VERSION = '2018-06-30'
+    SAS_TOKEN_TTL = 3600
+    # the IoTHub limits
+    BULK_MAX_DEVICES = 100
+    LIST_MAX_DEVICES = 1000
+    supportsBulk = True
+
+    def __init__(self, iotHubName, connectionString=None, endpoint=None, poolSize=10):
+        import requests
+        self.iotHubName = iotHubName
+        self.endpoint = endpoint
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._connectionStringLock = threading.Lock()
+        self._sasToken = None
+        self._sasTokenExpiry = 0
+        self._connectionString = None
+        self._hostName = None
+        self._iotHub = None
+        # with a known owner connection string all operations except showIotHub use the IoTHub REST API only
+        self.loginRequired = connectionString is None
+        self.authFailed = False
+        if connectionString:
+            self._setConnectionString(connectionString)
+
+    def _setConnectionString(self, connectionString):
+        self._connectionString = connectionString
+        self._connectionStringParts = dict(part.split('=', 1) for part in connectionString.split(';') if '=' in part)
+        self._hostName = self._connectionStringParts['HostName']
+        if not self.endpoint:
+            self.endpoint = 'https://{0}'.format(self._hostName)
+        self._sasTokenExpiry = 0
+
+    def _getSasToken(self):
+        # the token is shared by all requests and renewed shortly before it expires
+        with self._lock:
+            now = int(time.time())
+            if self._sasToken is None or self._sasTokenExpiry - now < 300:
+                self._sasTokenExpiry = now + self.SAS_TOKEN_TTL
+                resourceUri = urllib.parse.quote_plus(self._hostName.lower())
+                toSign = '{0}\n{1}'.format(resourceUri, self._sasTokenExpiry).encode('utf-8')
+                key = base64.b64decode(self._connectionStringParts['SharedAccessKey'])
+                signature = base64.b64encode(hmac.new(key, toSign, hashlib.sha256).digest())
+                self._sasToken = 'SharedAccessSignature sr={0}&sig={1}&se={2}&skn={3}'.format(resourceUri, urllib.parse.quote_plus(signature), self._sasTokenExpiry, self._connectionStringParts['SharedAccessKeyName'])
+            return self._sasToken
+
+    def _request(self, method, path, body=None, ifMatch=None, parameters=None, acceptBadRequest=False):
+        if not self.getIotHubConnectionString():
+            logging.error("IoTHub request '{0} {1}' failed: the IoTHub connection string can not be read".format(method, path))
+            return None
+        headers = { 'Authorization': self._getSasToken(), 'Content-Type': 'application/json' }
+        if ifMatch:
+            headers['If-Match'] = ifMatch
+        url = '{0}{1}?{2}api-version={3}'.format(self.endpoint, path, urllib.parse.urlencode(parameters) + '&' if parameters else '', self.API_VERSION)
+        import requests
+        try:
+            response = self.session.request(method, url, headers=headers, data=json.dumps(body) if body is not None else None)
+        except requests.exceptions.RequestException as e:
+            logging.error("IoTHub request '{0} {1}' failed: {2}".format(method, path, e))
+            return None
+        if response.status_code == 404:
+            return None
+        if response.status_code in [ 401, 403 ]:
+            self.authFailed = True
+        # bulk operations report the failed devices in the body of a bad request
+        if response.status_code == 400 and acceptBadRequest and response.content:
+            return response.json()
+        if response.status_code >= 300:
+            logging.error("IoTHub request '{0} {1}' failed with status {2}: {3}".format(method, path, response.status_code, response.text))
+            return None
+        return response.json() if response.content else {}
+
+    def _getIotHub(self):
+        if self._iotHub is None:
+            from azure.common.client_factory import get_client_from_cli_profile
+            from azure.mgmt.iothub import IotHubClient
+            client = get_client_from_cli_profile(IotHubClient)
+            for iotHub in client.iot_hub_resource.list_by_subscription():
+                if iotHub.name.lower() == self.iotHubName.lower():
+                    self._iotHub = { 'client': client, 'hub': iotHub, 'resourceGroup': iotHub.id.split('/')[4] }
+                    break
+        return self._iotHub
+
+    def showIotHub(self):
+        iotHub = self._getIotHub()
+        return iotHub['hub'].as_dict() if iotHub else None
+
+    def getIotHubConnectionString(self):
+        # the keys are fetched once, concurrent requests wait for the first fetch
+        with self._connectionStringLock:
+            if self._connectionString:
+                return self._connectionString
+            iotHub = self._getIotHub()
+            if not iotHub:
+                return None
+            key = iotHub['client'].iot_hub_resource.get_keys_for_key_name(iotHub['resourceGroup'], iotHub['hub'].name, 'iothubowner')
+            self._setConnectionString('HostName={0};SharedAccessKeyName={1};SharedAccessKey={2}'.format(iotHub['hub'].properties.host_name, key.key_name, key.primary_key))
+            return self._connectionString
+
+    def getDeployment(self, deploymentName):
+        return self._request('GET', '/configurations/{0}'.format(deploymentName))
+
+    def deleteDeployment(self, deploymentName):
+        self._request('DELETE', '/configurations/{0}'.format(deploymentName), ifMatch='*')
+
+    def createDeployment(self, deploymentName, deploymentFileName, targetCondition, priority=0, layered=False):
+        # a layered deployment differs only in its content, which sets the module properties by path
+        with open(deploymentFileName, 'r') as deploymentFile:
+            deploymentContent = json.loads(deploymentFile.read())
+        configuration = { 'id': deploymentName, 'content': deploymentContent['content'], 'targetCondition': targetCondition, 'priority': priority, 'labels': {} }
+        return self._request('PUT', '/configurations/{0}'.format(deploymentName), configuration)
+
+    def showDevice(self, deviceId):
+        return self._request('GET', '/devices/{0}'.format(deviceId))
+
+    def deleteDevice(self, deviceId):
+        self._request('DELETE', '/devices/{0}'.format(deviceId), ifMatch='*')
+
+    def createEdgeDevice(self, deviceId):
+        # IoTHub generates the keys
+        device = { 'deviceId': deviceId, 'capabilities': { 'iotEdge': True }, 'authentication': { 'type': 'sas', 'symmetricKey': { 'primaryKey': None, 'secondaryKey': None } } }
+        return self._request('PUT', '/devices/{0}'.format(deviceId), device)
+
+    def updateDeviceTags(self, deviceId, tags):
+        return self._request('PATCH', '/twins/{0}'.format(deviceId), { 'tags': tags }, ifMatch='*')
+
+    def getDeviceConnectionString(self, deviceId):
+        device = self.showDevice(deviceId)
+        if not device:
+            return None
+        return 'HostName={0};DeviceId={1};SharedAccessKey={2}'.format(self._hostName, deviceId, device['authentication']['symmetricKey']['primaryKey'])
+
+    def listDevices(self):
+        return self._request('GET', '/devices', parameters={ 'top': self.LIST_MAX_DEVICES })
+
+    def bulkUpdateDevices(self, devices):
+        # the IoTHub accepts a limited number of devices per request, the results are merged
+        bulkResult = { 'isSuccessful': True, 'errors': [], 'warnings': [] }
+        for index in range(0, len(devices), self.BULK_MAX_DEVICES):
+            result = self._request('POST', '/devices', devices[index:index + self.BULK_MAX_DEVICES], acceptBadRequest=True)
+            if result is None:
+                return None
+            bulkResult['isSuccessful'] = bulkResult['isSuccessful'] and result.get('isSuccessful', False)
+            bulkResult['errors'].extend(result.get('errors') or [])
+            bulkResult['warnings'].extend(result.get('warnings') or [])
+        return bulkResult
+
+
+class ReplayHubBackend:
+    # works offline with an IoTHub state read from a JSON file, which has the format:
+    #   { "iothub": <az iot hub show result>, "connectionString": "<IoTHub owner connection string>",
+    #     "deployments": { "<id>": <deployment> }, "devices": { "<id>": <device> }, "latency": { "<operation>": <ms> } }
+    # all operations change the state in memory only and wait for the configured latency
+    supportsBulk = True
+    loginRequired = False
+    authFailed = False
+
+    def __init__(self, iotHubName, replayFileName=None, latency=0):
+        self.iotHubName = iotHubName
+        state = {}
+        if replayFileName:
+            with open(replayFileName, 'r') as replayFile:
+                state = json.loads(replayFile.read())
+        self.iotHub = state.get('iothub', { 'name': iotHubName, 'properties': { 'hostName': '{0}.azure-devices.net'.format(iotHubName) } })
+        self.connectionString = state.get('connectionString', 'HostName={0};SharedAccessKeyName=iothubowner;SharedAccessKey={1}'.format(
+            self.iotHub['properties']['hostName'], base64.b64encode(hashlib.sha256(iotHubName.encode('utf-8')).digest()).decode('utf-8')))
+        self.deployments = state.get('deployments', {})
+        self.devices = state.get('devices', {})
+        self.latency = state.get('latency', {})
+        self.defaultLatency = latency
+        self._lock = threading.Lock()
+
+    def _wait(self, operation):
+        time.sleep(self.latency.get(operation, self.defaultLatency) / 1000.0)
+
+    def showIotHub(self):
+        self._wait('showIotHub')
+        return self.iotHub
+
+    def getIotHubConnectionString(self):
+        self._wait('getIotHubConnectionString')
+        return self.connectionString
+
+    def getDeployment(self, deploymentName):
+        self._wait('getDeployment')
+        return self.deployments.get(deploymentName)
+
+    def deleteDeployment(self, deploymentName):
+        self._wait('deleteDeployment')
+        with self._lock:
+            self.deployments.pop(deploymentName, None)
+
+    def createDeployment(self, deploymentName, deploymentFileName, targetCondition, priority=0, layered=False):
+        self._wait('createDeployment')
+        with open(deploymentFileName, 'r') as deploymentFile:
+            deploymentContent = json.loads(deploymentFile.read())
+        with self._lock:
+            if deploymentName in self.deployments:
+                return None
+            self.deployments[deploymentName] = { 'id': deploymentName, 'content': deploymentContent['content'], 'targetCondition': targetCondition, 'priority': priority, 'labels': {} }
+            return self.deployments[deploymentName]
+
+    def showDevice(self, deviceId):
+        self._wait('showDevice')
+        return self.devices.get(deviceId)
+
+    def deleteDevice(self, deviceId):
+        self._wait('deleteDevice')
+        with self._lock:
+            self.devices.pop(deviceId, None)
+
+    def createEdgeDevice(self, deviceId):
+        self._wait('createEdgeDevice')
+        # the keys are derived from the device id to get reproducible results
+        key = base64.b64encode(hashlib.sha256(deviceId.encode('utf-8')).digest()).decode('utf-8')
+        with self._lock:
+            if deviceId in self.devices:
+                return None
+            self.devices[deviceId] = { 'deviceId': deviceId, 'capabilities': { 'iotEdge': True }, 'authentication': { 'type': 'sas', 'symmetricKey': { 'primaryKey': key, 'secondaryKey': key } }, 'tags': {} }
+            return self.devices[deviceId]
+
+    def updateDeviceTags(self, deviceId, tags):
+        self._wait('updateDeviceTags')
+        with self._lock:
+            if deviceId not in self.devices:
+                return None
+            self.devices[deviceId].setdefault('tags', {}).update(tags)
+            return { 'deviceId': deviceId, 'tags': self.devices[deviceId]['tags'] }
+
+    def getDeviceConnectionString(self, deviceId):
+        self._wait('getDeviceConnectionString')
+        device = self.devices.get(deviceId)
+        if not device:
+            return None
+        return 'HostName={0};DeviceId={1};SharedAccessKey={2}'.format(self.iotHub['properties']['hostName'], deviceId, device['authentication']['symmetricKey']['primaryKey'])
+
+    def listDevices(self):
+        self._wait('listDevices')
+        with self._lock:
+            return list(self.devices.values())
+
+    def bulkUpdateDevices(self, devices):
+        self._wait('bulkUpdateDevices')
+        errors = []
+        with self._lock:
+            for device in devices:
+                deviceId = device['id']
+                if device['importMode'] == 'delete':
+                    if self.devices.pop(deviceId, None) is None:
+                        errors.append({ 'deviceId': deviceId, 'errorCode': 'DeviceNotFound', 'errorStatus': "Device '{0}' does not exist.".format(deviceId) })
+                elif deviceId in self.devices:
+                    errors.append({ 'deviceId': deviceId, 'errorCode': 'DeviceAlreadyExists', 'errorStatus': "Device '{0}' already exists.".format(deviceId) })
+                else:
+                    self.devices[deviceId] = { 'deviceId': deviceId, 'capabilities': device['capabilities'], 'authentication': device['authentication'], 'tags': device.get('tags', {}) }
+        return { 'isSuccessful': len(errors) == 0, 'errors': errors, 'warnings': [] }
+
+
+class RecordingHubBackend:
+    # forwards all operations to a backend and records the IoTHub state seen in the format of the replay file
+    def __init__(self, backend, recordFileName):
+        self.backend = backend
+        self.supportsBulk = backend.supportsBulk
+        self.loginRequired = backend.loginRequired
+        self.recordFileName = recordFileName
+        self.state = { 'iothub': None, 'connectionString': None, 'deployments': {}, 'devices': {} }
+        self._lock = threading.Lock()
+
+    def _record(self, kind, key, value):
+        with self._lock:
+            if value:
+                self.state[kind][key] = value
+            else:
+                self.state[kind].pop(key, None)
+
+    def save(self):
+        with open(self.recordFileName, 'w') as recordFile:
+            json.dump(self.state, recordFile, indent=4)
+
+    def showIotHub(self):
+        self.state['iothub'] = self.backend.showIotHub()
+        return self.state['iothub']
+
+    def getIotHubConnectionString(self):
+        self.state['connectionString'] = self.backend.getIotHubConnectionString()
+        return self.state['connectionString']
+
+    def getDeployment(self, deploymentName):
+        result = self.backend.getDeployment(deploymentName)
+        self._record('deployments', deploymentName, result)
+        return result
+
+    def deleteDeployment(self, deploymentName):
+        self.backend.deleteDeployment(deploymentName)
+        self._record('deployments', deploymentName, None)
+
+    def createDeployment(self, deploymentName, deploymentFileName, targetCondition, priority=0, layered=False):
+        result = self.backend.createDeployment(deploymentName, deploymentFileName, targetCondition, priority, layered)
+        self._record('deployments', deploymentName, result)
+        return result
+
+    def showDevice(self, deviceId):
+        result = self.backend.showDevice(deviceId)
+        self._record('devices', deviceId, result)
+        return result
+
+    def deleteDevice(self, deviceId):
+        self.backend.deleteDevice(deviceId)
+        self._record('devices', deviceId, None)
+
+    def createEdgeDevice(self, deviceId):
+        result = self.backend.createEdgeDevice(deviceId)
+        self._record('devices', deviceId, result)
+        return result
+
+    def updateDeviceTags(self, deviceId, tags):
+        result = self.backend.updateDeviceTags(deviceId, tags)
+        with self._lock:
+            if result and deviceId in self.state['devices']:
+                self.state['devices'][deviceId].setdefault('tags', {}).update(tags)
+        return result
+
+    def getDeviceConnectionString(self, deviceId):
+        return self.backend.getDeviceConnectionString(deviceId)
+
+    def listDevices(self):
+        result = self.backend.listDevices()
+        for device in result or []:
+            self._record('devices', device['deviceId'], device)
+        return result
+
+    def bulkUpdateDevices(self, devices):
+        result = self.backend.bulkUpdateDevices(devices)
+        if result is not None:
+            failedDeviceIds = [ error['deviceId'] for error in result['errors'] ]
+            for device in devices:
+                if device['id'] not in failedDeviceIds:
+                    self._record('devices', device['id'], None if device['importMode'] == 'delete' else
+                        { 'deviceId': device['id'], 'capabilities': device['capabilities'], 'authentication': device['authentication'], 'tags': device.get('tags', {}) })
+        return result
+
+    @property
+    def authFailed(self):
+        return self.backend.authFailed
+
+
+class HubCache:
+    # caches IoTHub metadata and connection strings between runs in a file, which is only readable by the user.
+    # each entry expires after ttl seconds
+    def __init__(self, cacheFileName, ttl):
+        self.cacheFileName = cacheFileName
+        self.ttl = ttl
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(cacheFileName):
+            try:
+                with open(cacheFileName, 'r') as cacheFile:
+                    self.entries = json.loads(cacheFile.read())
+            except ValueError:
+                logging.warning("The cache file '{0}' is invalid. Ignoring...".format(cacheFileName))
+        now = time.time()
+        self.entries = dict((key, entry) for key, entry in self.entries.items() if entry['expires'] > now)
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            return entry['value'] if entry and entry['expires'] > time.time() else None
+
+    def set(self, key, value):
+        # setting an empty value removes the entry
+        with self._lock:
+            if value:
+                self.entries[key] = { 'value': value, 'expires': time.time() + self.ttl }
+            else:
+                self.entries.pop(key, None)
+
+    def invalidate(self, keyPrefix):
+        with self._lock:
+            for key in [ key for key in self.entries if key.startswith(keyPrefix) ]:
+                del self.entries[key]
+
+    def save(self):
+        # the file is created with user only permissions before any secret is written to it and renamed when complete
+        with self._lock:
+            content = json.dumps(self.entries, indent=4)
+        cacheDir = os.path.dirname(self.cacheFileName)
+        if cacheDir and not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir, mode=stat.S_IRWXU)
+        tempFileName = '{0}.{1}.tmp'.format(self.cacheFileName, os.getpid())
+        with os.fdopen(os.open(tempFileName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IRUSR | stat.S_IWUSR), 'w') as cacheFile:
+            cacheFile.write(content)
+        os.chmod(tempFileName, stat.S_IRUSR | stat.S_IWUSR)
+        os.replace(tempFileName, self.cacheFileName)
+
+
+class CachingHubBackend:
+    # forwards all operations to a backend and serves the IoTHub metadata and connection strings from the cache.
+    # all cached entries of the IoTHub are dropped if the IoTHub rejects the credentials
+    def __init__(self, backend, cache, iotHubName):
+        self.backend = backend
+        self.cache = cache
+        self.keyPrefix = '{0}/'.format(iotHubName.lower())
+        self.supportsBulk = backend.supportsBulk
+        self.loginRequired = backend.loginRequired
+        self._authFailureHandled = False
+
+    def _cached(self, key, function, *args):
+        value = self.cache.get(self.keyPrefix + key)
+        if value is None:
+            value = self._checkAuth(function(*args))
+            self.cache.set(self.keyPrefix + key, value)
+        return value
+
+    def _checkAuth(self, result):
+        if self.backend.authFailed and not self._authFailureHandled:
+            self._authFailureHandled = True
+            logging.warning("The IoTHub rejected the credentials. Dropping the cached IoTHub connection strings...")
+            self.cache.invalidate(self.keyPrefix)
+            self.cache.save()
+        return result
+
+    @property
+    def authFailed(self):
+        return self.backend.authFailed
+
+    def showIotHub(self):
+        return self._cached('iothub', self.backend.showIotHub)
+
+    def getIotHubConnectionString(self):
+        return self._cached('connectionString', self.backend.getIotHubConnectionString)
+
+    def getDeployment(self, deploymentName):
+        return self._checkAuth(self.backend.getDeployment(deploymentName))
+
+    def deleteDeployment(self, deploymentName):
+        return self._checkAuth(self.backend.deleteDeployment(deploymentName))
+
+    def createDeployment(self, deploymentName, deploymentFileName, targetCondition, priority=0, layered=False):
+        return self._checkAuth(self.backend.createDeployment(deploymentName, deploymentFileName, targetCondition, priority, layered))
+
+    def showDevice(self, deviceId):
+        return self._checkAuth(self.backend.showDevice(deviceId))
+
+    def deleteDevice(self, deviceId):
+        self.cache.set('{0}devices/{1}'.format(self.keyPrefix, deviceId), None)
+        return self._checkAuth(self.backend.deleteDevice(deviceId))
 
-_args = parser.parse_args()
+    def createEdgeDevice(self, deviceId):
+        self.cache.set('{0}devices/{1}'.format(self.keyPrefix, deviceId), None)
+        return self._checkAuth(self.backend.createEdgeDevice(deviceId))
+
+    def updateDeviceTags(self, deviceId, tags):
+        return self._checkAuth(self.backend.updateDeviceTags(deviceId, tags))
+
+    def getDeviceConnectionString(self, deviceId):
+        return self._cached('devices/{0}'.format(deviceId), self.backend.getDeviceConnectionString, deviceId)
+
+    def listDevices(self):
+        return self._checkAuth(self.backend.listDevices())
+
+    def bulkUpdateDevices(self, devices):
+        for device in devices:
+            self.cache.set('{0}devices/{1}'.format(self.keyPrefix, device['id']), None)
+        return self._checkAuth(self.backend.bulkUpdateDevices(devices))
+
+
+def createHubBackend():
+    if _args.hubbackend == 'replay':
+        return ReplayHubBackend(_args.iothubname, _args.replayfile, _args.replaylatency)
+    backend = createOnlineHubBackend()
+    if _hubCache:
+        backend = CachingHubBackend(backend, _hubCache, _args.iothubname)
+    if _args.recordfile:
+        return RecordingHubBackend(backend, _args.recordfile)
+    return backend
+
+def createOnlineHubBackend():
+    # use the in-process backend if possible and fall back to the Azure CLI
+    if _args.hubbackend == 'http':
+        try:
+            import requests
+            import azure.mgmt.iothub
+            connectionString = _hubCache.get('{0}/connectionString'.format(_args.iothubname.lower())) if _hubCache else None
+            return HttpHubBackend(_args.iothubname, connectionString, poolSize=max(_args.parallel, 1))
+        except ImportError as e:
+            logging.warning("The in-process IoTHub backend is not available ({0}). Using the Azure CLI...".format(e))
+    return AzCliHubBackend(_args.iothubname)
+
+#
+# container images
+#
+def getContainerImage(image, version):
+    # the reference of an image for the container OS and CPU of the target: <registry>/<image>:[<version>-]<os>-<cpu>
+    if '/' not in image:
+        image = '{0}/{1}'.format(_args.dockerregistry, image)
+    tag = '{0}-{1}'.format('windows' if _containerOs == 'windows' else 'linux', 'amd64' if _platformCpu == 'amd64' else 'arm32v7')
+    if version:
+        tag = '{0}-{1}'.format(version, tag)
+    return '{0}:{1}'.format(image, tag)
+
+def parseImageReference(image):
+    # split an image reference into registry, repository and tag, images without registry are on Docker Hub
+    repository, tag = image, 'latest'
+    if ':' in image.rsplit('/', 1)[-1]:
+        repository, tag = image.rsplit(':', 1)
+    registry = 'docker.io'
+    firstPart = repository.split('/', 1)[0]
+    if '/' in repository and ('.' in firstPart or ':' in firstPart or firstPart == 'localhost'):
+        registry, repository = repository.split('/', 1)
+    if registry == 'docker.io' and '/' not in repository:
+        repository = 'library/{0}'.format(repository)
+    return registry, repository, tag
+
+class ImageResolver:
+    # resolves image tags to their digests with the registry v2 API via one HTTP session with keep-alive.
+    # the digests are cached with the key 'image:<image>'. registries on localhost are accessed via HTTP and
+    # endpoint allows to redirect all registry requests, e.g. to a local registry stand-in for testing
+    MANIFEST_TYPES = [ 'application/vnd.docker.distribution.manifest.list.v2+json', 'application/vnd.oci.image.index.v1+json',
+        'application/vnd.docker.distribution.manifest.v2+json', 'application/vnd.oci.image.manifest.v1+json' ]
+
+    def __init__(self, cache=None, endpoint=None, poolSize=10):
+        import requests
+        self.cache = cache
+        self.endpoint = endpoint
+        self.poolSize = poolSize
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=poolSize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._tokens = {}
+
+    def resolve(self, images):
+        # resolve all images concurrently, returns the pinned reference <image>@<digest> of each image or None if it can not be resolved
+        pinnedImages = {}
+        unresolvedImages = []
+        for image in dict.fromkeys(images):
+            digest = self.cache.get('image:{0}'.format(image)) if self.cache else None
+            if '@' in image:
+                pinnedImages[image] = image
+            elif digest:
+                pinnedImages[image] = '{0}@{1}'.format(image, digest)
+            else:
+                unresolvedImages.append(image)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.poolSize) as executor:
+            for image, digest in zip(unresolvedImages, executor.map(self.getDigest, unresolvedImages)):
+                pinnedImages[image] = '{0}@{1}'.format(image, digest) if digest else None
+                if digest and self.cache:
+                    self.cache.set('image:{0}'.format(image), digest)
+        return pinnedImages
+
+    def getDigest(self, image):
+        registry, repository, tag = parseImageReference(image)
+        if self.endpoint:
+            registryUrl = self.endpoint
+        elif registry.split(':')[0] in [ 'localhost', '127.0.0.1' ]:
+            registryUrl = 'http://{0}'.format(registry)
+        else:
+            registryUrl = 'https://{0}'.format('registry-1.docker.io' if registry == 'docker.io' else registry)
+        url = '{0}/v2/{1}/manifests/{2}'.format(registryUrl, repository, tag)
+        import requests
+        try:
+            with _tracer.span('registry manifest', None, image):
+                response = self._request('HEAD', url, registry, repository)
+                # the digest header is optional, then it is the hash of the manifest
+                if response.status_code == 200 and 'Docker-Content-Digest' not in response.headers:
+                    response = self._request('GET', url, registry, repository)
+                    if response.status_code == 200:
+                        return 'sha256:{0}'.format(hashlib.sha256(response.content).hexdigest())
+        except requests.exceptions.RequestException as e:
+            logging.error("The registry request for image '{0}' failed: {1}".format(image, e))
+            return None
+        if response.status_code != 200:
+            logging.error("The registry request for image '{0}' failed with status {1}".format(image, response.status_code))
+            return None
+        return response.headers['Docker-Content-Digest']
+
+    def _request(self, method, url, registry, repository):
+        # registries, which require a token, send a challenge, anonymous pull tokens are requested and shared per repository
+        tokenKey = '{0}/{1}'.format(registry, repository)
+        headers = { 'Accept': ', '.join(self.MANIFEST_TYPES) }
+        with self._lock:
+            token = self._tokens.get(tokenKey)
+        if token:
+            headers['Authorization'] = 'Bearer {0}'.format(token)
+        response = self.session.request(method, url, headers=headers)
+        challenge = response.headers.get('WWW-Authenticate', '')
+        if response.status_code == 401 and challenge.lower().startswith('bearer '):
+            challengeParameters = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+            tokenParameters = dict((key, value) for key, value in challengeParameters.items() if key in [ 'service', 'scope' ])
+            tokenResponse = self.session.get(challengeParameters.get('realm', ''), params=tokenParameters)
+            if tokenResponse.status_code == 200:
+                token = tokenResponse.json().get('token') or tokenResponse.json().get('access_token')
+                with self._lock:
+                    self._tokens[tokenKey] = token
+                headers['Authorization'] = 'Bearer {0}'.format(token)
+                response = self.session.request(method, url, headers=headers)
+        return response
 
 #
 # configure IoT Edge site
 #
-def createEdgeSiteConfiguration(siteName):
+def compileTemplate(templateFileName):
+    # parse a template once into a list of alternating literal text and placeholder names, the result is cached
+    if templateFileName not in _templateCache:
+        with open(templateFileName, 'r') as templateFile:
+            templateParts = re.split(r'\$\{([^}]*)\}', templateFile.read())
+        unknownPlaceholders = sorted(set(templateParts[1::2]) - set(TEMPLATE_PLACEHOLDERS))
+        if unknownPlaceholders:
+            raise ValueError("The template '{0}' contains unknown placeholders: {1}".format(templateFileName, ", ".join('${' + placeholder + '}' for placeholder in unknownPlaceholders)))
+        _templateCache[templateFileName] = templateParts
+    return _templateCache[templateFileName]
+
+def renderTemplate(templateParts, values):
+    # render a compiled template in one pass
+    return "".join(values[part] if index % 2 else part for index, part in enumerate(templateParts))
+
+def getTemplateValues(site):
+    # the values of all template placeholders for a site
+    values = {}
+    values['OPCPUBLISHER_CONTAINER'] = _opcPublisherContainer
+    values['OPCPROXY_CONTAINER'] = _opcProxyContainer
+    values['OPCTWIN_CONTAINER'] = _opcTwinContainer
+    values['OPCPLC_CONTAINER'] = _opcPlcContainer
+    values['TELEMETRYCONFIG_OPTION'] = '--tc /d/tc-{0}.json'.format(site['site']) if site['telemetryconfig'] else ''
+    values['IOTHUB_CONNECTIONSTRING'] = _iotHubOwnerConnectionString
+    values['OPCTWIN_DEVICECONNECTIONSTRING_OPTION'] = ''
+    values['SITE'] = site['site']
+    values['BINDSOURCE'] = _dockerBindSource
+    # the extra hosts are a YAML flow sequence, so they do not depend on the indentation of the placeholder
+    values['EXTRAHOSTS'] = json.dumps(formatExtraHosts(_extraHosts))
+    return values
+
+def timedStep(site, stepName, function, *args):
+    # run a provisioning step of a site in a span and record its duration
+    startTime = time.perf_counter()
+    with _tracer.span(stepName, site['site'], function.__name__) as span:
+        try:
+            result = function(*args)
+            if result is None and not function.__name__.startswith('delete'):
+                span['outcome'] = 'no result'
+            return result
+        finally:
+            site['timings'][stepName] = time.perf_counter() - startTime
+
+def shardPublisherService(serviceConfig, siteName, shard):
+    # the service of a publisher shard has its own name, nodes configuration, log file and host ports
+    replacements = [ ('pub-{0}'.format(siteName), 'pub-{0}-{1}'.format(siteName, shard)), ('pn-{0}.json'.format(siteName), 'pn-{0}-{1}.json'.format(siteName, shard)),
+        ('{0}-pub.log'.format(siteName), '{0}-pub-{1}.log'.format(siteName, shard)) ]
+    # the lists are copied, so the shards do not share them
+    shardConfig = dict((field, list(value) if isinstance(value, list) else value) for field, value in serviceConfig.items())
+    for field in [ 'container_name', 'hostname', 'command' ]:
+        if shardConfig.get(field):
+            for value, shardValue in replacements:
+                shardConfig[field] = shardConfig[field].replace(value, shardValue)
+    if 'ports' in shardConfig:
+        shardPorts = []
+        for port in shardConfig['ports']:
+            hostPort, containerPort = port.split(':', 1) if ':' in port else (port, port)
+            shardPorts.append('{0}:{1}'.format(int(hostPort) + shard - 1, containerPort) if hostPort.isdigit() else port)
+        shardConfig['ports'] = shardPorts
+    return shardConfig
+
+def shardPublisherServices(services, siteName, publisherShards):
+    # a sharded publisher runs as one service 'pub-<site>-<k>' per shard, the order of the services is kept
+    shardedServices = {}
+    for service, serviceConfig in services.items():
+        if service.lower() == 'publisher' and publisherShards > 1:
+            for shard in range(1, publisherShards + 1):
+                shardedServices['pub-{0}-{1}'.format(siteName, shard)] = shardPublisherService(serviceConfig, siteName, shard)
+        else:
+            shardedServices[service] = serviceConfig
+    return shardedServices
+
+def createModulesConfig(services, siteName, publisherShards=1):
     #
-    # create all IoT Edge azure configuration resoures and settings for the site
+    # translate the docker compose services into the IoT Edge modules configuration
+    # returns the modules and if there is a twin module
     #
-    # check if the deployment already exists
+    twinService = False
+    modulesConfig = {}
+    for service, serviceConfig in shardPublisherServices(services, siteName, publisherShards).items():
+        moduleConfig = {}
+        moduleConfig['version'] = '1.0'
+        moduleConfig['type'] = 'docker'
+        moduleConfig['status'] = 'running'
+        moduleConfig['restartPolicy'] = serviceConfig['restart']
+        settings = {}
+        settings['image'] = serviceConfig['image']
+        createOptions = {}
+        if 'hostname' in serviceConfig:
+            createOptions['Hostname'] = serviceConfig['hostname']
+        if 'environment' in serviceConfig:
+            env = []
+            for envVar in serviceConfig['environment']:
+                env.append(envVar)
+            createOptions['Env'] = env
+        if 'command' in serviceConfig and serviceConfig['command'] is not None:
+            cmdList = []
+            cmdArgs = filter(lambda arg: arg.strip() != '', serviceConfig['command'].split(" "))
+            cmdList.extend(cmdArgs)
+            createOptions['Cmd'] = cmdList
+        hostConfig = {}
+        if 'expose' in serviceConfig:
+            exposedPorts = {}
+            for port in serviceConfig['expose']:
+                exposedPort = str(port) + "/tcp"
+                exposedPorts[exposedPort] = {}
+            createOptions['ExposedPorts'] = exposedPorts       
+        if 'ports' in serviceConfig:
+            portBindings = {}
+            for port in serviceConfig['ports']:
+                hostPorts = []
+                if '-' in port or '/' in port:
+                    raise SiteError("For ports in the .yml configuration only the single port short syntax without protocol (tcp is used) is supported (HOSTPORT:CONTAINERPORT)")
+                if ':' in port:
+                    delim = port.find(':')
+                    hostPort = port[:delim]
+                    containerPort = port[delim+1:] + '/tcp'
+                else:
+                    hostPort = port
+                    containerPort = port + '/tcp'
+                hostPorts.append( { "HostPort": str(hostPort) } )
+                portBindings[containerPort] = hostPorts
+            hostConfig['PortBindings'] = portBindings
+        if 'volumes' in serviceConfig:
+            binds = []
+            for bind in serviceConfig['volumes']:
+                if bind[0:1] != '/' and bind[1:2] != ':':
+                    bind = '{0}_{1}'.format(siteName, bind)
+                binds.append(bind)
+            hostConfig['Binds'] = binds
+        if 'extra_hosts' in serviceConfig:
+            # services with extra_hosts get the hosts of the extrahosts index and their own hosts
+            extraHosts = formatExtraHosts(_extraHosts)
+            for extraHost in serviceConfig['extra_hosts'] or []:
+                if extraHost not in extraHosts:
+                    extraHosts.append(extraHost)
+            if len(extraHosts) > 0:
+                hostConfig['ExtraHosts'] = extraHosts
+        if len(hostConfig) != 0:
+            createOptions['HostConfig'] = hostConfig
+        setCreateOptions(settings, createOptions, service)
+        moduleConfig['settings'] = settings
+        # map the service name to a site specific service name
+        if service.lower() == 'publisher':
+            service = 'pub-{0}'.format(siteName)
+        elif service.lower() == 'proxy':
+            service = 'prx-{0}'.format(siteName)
+        elif service.lower() == 'plc':
+            service = 'plc-{0}'.format(siteName)
+        elif service.lower() == 'twin':
+            service = 'twin-{0}'.format(siteName)
+            twinService = True
+        modulesConfig[service] = moduleConfig
+    return modulesConfig, twinService
+
+def setCreateOptions(settings, createOptions, moduleName):
+    # the createOptions are serialized compact with a deterministic key order and split into chunks of the length IoT Edge supports
+    createOptionsJson = json.dumps(createOptions, separators=(',', ':'), sort_keys=True)
+    chunks = [ createOptionsJson[start:start + CREATE_OPTIONS_CHUNK_SIZE] for start in range(0, len(createOptionsJson), CREATE_OPTIONS_CHUNK_SIZE) ]
+    if len(chunks) > CREATE_OPTIONS_MAX_CHUNKS:
+        raise SiteError("The createOptions of module '{0}' have {1} characters, but IoT Edge supports only {2}".format(moduleName, len(createOptionsJson), CREATE_OPTIONS_CHUNK_SIZE * CREATE_OPTIONS_MAX_CHUNKS))
+    settings['createOptions'] = chunks[0]
+    for chunk in range(1, len(chunks)):
+        settings['createOptions{0:02d}'.format(chunk)] = chunks[chunk]
+
+def writeDeploymentManifest(deploymentName, content):
+    #
+    # write a deployment manifest compact with a deterministic key order, so it is small to push and the same content
+    # gives the same file. returns the size of the manifest, which must not exceed the IoTHub limit
+    #
+    manifest = json.dumps(content, separators=(',', ':'), sort_keys=True)
+    with open('{0}/{1}.json'.format(_args.outdir, deploymentName), 'w', newline=_targetNewline) as deploymentContentFile:
+        deploymentContentFile.write(manifest)
+    manifestSize = len(manifest.encode('utf-8'))
+    if manifestSize > DEPLOYMENT_SIZE_LIMIT:
+        raise SiteError("The deployment manifest '{0}' has {1} bytes and exceeds the IoTHub limit of {2} bytes".format(deploymentName, manifestSize, DEPLOYMENT_SIZE_LIMIT))
+    logging.info("The deployment manifest '{0}' has {1} bytes ({2:.0%} of the IoTHub limit of {3} bytes)".format(deploymentName, manifestSize, manifestSize / DEPLOYMENT_SIZE_LIMIT, DEPLOYMENT_SIZE_LIMIT))
+    return manifestSize
+
+def createDeploymentContent(siteName, modulesConfig, twinService):
+    #
+    # create IoTHub IoT Edge deployment manifest
+    #
+    # todo fetch the deployment content template from a new created deployment, so we can get rid of iiot-edge-deployment-content-template.json
+    with open('iiot-edge-deployment-content-template.json', 'r') as deploymentContentTemplateFile:
+        deploymentContent = json.loads(deploymentContentTemplateFile.read())
+    # add proxy configuration
+    if _args.proxyhost:
+        ProxyUrl = _args.proxyschema + "://"
+        if _args.proxyusername and _args.proxypassword:
+            ProxyUrl = ProxyUrl + _args.proxyusername + ":" + _args.proxypassword
+        ProxyUrl = ProxyUrl + "@" + _args.proxyhost
+        if _args.proxyport:
+            ProxyUrl = ProxyUrl + ":" + _args.proxyport
+        # configure EdgeHub to use proxy
+        if not 'env' in deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeHub']['settings']:
+            deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeHub']['settings']['env'] = {} 
+        if not 'https_proxy' in deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeHub']['settings']['env']:
+            deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeHub']['settings']['env']['https_proxy'] = {}
+        deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeHub']['settings']['env']['https_proxy'] = { 'value': ProxyUrl }
+        # configure EdgeAgent to use proxy
+        if not 'env' in deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']:
+            deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env'] = {} 
+        if not 'https_proxy' in deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env']:
+            deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env']['https_proxy'] = {}
+        deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env']['https_proxy'] = { 'value': ProxyUrl }
+    # configure EdgeHub for requested upstream protocol
+    if _args.upstreamprotocol != 'Amqp':
+        if not 'UpstreamProtocol' in deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env']:
+            deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env']['UpstreamProtocol'] = {}
+        deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env']['UpstreamProtocol'] = { 'value': _args.upstreamprotocol }
+    # configure IIoT Edge modules config
+    deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['modules'] = modulesConfig
+    # set default properties for twin
+    if twinService:
+        deploymentContent['content']['modulesContent']['twin-{0}'.format(siteName)] = { 'properties.desired': {} }
+        # todo read more complex discovery settings
+        deploymentContent['content']['modulesContent']['twin-{0}'.format(siteName)]['properties.desired'] = { 'Discovery': "Off" }
+    # todo add scanner configuration from file
+    return deploymentContent
+
+def createEdgeSiteDeploymentManifest(site, deploymentName):
+    #
+    # Read our module configuration from a .yml and create the deployment manifest
+    #
+    siteName = site['site']
+    publisherShards = len(site.get('publisherShards', [])) or 1
+    # render the template to create a docker compose configuration
+    ymlFileName = '{0}.yml'.format(siteName)
+    ymlOutFileName = '{0}/{1}'.format(_args.outdir, ymlFileName)
+    with _tracer.span('siteconfig render', siteName, 'renderTemplate'):
+        siteTemplate = compileTemplate(os.path.join(_scriptDir, _args.siteconfig))
+        templateValues = getTemplateValues(site)
+        composeYml = renderTemplate(siteTemplate, templateValues)
+        # the extra hosts are injected into the modules from the index, so they are not parsed for each service
+        templateValues['EXTRAHOSTS'] = ''
+        siteYml = renderTemplate(siteTemplate, templateValues)
+    import yaml
+    with _tracer.span('siteconfig parse', siteName, 'yaml.safe_load'):
+        yamlTemplate = yaml.safe_load(siteYml)
+        # the docker compose configuration runs the same publisher shards as the deployment
+        if publisherShards > 1:
+            composeConfig = yaml.safe_load(composeYml)
+            composeConfig['services'] = shardPublisherServices(composeConfig['services'], siteName, publisherShards)
+            composeYml = yaml.safe_dump(composeConfig, default_flow_style=False)
+    with _tracer.span('siteconfig write', siteName, ymlFileName):
+        with open(ymlOutFileName, 'w+', newline=_targetNewline) as setupOutFile:
+            setupOutFile.write(composeYml)
+    # the images are prefetched by the init script
+    site['images'] = [ serviceConfig['image'] for serviceConfig in yamlTemplate['services'].values() if serviceConfig.get('image') ]
+    with _tracer.span('modules config', siteName, 'createModulesConfig'):
+        modulesConfig, twinService = createModulesConfig(yamlTemplate['services'], siteName, publisherShards)
+    with _tracer.span('deployment write', siteName, 'writeDeploymentManifest'):
+        deploymentContent = createDeploymentContent(siteName, modulesConfig, twinService)
+        # with a base deployment only the modules of the site are deployed
+        deployedContent = deploymentContent
+        if _baseDeploymentContent:
+            deployedContent = { 'content': { 'modulesContent': createDeploymentLayer(_baseDeploymentContent['content'], deploymentContent) } }
+        site['manifestSize'] = writeDeploymentManifest(deploymentName, deployedContent)
+    return deploymentContent
+
+def createDeploymentLayer(deployedContent, deploymentContent):
+    #
+    # create the modulesContent of a layered deployment with all modules, which differ from the deployed content.
+    # returns None if the changes can not be layered: layers can only add or override modules, but not remove them
+    # or change the runtime, system modules and routes
+    #
+    deployedModulesContent = deployedContent['modulesContent']
+    modulesContent = deploymentContent['content']['modulesContent']
+    deployedAgent = deployedModulesContent['$edgeAgent']['properties.desired']
+    agent = modulesContent['$edgeAgent']['properties.desired']
+    for agentSetting in set(deployedAgent) | set(agent):
+        if agentSetting != 'modules' and deployedAgent.get(agentSetting) != agent.get(agentSetting):
+            return None
+    if deployedModulesContent.get('$edgeHub') != modulesContent.get('$edgeHub'):
+        return None
+    deployedModules = deployedAgent.get('modules', {})
+    modules = agent.get('modules', {})
+    if any(moduleName not in modules for moduleName in deployedModules):
+        return None
+    if any(moduleName not in modulesContent for moduleName in deployedModulesContent):
+        return None
+    layerContent = { '$edgeAgent': {} }
+    for moduleName, module in modules.items():
+        if deployedModules.get(moduleName) != module:
+            layerContent['$edgeAgent']['properties.desired.modules.{0}'.format(moduleName)] = module
+    # the module twins
+    for moduleName, moduleTwin in modulesContent.items():
+        if not moduleName.startswith('$') and deployedModulesContent.get(moduleName) != moduleTwin:
+            layerContent[moduleName] = moduleTwin
+    return layerContent
+
+def createEdgeSiteDeploymentLayer(site, deploymentJson, deploymentContent, targetCondition):
+    #
+    # replace the layered deployment of the site with one, which contains the modules differing from the deployment.
+    # returns False if the changes can not be layered
+    #
+    siteName = site['site']
+    layerName = 'iiot-layer-{0}'.format(siteName)
+    layerContent = createDeploymentLayer(deploymentJson['content'], deploymentContent)
+    if layerContent is None:
+        return False
+    # layered deployments can not be updated, so replace it
+    if timedStep(site, 'layer show', _hubBackend.getDeployment, layerName):
+        logging.info("Deleting layered deployment '{0}'".format(layerName))
+        timedStep(site, 'layer delete', _hubBackend.deleteDeployment, layerName)
+    changedModules = [ name.split('.')[-1] for name in layerContent['$edgeAgent'] ]
+    if len(changedModules) == 0 and len(layerContent) == 1:
+        logging.info("The modules of site '{0}' do not differ from deployment 'iiot-deployment-{0}'. No layered deployment required.".format(siteName))
+        site['layered'] = False
+        return True
+    logging.info("Creating layered deployment '{0}' with the changed module(s): {1}".format(layerName, ", ".join(changedModules + [ name for name in layerContent if name != '$edgeAgent' ])))
+    writeDeploymentManifest(layerName, { 'content': { 'modulesContent': layerContent } })
+    layerCreateResult = timedStep(site, 'layer create', _hubBackend.createDeployment, layerName, '{0}/{1}.json'.format(_args.outdir, layerName), targetCondition, LAYERED_DEPLOYMENT_PRIORITY, True)
+    if not layerCreateResult:
+        raise SiteError("Can not create layered deployment '{0}'.".format(layerName))
+    site['layered'] = True
+    return True
+
+def createEdgeSiteDeployment(site):
+    #
+    # create the IoTHub IoT Edge deployment for the site
+    #
+    siteName = site['site']
     deploymentName = 'iiot-deployment-{0}'.format(siteName)
+    # todo enable when bool is supported for target condition
+    #targetCondition = "tags.iiot=true and tags.site='{0}'".format(siteName)
+    targetCondition = "tags.iiot='true' and tags.site='{0}'".format(siteName)
+    deploymentContent = timedStep(site, 'deployment manifest', createEdgeSiteDeploymentManifest, site, deploymentName)
+    # a switch to or from the base deployment changes the hash, because the deployment of the site has to be replaced
+    site['manifestHash'] = hashlib.sha256((json.dumps(deploymentContent, sort_keys=True) + (BASE_DEPLOYMENT_NAME if _baseDeploymentContent else '')).encode('utf-8')).hexdigest()
+    # the manifest hash of the last run, the deployment is only replaced if the manifest changed
+    siteState = _siteStates.get(siteName, {})
+
+    # check if the deployment already exists
     logging.info("Check if deployment with id '{0}' exists".format(deploymentName))
-    cmd = "az iot edge deployment list --hub-name {0} --query \"[?id=='{1}']\"".format(_args.iothubname, deploymentName)
-    deploymentListResult = os.popen(cmd).read()
-    deploymentListJson = json.loads(deploymentListResult)
+    deploymentJson = timedStep(site, 'deployment show', _hubBackend.getDeployment, deploymentName)
 
     #
     # create an IoTHub IoT Edge deployment if it is not there
     #
     createDeployment = False
-    if not deploymentListResult or len(deploymentListJson) == 0:
+    site['layered'] = siteState.get('layered', False)
+    if not deploymentJson:
         createDeployment = True
     else:
-        if _args.force:
+        if _args.layered and (_args.force or siteState.get('manifest') != site['manifestHash']) and createEdgeSiteDeploymentLayer(site, deploymentJson, deploymentContent, targetCondition):
+            logging.info("Deployment '{0}' found. Using it with the layered deployment...".format(deploymentName))
+        elif _args.force:
             # delete deployment and trigger creation
             logging.info("Deployment '{0}' found. Deleting it...".format(deploymentName))
-            cmd = "az iot edge deployment delete --hub-name {0} --config-id {1}".format(_args.iothubname, deploymentName)
-            os.popen(cmd).read()
+            timedStep(site, 'deployment delete', _hubBackend.deleteDeployment, deploymentName)
+            createDeployment = True
+        elif siteState.get('manifest') and siteState['manifest'] != site['manifestHash']:
+            # deployments can not be updated, so delete it and trigger creation
+            logging.info("Deployment '{0}' found, but the manifest has changed. Replacing it...".format(deploymentName))
+            timedStep(site, 'deployment delete', _hubBackend.deleteDeployment, deploymentName)
             createDeployment = True
         else:
             logging.info("Deployment '{0}' found. Using it...".format(deploymentName))
-            logging.debug(json.dumps(deploymentListJson, indent=4))
-    
-    #
-    # Read our module configuration from a .yml to push it into a deployment manifest in the next step
-    #
-    if createDeployment:
-        logging.info("Creating deployment '{0}'".format(deploymentName))
-        twinService = False
-        # patch the template to create a docker compose configuration
-        ymlFileName = '{0}.yml'.format(siteName)
-        ymlOutFileName = '{0}/{1}'.format(_args.outdir, ymlFileName)
-        telemetryConfigOption = ''
-        try:
-            if _args.telemetryconfig:
-                telemetryConfigOption = '--tc /d/tc-{0}.json'.format(siteName)
-        except AttributeError:
-            pass
-        with open('{0}/{1}'.format(_scriptDir, _args.siteconfig), 'r') as setupTemplate, open(ymlOutFileName, 'w+', newline=_targetNewline) as setupOutFile:
-            for line in setupTemplate:
-                line = line.replace('${OPCPUBLISHER_CONTAINER}', _opcPublisherContainer)
-                line = line.replace('${OPCPROXY_CONTAINER}', _opcProxyContainer)
-                line = line.replace('${OPCTWIN_CONTAINER}', _opcTwinContainer)
-                line = line.replace('${OPCPLC_CONTAINER}', _opcPlcContainer)
-                line = line.replace('${TELEMETRYCONFIG_OPTION}', telemetryConfigOption)
-                line = line.replace('${IOTHUB_CONNECTIONSTRING}', _iotHubOwnerConnectionString)
-                line = line.replace('${OPCTWIN_DEVICECONNECTIONSTRING_OPTION}', '')
-                line = line.replace('${SITE}', siteName)
-                line = line.replace('${BINDSOURCE}', _dockerBindSource)
-                line = line.replace('${EXTRAHOSTS}', "".join(_extraHosts))
-                setupOutFile.write(line)
-        with open(ymlOutFileName, 'r') as templateStream:
-            yamlTemplate = yaml.load(templateStream)
-        modulesConfig = {}
-        for service in yamlTemplate['services']:
-            serviceConfig = yamlTemplate['services'][service]
-            moduleConfig = {}
-            moduleConfig['version'] = '1.0'
-            moduleConfig['type'] = 'docker'
-            moduleConfig['status'] = 'running'
-            moduleConfig['restartPolicy'] = serviceConfig['restart']
-            settings = {}
-            settings['image'] = serviceConfig['image']
-            createOptions = {}
-            if 'hostname' in serviceConfig:
-                createOptions['Hostname'] = serviceConfig['hostname']
-            if 'environment' in serviceConfig:
-                env = []
-                for envVar in serviceConfig['environment']:
-                    env.append('"{0}"'.format(envVar))
-                createOptions['Env'] = env
-            if 'command' in serviceConfig and serviceConfig['command'] is not None:
-                cmdList = []
-                cmdArgs = filter(lambda arg: arg.strip() != '', serviceConfig['command'].split(" "))
-                cmdList.extend(cmdArgs)
-                createOptions['Cmd'] = cmdList
-            hostConfig = {}
-            if 'expose' in serviceConfig:
-                exposedPorts = {}
-                for port in serviceConfig['expose']:
-                    exposedPort = str(port) + "/tcp"
-                    exposedPorts[exposedPort] = {}
-                createOptions['ExposedPorts'] = exposedPorts       
-            if 'ports' in serviceConfig:
-                portBindings = {}
-                for port in serviceConfig['ports']:
-                    hostPorts = []
-                    if '-' in port or '/' in port:
-                        logging.fatal("For ports in the .yml configuration only the single port short syntax without protocol (tcp is used) is supported (HOSTPORT:CONTAINERPORT)")
-                        sys.exit(1)
-                    if ':' in port:
-                        delim = port.find(':')
-                        hostPort = port[:delim]
-                        containerPort = port[delim+1:] + '/tcp'
-                    else:
-                        hostPort = port
-                        containerPort = port + '/tcp'
-                    hostPorts.append( { "HostPort": str(hostPort) } )
-                    portBindings[containerPort] = hostPorts
-                hostConfig['PortBindings'] = portBindings
-            if 'volumes' in serviceConfig:
-                binds = []
-                for bind in serviceConfig['volumes']:
-                    if bind[0:1] != '/' and bind[1:2] != ':':
-                        bind = '{0}_{1}'.format(siteName, bind)
-                    binds.append(bind)
-                hostConfig['Binds'] = binds
-            if 'extra_hosts' in serviceConfig and serviceConfig['extra_hosts']:
-                extraHosts = []
-                for extraHost in serviceConfig['extra_hosts']:
-                    extraHosts.append(extraHost)
-                hostConfig['ExtraHosts'] = extraHosts
-            if len(hostConfig) != 0:
-                createOptions['HostConfig'] = hostConfig
-            settings['createOptions'] = json.dumps(createOptions)
-            moduleConfig['settings'] = settings
-            # map the service name to a site specific service name
-            if service.lower() == 'publisher':
-                service = 'pub-{0}'.format(siteName)
-            elif service.lower() == 'proxy':
-                service = 'prx-{0}'.format(siteName)
-            elif service.lower() == 'plc':
-                service = 'plc-{0}'.format(siteName)
-            elif service.lower() == 'twin':
-                service = 'twin-{0}'.format(siteName)
-                twinService = True
-            modulesConfig[service] = moduleConfig
+            logging.debug(json.dumps(deploymentJson, indent=4))
 
-        #
-        # todo fetch the deployment content template from a new created deployment, so we can get rid of iiot-edge-deployment-content-template.json
-        #
+    if createDeployment:
+        # a layered deployment of the site would override the modules of the new deployment
+        if site['layered'] or _args.layered:
+            layerName = 'iiot-layer-{0}'.format(siteName)
+            if timedStep(site, 'layer show', _hubBackend.getDeployment, layerName):
+                logging.info("Deleting layered deployment '{0}'".format(layerName))
+                timedStep(site, 'layer delete', _hubBackend.deleteDeployment, layerName)
+            site['layered'] = False
+        logging.info("Creating {0}deployment '{1}'".format('layered ' if _baseDeploymentContent else '', deploymentName))
+        if _baseDeploymentContent:
+            deploymentCreateResult = timedStep(site, 'deployment create', _hubBackend.createDeployment, deploymentName, '{0}/{1}.json'.format(_args.outdir, deploymentName), targetCondition, LAYERED_DEPLOYMENT_PRIORITY, True)
+        else:
+            deploymentCreateResult = timedStep(site, 'deployment create', _hubBackend.createDeployment, deploymentName, '{0}/{1}.json'.format(_args.outdir, deploymentName), targetCondition)
+        if not deploymentCreateResult:
+            raise SiteError("Can not create deployment '{0}'.".format(deploymentName))
+        logging.debug(json.dumps(deploymentCreateResult, indent=4))
 
-        #
-        # create IoTHub IoT Edge deployment manifest
-        #
-        with open('iiot-edge-deployment-content-template.json', 'r') as deploymentContentTemplateFile, open('{0}/{1}.json'.format(_args.outdir, deploymentName), 'w', newline=_targetNewline) as deploymentContentFile:
-            deploymentContent = json.loads(deploymentContentTemplateFile.read())
-            # add proxy configuration
-            if _args.proxyhost:
-                ProxyUrl = _args.proxyschema + "://"
-                if _args.proxyusername and _args.proxypassword:
-                    ProxyUrl = ProxyUrl + _args.proxyusername + ":" + _args.proxypassword
-                ProxyUrl = ProxyUrl + "@" + _args.proxyhost
-                if _args.proxyport:
-                    ProxyUrl = ProxyUrl + ":" + _args.proxyport
-                # configure EdgeHub to use proxy
-                if not 'env' in deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeHub']['settings']:
-                    deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeHub']['settings']['env'] = {} 
-                if not 'https_proxy' in deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeHub']['settings']['env']:
-                    deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeHub']['settings']['env']['https_proxy'] = {}
-                deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeHub']['settings']['env']['https_proxy'] = { 'value': ProxyUrl }
-                # configure EdgeAgent to use proxy
-                if not 'env' in deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']:
-                    deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env'] = {} 
-                if not 'https_proxy' in deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env']:
-                    deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env']['https_proxy'] = {}
-                deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env']['https_proxy'] = { 'value': ProxyUrl }
-            # configure EdgeHub for requested upstream protocol
-            if _args.upstreamprotocol != 'Amqp':
-                if not 'UpstreamProtocol' in deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env']:
-                    deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env']['UpstreamProtocol'] = {}
-                deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['systemModules']['edgeAgent']['settings']['env']['UpstreamProtocol'] = { 'value': _args.upstreamprotocol }
-            # configure IIoT Edge modules config
-            deploymentContent['content']['modulesContent']['$edgeAgent']['properties.desired']['modules'] = modulesConfig
-            # set default properties for twin
-            if twinService:
-                deploymentContent['content']['modulesContent']['twin-{0}'.format(siteName)] = { 'properties.desired': {} }
-                # todo read more complex discovery settings
-                deploymentContent['content']['modulesContent']['twin-{0}'.format(siteName)]['properties.desired'] = { 'Discovery': "Off" }
-            # todo add scanner configuration from file
-            json.dump(deploymentContent, deploymentContentFile, indent=4)
-        # todo enable when bool is supported for target condition
-        #cmd = 'az iot edge deployment create --config-id {0} --hub-name {1}  --content {2}/{0}.json --target-condition "tags.iiot=true and tags.site=\'{3}\'"'.format(deploymentName, _args.iothubname, _args.outdir, siteName)
-        cmd = "az iot edge deployment create --config-id {0} --hub-name {1}  --content {2}/{0}.json --target-condition \"tags.iiot=\'true\' and tags.site=\'{3}\'\"".format(deploymentName, _args.iothubname, _args.outdir, siteName)
-        deploymentCreateResult = os.popen(cmd).read()
+def createEdgeBaseDeployment():
+    #
+    # create the deployment with the system modules shared by all sites, the sites deploy their modules as layered deployments on top of it.
+    # it is only replaced if its content has changed, --force is ignored, because all devices of the IoTHub would redeploy
+    #
+    global _baseDeploymentContent
+    baseContent = createDeploymentContent(None, {}, False)
+    writeDeploymentManifest(BASE_DEPLOYMENT_NAME, baseContent)
+    logging.info("Check if base deployment with id '{0}' exists".format(BASE_DEPLOYMENT_NAME))
+    with _tracer.span('base deployment show', None, 'getDeployment'):
+        deploymentJson = _hubBackend.getDeployment(BASE_DEPLOYMENT_NAME)
+    if deploymentJson and deploymentJson['content']['modulesContent'] != baseContent['content']['modulesContent']:
+        logging.info("Base deployment '{0}' found, but its content has changed. Replacing it...".format(BASE_DEPLOYMENT_NAME))
+        with _tracer.span('base deployment delete', None, 'deleteDeployment'):
+            _hubBackend.deleteDeployment(BASE_DEPLOYMENT_NAME)
+        deploymentJson = None
+    if deploymentJson:
+        logging.info("Base deployment '{0}' found. Using it...".format(BASE_DEPLOYMENT_NAME))
+    else:
+        logging.info("Creating base deployment '{0}'".format(BASE_DEPLOYMENT_NAME))
+        with _tracer.span('base deployment create', None, 'createDeployment'):
+            deploymentCreateResult = _hubBackend.createDeployment(BASE_DEPLOYMENT_NAME, '{0}/{1}.json'.format(_args.outdir, BASE_DEPLOYMENT_NAME), "tags.iiot='true'")
         if not deploymentCreateResult:
-            logging.critical("Can not create deployment. Exiting...")
+            logging.critical("Can not create base deployment '{0}'. Exiting...".format(BASE_DEPLOYMENT_NAME))
             sys.exit(1)
-        logging.debug(json.dumps(json.loads(deploymentCreateResult), indent=4))
-    
+    _baseDeploymentContent = baseContent
+
+def createEdgeSiteDevice(site):
     #
-    # create an IoTHub device identity for the edge device and set tags
+    # create an IoTHub device identity for the edge device, set tags and return its connection string
+    # the steps depend on each other and run in order
     #
+    siteName = site['site']
     deviceId = 'iiot-edge-{0}'.format(siteName)
     logging.info("Check if device '{0}' already exists".format(deviceId))
-    cmd = "az iot hub device-identity show --hub-name {0} --device-id {1}".format(_args.iothubname, deviceId)
-    deviceShowResult = os.popen(cmd).read()
+    deviceShowResult = timedStep(site, 'device show', _hubBackend.showDevice, deviceId)
     createDevice = False
     if not deviceShowResult:
         createDevice = True
@@ -317,83 +1415,107 @@ def createEdgeSiteConfiguration(siteName):
         if _args.force:
             # delete device and trigger creation
             logging.info("Device '{0}' found. Deleting it...".format(deviceId))
-            cmd = "az iot hub device-identity delete --hub-name {0} --device-id {1}".format(_args.iothubname, deviceId)
-            os.popen(cmd).read()
+            timedStep(site, 'device delete', _hubBackend.deleteDevice, deviceId)
             createDevice = True
         else:
             logging.info("Device '{0}' found. Using it...".format(deviceId))
-            logging.debug(json.dumps(json.loads(deviceShowResult), indent=4))
+            logging.debug(json.dumps(deviceShowResult, indent=4))
 
     if createDevice:
         logging.info("Creating device '{0}'".format(deviceId))
-        cmd = "az iot hub device-identity create --hub-name {0} --device-id {1} --edge-enabled".format(_args.iothubname, deviceId)
-        deviceCreateResult = os.popen(cmd).read()
+        deviceCreateResult = timedStep(site, 'device create', _hubBackend.createEdgeDevice, deviceId)
         if not deviceCreateResult:
-            logging.critical("Can not create device. Exiting...")
-            sys.exit(1)
-        logging.debug(json.dumps(json.loads(deviceCreateResult), indent=4))
+            raise SiteError("Can not create device '{0}'.".format(deviceId))
+        logging.debug(json.dumps(deviceCreateResult, indent=4))
 
         logging.info("Setting tags for device '{0}'".format(deviceId))
         # todo enable when bool is supported for target condition
         # tags = {"iiot": True, "site": sitename }
         tags = {"iiot": "true", "site": siteName }
-        tagsJson = json.dumps(tags)
-        # todo need to fix escape and strings for Linux
-        tagsJsonOs = tagsJson.replace('\"', '\\"').replace(' ', '')
-        cmd = "az iot hub device-twin update --hub-name {0} --device-id {1} --set tags={2}".format(_args.iothubname, deviceId, tagsJsonOs)
-        updateTagsResult = os.popen(cmd).read()
+        updateTagsResult = timedStep(site, 'device tags update', _hubBackend.updateDeviceTags, deviceId, tags)
         if not updateTagsResult:
-            logging.critical("Can not set tags for device. Exiting...")
-            sys.exit(1)
-        logging.debug(json.dumps(json.loads(updateTagsResult), indent=4))
+            raise SiteError("Can not set tags for device '{0}'.".format(deviceId))
+        logging.debug(json.dumps(updateTagsResult, indent=4))
 
     #
     # fetch edge device connection string
     #
     logging.info("Fetch connection string for device '{0}'".format(deviceId))
-    cmd = "az iot hub device-identity show-connection-string --hub-name {0} --device-id {1}".format(_args.iothubname, deviceId)
-    connectionStringResult = os.popen(cmd).read()
-    if not connectionStringResult:
-        logging.critical("Can not read connection string for device. Exiting...")
-        sys.exit(1)
-    connectionStringJson = json.loads(connectionStringResult)
-    logging.debug(json.dumps(connectionStringJson, indent=4))
-    edgeDeviceConnectionString = connectionStringJson['cs']
+    edgeDeviceConnectionString = timedStep(site, 'device connection string', _hubBackend.getDeviceConnectionString, deviceId)
+    if not edgeDeviceConnectionString:
+        raise SiteError("Can not read connection string for device '{0}'.".format(deviceId))
+    return edgeDeviceConnectionString
 
+def createEdgeDevicesBulk(sites):
     #
-    # create script commands to start/stop IoT Edge
+    # create the IoTHub device identities of all sites with bulk operations and store their connection strings in the sites.
+    # the keys of new devices are generated here, the keys of existing devices are read with one device list.
+    # sites without a connection string afterwards fall back to createEdgeSiteDevice
     #
-    if _targetPlatform == 'windows':
-        startCmd = "Start-Service iotedge"
-        _startScript.append(startCmd + '\n')
-        stopCmd = "Stop-Service iotedge"
-        _stopScript.append(stopCmd + '\n')
+    def bulkUpdate(operation, devices):
+        with _tracer.span('devices bulk {0}'.format(operation), None, 'bulkUpdateDevices') as span:
+            result = _hubBackend.bulkUpdateDevices(devices)
+            if result is None:
+                span['outcome'] = 'no result'
+                logging.error("Bulk {0} of {1} device(s) failed.".format(operation, len(devices)))
+                return []
+            failedDeviceIds = [ error['deviceId'] for error in result['errors'] ]
+            for error in result['errors']:
+                logging.warning("Bulk {0} of device '{1}' failed with {2}: {3}".format(operation, error['deviceId'], error.get('errorCode'), error.get('errorStatus')))
+            return [ device for device in devices if device['id'] not in failedDeviceIds ]
+
+    hostName = dict(part.split('=', 1) for part in _iotHubOwnerConnectionString.split(';') if '=' in part)['HostName']
+    siteDevices = dict(('iiot-edge-{0}'.format(site['site']), site) for site in sites)
+    logging.info("Check which of the {0} device(s) already exist".format(len(siteDevices)))
+    with _tracer.span('devices list', None, 'listDevices'):
+        deviceList = _hubBackend.listDevices()
+    if deviceList is None:
+        logging.error("Can not list the devices of IoTHub '{0}'.".format(_args.iothubname))
+        return
+    existingDevices = dict((device['deviceId'], device) for device in deviceList if device['deviceId'] in siteDevices)
+
+    createDeviceIds = [ deviceId for deviceId in siteDevices if deviceId not in existingDevices ]
+    if _args.force and len(existingDevices) > 0:
+        logging.info("Deleting {0} existing device(s)".format(len(existingDevices)))
+        deletedDevices = bulkUpdate('delete', [ { 'id': deviceId, 'importMode': 'delete' } for deviceId in existingDevices ])
+        createDeviceIds.extend(device['id'] for device in deletedDevices)
 
+    if len(createDeviceIds) > 0:
+        logging.info("Creating {0} device(s)".format(len(createDeviceIds)))
+        # the iiot tag is the string 'true' like in the per-site path, because the deployment target condition compares it as a string
+        createdDevices = bulkUpdate('create', [ { 'id': deviceId, 'importMode': 'create', 'status': 'enabled', 'capabilities': { 'iotEdge': True },
+            'authentication': { 'type': 'sas', 'symmetricKey': { 'primaryKey': base64.b64encode(os.urandom(32)).decode('utf-8'), 'secondaryKey': base64.b64encode(os.urandom(32)).decode('utf-8') } },
+            'tags': { 'iiot': 'true', 'site': siteDevices[deviceId]['site'] } } for deviceId in createDeviceIds ])
+        for device in createdDevices:
+            siteDevices[device['id']]['deviceConnectionString'] = 'HostName={0};DeviceId={1};SharedAccessKey={2}'.format(hostName, device['id'], device['authentication']['symmetricKey']['primaryKey'])
+
+    if not _args.force:
+        for deviceId, device in existingDevices.items():
+            symmetricKey = (device.get('authentication') or {}).get('symmetricKey') or {}
+            if symmetricKey.get('primaryKey'):
+                siteDevices[deviceId]['deviceConnectionString'] = 'HostName={0};DeviceId={1};SharedAccessKey={2}'.format(hostName, deviceId, symmetricKey['primaryKey'])
+
+    fallbackSites = [ site['site'] for site in sites if 'deviceConnectionString' not in site ]
+    if len(fallbackSites) > 0:
+        logging.warning("The devices of {0} site(s) are created with single operations: {1}".format(len(fallbackSites), ", ".join(fallbackSites)))
+
+def createSiteScripts(site, initYmlFileName, edgeDeviceConnectionString):
     #
-    # create setup scripts
+    # create the script commands of a site
     #
-    # patch the init template to create a docker compose configuration
-    ymlFileName = '{0}-edge-init.yml'.format(siteName)
-    ymlOutFileName = '{0}/{1}'.format(_args.outdir, ymlFileName)
-    with open('{0}/site-edge-init.yml'.format(_scriptDir), 'r') as setupTemplate, open(ymlOutFileName, 'w+', newline=_targetNewline) as setupOutFile:
-            for line in setupTemplate:
-                line = line.replace('${OPCPROXY_CONTAINER}', _opcProxyContainer)
-                line = line.replace('${IOTHUB_CONNECTIONSTRING}', _iotHubOwnerConnectionString)
-                line = line.replace('${SITE}', siteName)
-                line = line.replace('${BINDSOURCE}', _dockerBindSource)
-                setupOutFile.write(line)
-
-    # generate our setup script
+    siteName = site['site']
+    siteScripts = { 'start': [], 'stop': [], 'init': [], 'deinit': [], 'images': [] }
+    # the images of the site are pulled by the init script before the steps of all sites
+    siteScripts['images'] = list(dict.fromkeys([ _opcProxyContainer ] + site.get('images', [])))
+    # generate our setup script, the steps run in this order and the script stops at the first failed step
     # todo add registry credential
     # todo use CA signed cert
     initCmd = 'docker volume create {0}_cfappdata'.format(siteName)
-    _initScript.append(initCmd + '\n')
-    initCmd = 'docker pull {0}'.format(_opcProxyContainer)
-    _initScript.append(initCmd + '\n')
-    initCmd = 'docker-compose -p {0} -f {1} up'.format(siteName, ymlFileName)
-    _initScript.append(_initScriptCmdPrefix + initCmd + _initScriptCmdPostfix + '\n')
-    initCmd = 'docker-compose -p {0} -f {1} down'.format(siteName, ymlFileName)
-    _initScript.append(_initScriptCmdPrefix + initCmd + _initScriptCmdPostfix + '\n')
+    siteScripts['init'].append(formatInitStep(siteName, 'create volume', initCmd))
+    initCmd = 'docker-compose -p {0} -f {1} up'.format(siteName, initYmlFileName)
+    siteScripts['init'].append(formatInitStep(siteName, 'init proxy', _initScriptCmdPrefix + initCmd + _initScriptCmdPostfix))
+    initCmd = 'docker-compose -p {0} -f {1} down'.format(siteName, initYmlFileName)
+    siteScripts['init'].append(formatInitStep(siteName, 'remove init proxy', _initScriptCmdPrefix + initCmd + _initScriptCmdPostfix))
     if _targetPlatform == 'windows':
         initCmd = '. ./Init-IotEdgeService.ps1 -DeviceConnectionString "{0}" -ContainerOs {1} '.format(edgeDeviceConnectionString, _containerOs)
         if _args.proxyhost:
@@ -409,16 +1531,759 @@ def createEdgeSiteConfiguration(siteName):
             initCmd = initCmd + ' -UpstreamProtocol {0} '.format(_args.upstreamprotocol)               
         if _args.archivepath:
             initCmd = initCmd + ' -ArchivePath "{0}" '.format(_args.archivepath)               
-        _initScript.append(_initScriptCmdPrefix + initCmd + _initScriptCmdPostfix + '\n')
+        siteScripts['init'].append(formatInitStep(siteName, 'setup iotedge', _initScriptCmdPrefix + initCmd + _initScriptCmdPostfix))
         deinitCmd = ". ./Deinit-IotEdgeService.ps1"
-        _deinitScript.append(_deinitScriptCmdPrefix + deinitCmd + _deinitScriptCmdPostfix + '\n')
+        siteScripts['deinit'].append(_deinitScriptCmdPrefix + deinitCmd + _deinitScriptCmdPostfix + '\n')
     else:
         # todo adjust to v1
         initCmd = 'iotedgectl setup --connection-string "{0}" --auto-cert-gen-force-no-passwords {1}'.format(edgeDeviceConnectionString, '--runtime-log-level debug' if (_args.loglevel.lower() == 'debug') else '')
-        _initScript.append(_initScriptCmdPrefix + initCmd + _initScriptCmdPostfix + '\n')
+        siteScripts['init'].append(formatInitStep(siteName, 'setup iotedge', _initScriptCmdPrefix + initCmd + _initScriptCmdPostfix))
     # deinit commands are written in reversed order
     deinitCmd = 'docker volume rm {0}_cfappdata'.format(siteName)
-    _deinitScript.append(_deinitScriptCmdPrefix + deinitCmd + _deinitScriptCmdPostfix + '\n')
+    siteScripts['deinit'].append(_deinitScriptCmdPrefix + deinitCmd + _deinitScriptCmdPostfix + '\n')
+    return siteScripts
+
+def formatInitStep(siteName, stepName, command):
+    # a step of the init script, which logs its duration and stops the script if the command fails
+    if _targetPlatform == 'windows':
+        return "Invoke-Step '{0}: {1}' {{ {2} }}\n".format(siteName, stepName, command)
+    return "step '{0}: {1}' {2}\n".format(siteName, stepName, command)
+
+def createInitScriptPrologue(images):
+    #
+    # the start of the init script: the step function and the prefetch of all images of the sites with a bounded parallelism,
+    # so the IoT Edge runtime does not need to pull them after the deployment
+    #
+    if _targetPlatform == 'windows':
+        prologue = [
+            "$ErrorActionPreference = 'Stop'\n",
+            "function Invoke-Step([string]$Name, [scriptblock]$Command) {\n",
+            "    Write-Output \"Step '$Name'\"\n",
+            "    $stepTime = [System.Diagnostics.Stopwatch]::StartNew()\n",
+            "    $global:LASTEXITCODE = 0\n",
+            "    & $Command\n",
+            "    if ($LASTEXITCODE -ne 0) { throw \"Step '$Name' failed with exit code $LASTEXITCODE\" }\n",
+            "    Write-Output (\"Step '{0}' completed in {1:N1}s\" -f $Name, $stepTime.Elapsed.TotalSeconds)\n",
+            "}\n",
+            "function Invoke-ImagePull([int]$Parallel, [string[]]$Images) {\n",
+            "    $pulls = @()\n",
+            "    foreach ($image in $Images) {\n",
+            "        while (@($pulls | Where-Object { -not $_.HasExited }).Count -ge $Parallel) { Start-Sleep -Milliseconds 200 }\n",
+            "        $pull = Start-Process docker -ArgumentList 'pull', $image -NoNewWindow -PassThru\n",
+            "        $null = $pull.Handle\n",
+            "        $pulls += $pull\n",
+            "    }\n",
+            "    $pulls | Wait-Process\n",
+            "    $failedPulls = @($pulls | Where-Object { $_.ExitCode -ne 0 })\n",
+            "    if ($failedPulls.Count -gt 0) { throw \"$($failedPulls.Count) of $($Images.Count) image(s) can not be pulled\" }\n",
+            "}\n",
+            "Invoke-Step 'prefetch {0} image(s)' {{ Invoke-ImagePull {1} {2} }}\n".format(len(images), _args.pullparallel, ", ".join("'{0}'".format(image) for image in images)),
+        ]
+    else:
+        prologue = [
+            "#!/bin/sh\n",
+            "set -e\n",
+            "step() {\n",
+            "    stepName=\"$1\"\n",
+            "    shift\n",
+            "    echo \"Step '$stepName'\"\n",
+            "    stepStart=$(date +%s)\n",
+            "    \"$@\"\n",
+            "    echo \"Step '$stepName' completed in $(( $(date +%s) - stepStart ))s\"\n",
+            "}\n",
+            "pull_images() {\n",
+            "    parallel=\"$1\"\n",
+            "    shift\n",
+            "    printf '%s\\n' \"$@\" | xargs -n 1 -P \"$parallel\" docker pull\n",
+            "}\n",
+            "step 'prefetch {0} image(s)' pull_images {1} {2}\n".format(len(images), _args.pullparallel, " ".join(images)),
+        ]
+    return prologue
+
+def createEdgeSiteConfiguration(site):
+    #
+    # create all IoT Edge azure configuration resoures and settings for the site
+    # the script commands for the site are returned and merged by the caller
+    #
+    siteName = site['site']
+    site['timings'] = {}
+    siteStartTime = time.perf_counter()
+
+    #
+    # the deployment and the device identity are independent and are created concurrently,
+    # meanwhile the local setup files are generated
+    #
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        deploymentFuture = executor.submit(createEdgeSiteDeployment, site)
+        # the device may already be created by createEdgeDevicesBulk
+        deviceFuture = executor.submit(createEdgeSiteDevice, site) if 'deviceConnectionString' not in site else None
+
+        #
+        # create setup scripts
+        #
+        # render the init template to create a docker compose configuration
+        ymlFileName = '{0}-edge-init.yml'.format(siteName)
+        ymlOutFileName = '{0}/{1}'.format(_args.outdir, ymlFileName)
+        with _tracer.span('init render', siteName, 'renderTemplate'):
+            with open(ymlOutFileName, 'w+', newline=_targetNewline) as setupOutFile:
+                setupOutFile.write(renderTemplate(compileTemplate('{0}/site-edge-init.yml'.format(_scriptDir)), getTemplateValues(site)))
+
+        # wait for the critical path, exceptions of the steps are raised here
+        deploymentFuture.result()
+        edgeDeviceConnectionString = deviceFuture.result() if deviceFuture else site['deviceConnectionString']
+
+    siteScripts = timedStep(site, 'site scripts', createSiteScripts, site, ymlFileName, edgeDeviceConnectionString)
+    site['timings']['total'] = time.perf_counter() - siteStartTime
+    logging.info("Site '{0}' provisioned in {1:.2f}s ({2})".format(siteName, site['timings']['total'], ", ".join("{0}: {1:.2f}s".format(step, duration) for step, duration in site['timings'].items() if step != 'total')))
+    return siteScripts
+
+def getSiteConfigFiles(site):
+    # the configuration files of a site are copied to the right directory if we are running on the target, otherwise to the config file directory
+    siteConfigFiles = []
+    configDir = _outdirConfig if _args.targetplatform else _hostDirHost
+    if site.get('publisherShards'):
+        for shard, shardContent in enumerate(site['publisherShards'], 1):
+            siteConfigFiles.append((shardContent, '{0}/pn-{1}-{2}.json'.format(configDir, site['site'], shard)))
+    elif site['nodesconfig']:
+        nodesconfigFileName = 'pn-' + site['site'] + '.json'
+        siteConfigFiles.append((site['nodesconfig'], '{0}/{1}'.format(configDir, nodesconfigFileName)))
+    if site['telemetryconfig']:
+        # the telemetry configuration is written normalized and minified
+        telemetryconfigFileName = 'tc-' + site['site'] + '.json'
+        siteConfigFiles.append((site['telemetryconfigContent'], '{0}/{1}'.format(configDir, telemetryconfigFileName)))
+    return siteConfigFiles
+
+def syncFile(source, destinationFileName):
+    # copy a file or write the given bytes, if the destination differs in size or content and return if it was written and its size.
+    # the copy is written to a temporary file and renamed, so readers never see a partially written file
+    with _tracer.span('file sync', None, os.path.basename(destinationFileName)) as span:
+        fileSize = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+        if os.path.isfile(destinationFileName) and os.path.getsize(destinationFileName) == fileSize:
+            sourceHasher = hashlib.sha256()
+            if isinstance(source, bytes):
+                sourceHasher.update(source)
+            else:
+                hashFile(source, sourceHasher)
+            destinationHasher = hashlib.sha256()
+            hashFile(destinationFileName, destinationHasher)
+            if sourceHasher.digest() == destinationHasher.digest():
+                span['outcome'] = 'skipped'
+                return False, fileSize
+        tempFileName = '{0}.{1}.tmp'.format(destinationFileName, os.getpid())
+        try:
+            if isinstance(source, bytes):
+                with open(tempFileName, 'wb') as tempFile:
+                    tempFile.write(source)
+            else:
+                shutil.copyfile(source, tempFileName)
+            os.replace(tempFileName, destinationFileName)
+        finally:
+            if os.path.exists(tempFileName):
+                os.remove(tempFileName)
+        return True, fileSize
+
+def syncFiles(files):
+    # copy a list of (source file or bytes, destination) files concurrently
+    copiedBytes = skippedBytes = copiedFiles = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_args.parallel) as executor:
+        syncFutures = {}
+        for source, destinationFileName in files:
+            if not isinstance(source, bytes) and not os.path.isfile(source):
+                logging.warning("The file '{0}' can not be found. Skipping it...".format(source))
+                continue
+            syncFutures[executor.submit(syncFile, source, destinationFileName)] = destinationFileName
+        for syncFuture in concurrent.futures.as_completed(syncFutures):
+            fileCopied, fileSize = syncFuture.result()
+            if fileCopied:
+                logging.debug("Copied '{0}' ({1} bytes)".format(syncFutures[syncFuture], fileSize))
+                copiedFiles += 1
+                copiedBytes += fileSize
+            else:
+                skippedBytes += fileSize
+    logging.info("Synchronized {0} file(s): {1} file(s) with {2} bytes copied, {3} file(s) with {4} bytes unchanged".format(len(syncFutures), copiedFiles, copiedBytes, len(syncFutures) - copiedFiles, skippedBytes))
+    return copiedBytes, skippedBytes
+
+def hashFile(fileName, hasher):
+    with open(fileName, 'rb') as hashedFile:
+        for chunk in iter(lambda: hashedFile.read(65536), b''):
+            hasher.update(chunk)
+
+def computeSiteInputsHash(site):
+    # hash all inputs, which have an impact on the generated configuration of the site
+    hasher = hashlib.sha256()
+    inputFiles = [ os.path.join(_scriptDir, _args.siteconfig), '{0}/site-edge-init.yml'.format(_scriptDir), 'iiot-edge-deployment-content-template.json',
+        '{0}/extrahosts'.format(_scriptDir), site['nodesconfig'], site['telemetryconfig'] ]
+    for inputFile in inputFiles:
+        hasher.update(str(inputFile).encode('utf-8'))
+        if inputFile and os.path.isfile(inputFile):
+            hashFile(inputFile, hasher)
+    settings = {}
+    settings['site'] = site['site']
+    settings['images'] = [ _opcPublisherContainer, _opcProxyContainer, _opcTwinContainer, _opcPlcContainer ]
+    settings['iothub'] = [ _args.iothubname, _iotHubOwnerConnectionString ]
+    settings['platform'] = [ _targetPlatform, _containerOs, _dockerBindSource, _args.archivepath, _args.loglevel.lower() == 'debug' ]
+    settings['proxy'] = [ _args.proxyschema, _args.proxyhost, _args.proxyport, _args.proxyusername, _args.proxypassword, _args.upstreamprotocol ]
+    settings['extrahosts'] = _extraHosts
+    settings['basedeployment'] = _args.basedeployment
+    settings['publishershards'] = _args.publishershards
+    settings['scripts'] = SITE_SCRIPTS_FORMAT
+    hasher.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    return hasher.hexdigest()
+
+def loadSiteStates():
+    # read the state of the last run, which allows to skip sites with unchanged inputs
+    global _siteStates
+    if os.path.isfile(_stateFileName):
+        try:
+            with open(_stateFileName, 'r') as stateFile:
+                _siteStates = json.loads(stateFile.read())
+        except ValueError:
+            logging.warning("The state file '{0}' is invalid. Ignoring...".format(_stateFileName))
+            _siteStates = {}
+
+def saveSiteStates(siteStates):
+    # write to a temporary file and rename it, to not leave a partial state file behind
+    with open(_stateFileName + '.tmp', 'w') as stateFile:
+        json.dump(siteStates, stateFile, indent=4)
+    os.replace(_stateFileName + '.tmp', _stateFileName)
+
+def isSiteUnchanged(site):
+    # a site is unchanged if the inputs are the same as in the last run
+    if 'inputsHash' not in site:
+        site['inputsHash'] = computeSiteInputsHash(site)
+    siteState = _siteStates.get(site['site'])
+    return not _args.force and siteState is not None and siteState.get('inputs') == site['inputsHash']
+
+def provisionSite(site):
+    # create site/factory configuration and scripts
+    with _tracer.span('site', site['site'], 'provisionSite') as span:
+        siteState = _siteStates.get(site['site'])
+        if isSiteUnchanged(site):
+            logging.info("The inputs of site '{0}' are unchanged. Skipping it...".format(site['site']))
+            site['skipped'] = True
+            span['outcome'] = 'skipped'
+            return siteState['scripts']
+        logging.info("Create the site initialization and configuration for '{0}'".format(site['site']))
+        return createEdgeSiteConfiguration(site)
+
+def mergeTelemetryConfig(schema, defaults, overrides, path):
+    # validate the overrides of a section of the telemetry configuration and merge them into the resolved defaults
+    if not isinstance(overrides, dict):
+        raise ValueError("'{0}' must be an object".format(path))
+    merged = {}
+    for field, fieldSchema in schema.items():
+        fieldPath = '{0}.{1}'.format(path, field)
+        if isinstance(fieldSchema, dict):
+            merged[field] = mergeTelemetryConfig(fieldSchema, defaults.get(field, {}), overrides.get(field, {}), fieldPath)
+            continue
+        value = overrides.get(field, defaults.get(field))
+        if value is None:
+            continue
+        if not isinstance(value, fieldSchema):
+            raise ValueError("'{0}' must be a {1}".format(fieldPath, 'boolean' if fieldSchema is bool else 'string'))
+        if field == 'Pattern':
+            try:
+                re.compile(value)
+            except re.error as e:
+                raise ValueError("'{0}' is not a valid regular expression: {1}".format(fieldPath, e))
+        merged[field] = value
+    unknownFields = [ field for field in overrides if field not in schema ]
+    if len(unknownFields) > 0:
+        raise ValueError("Unknown field(s) in '{0}': {1}".format(path, ", ".join(unknownFields)))
+    return merged
+
+def normalizeTelemetryConfig(telemetryConfig):
+    #
+    # resolve the defaults and the endpoint specific settings of a telemetry configuration, so each of them sets all fields.
+    # raises ValueError for unknown fields and invalid values
+    #
+    if not isinstance(telemetryConfig, dict):
+        raise ValueError("The telemetry configuration must be an object")
+    unknownFields = [ field for field in telemetryConfig if field not in [ 'Defaults', 'EndpointSpecific' ] ]
+    if len(unknownFields) > 0:
+        raise ValueError("Unknown field(s) in the telemetry configuration: {0}".format(", ".join(unknownFields)))
+    normalizedConfig = { 'Defaults': mergeTelemetryConfig(TELEMETRY_CONFIG_SCHEMA, TELEMETRY_CONFIG_DEFAULTS, telemetryConfig.get('Defaults', {}), 'Defaults') }
+    endpointConfigs = telemetryConfig.get('EndpointSpecific', [])
+    if not isinstance(endpointConfigs, list):
+        raise ValueError("'EndpointSpecific' must be a list")
+    if len(endpointConfigs) > 0:
+        normalizedConfig['EndpointSpecific'] = []
+    for index, endpointConfig in enumerate(endpointConfigs):
+        path = 'EndpointSpecific[{0}]'.format(index)
+        if not isinstance(endpointConfig, dict) or not isinstance(endpointConfig.get('ForEndpointUrl'), str):
+            raise ValueError("'{0}' must be an object with a 'ForEndpointUrl' string".format(path))
+        endpointOverrides = dict((field, value) for field, value in endpointConfig.items() if field != 'ForEndpointUrl')
+        normalizedEndpointConfig = { 'ForEndpointUrl': endpointConfig['ForEndpointUrl'] }
+        normalizedEndpointConfig.update(mergeTelemetryConfig(TELEMETRY_CONFIG_SCHEMA, normalizedConfig['Defaults'], endpointOverrides, path))
+        normalizedConfig['EndpointSpecific'].append(normalizedEndpointConfig)
+    return normalizedConfig
+
+def estimateTelemetryPayload(resolvedConfig, sampleValues=TELEMETRY_SAMPLE_VALUES):
+    # estimate the size in bytes of the JSON message OPC Publisher sends for one value change.
+    # patterns are not applied, so this is an upper bound for the sample values
+    message = {}
+    for section, sectionSchema in TELEMETRY_CONFIG_SCHEMA.items():
+        sectionConfig = resolvedConfig[section]
+        if 'Flat' not in sectionSchema:
+            if sectionConfig['Publish']:
+                message[sectionConfig['Name']] = sampleValues[section]
+            continue
+        sectionMessage = message if sectionConfig['Flat'] else {}
+        for field in sectionSchema:
+            if field != 'Flat' and sectionConfig[field]['Publish']:
+                sectionMessage[sectionConfig[field]['Name']] = sampleValues[field]
+        if not sectionConfig['Flat'] and len(sectionMessage) > 0:
+            message[section] = sectionMessage
+    return len(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+
+def loadTelemetryConfig(telemetryConfigFileName):
+    # read, validate and normalize a telemetry configuration and return it minified with the estimated message sizes
+    try:
+        with open(telemetryConfigFileName, 'r') as telemetryConfigFile:
+            telemetryConfig = json.loads(telemetryConfigFile.read())
+    except ValueError as e:
+        raise ValueError("The telemetryconfig file '{0}' is not valid JSON: {1}".format(telemetryConfigFileName, e))
+    try:
+        normalizedConfig = normalizeTelemetryConfig(telemetryConfig)
+    except ValueError as e:
+        raise ValueError("The telemetryconfig file '{0}' is invalid: {1}".format(telemetryConfigFileName, e))
+    payloadSizes = { 'Defaults': estimateTelemetryPayload(normalizedConfig['Defaults']) }
+    for endpointConfig in normalizedConfig.get('EndpointSpecific', []):
+        payloadSizes[endpointConfig['ForEndpointUrl']] = estimateTelemetryPayload(endpointConfig)
+    return json.dumps(normalizedConfig, separators=(',', ':')).encode('utf-8'), payloadSizes
+
+def getStationNodesConfig(station):
+    # the publisher nodes configuration of a station, nodes without a node id (constant or symbolic values) are not published
+    opcNodes = []
+    for node in station.get('OpcNodes', []):
+        if 'ExpandedNodeId' not in node:
+            continue
+        opcNode = { 'Id': node['ExpandedNodeId'] }
+        if _args.publishinginterval:
+            opcNode['OpcPublishingInterval'] = _args.publishinginterval
+        if _args.samplinginterval:
+            opcNode['OpcSamplingInterval'] = _args.samplinginterval
+        opcNodes.append(opcNode)
+    if not station.get('OpcEndpointUrl') or len(opcNodes) == 0:
+        return None
+    return { 'EndpointUrl': station['OpcEndpointUrl'], 'OpcNodes': opcNodes }
+
+def createNodesConfigFromTopology(topologyFileName, configDir):
+    #
+    # stream the topology description and write the publisher nodes configuration for each factory
+    # only one station is kept in memory, so the memory usage does not depend on the size of the topology
+    #
+    try:
+        import ijson
+    except ImportError:
+        logging.critical("The topology subcommand requires the 'ijson' package. Please install the packages listed in requirements.txt. Exiting...")
+        sys.exit(1)
+    stationPrefix = 'Factories.item.ProductionLines.item.Stations.item'
+    sites = []
+    factoryIndex = 0
+    nodesConfigFile = None
+    tempFileName = None
+    stationBuilder = None
+    with open(topologyFileName, 'rb') as topologyFile:
+        try:
+            for prefix, event, value in ijson.parse(topologyFile, use_float=True):
+                if stationBuilder is not None:
+                    stationBuilder.event(event, value)
+                    if prefix == stationPrefix and event == 'end_map':
+                        stationNodesConfig = getStationNodesConfig(stationBuilder.value)
+                        stationBuilder = None
+                        if stationNodesConfig:
+                            nodesConfigFile.write('{0}\n    {1}'.format(',' if endpointCount > 0 else '', json.dumps(stationNodesConfig)))
+                            endpointCount += 1
+                            nodeCount += len(stationNodesConfig['OpcNodes'])
+                elif prefix == stationPrefix and event == 'start_map':
+                    stationBuilder = ijson.ObjectBuilder()
+                    stationBuilder.event(event, value)
+                elif prefix == 'Factories.item' and event == 'start_map':
+                    # the domain could follow the stations, so we write to a temporary file first
+                    factoryIndex += 1
+                    siteName = None
+                    endpointCount = 0
+                    nodeCount = 0
+                    tempFileName = '{0}/pn-factory{1}.json.tmp'.format(configDir, factoryIndex)
+                    nodesConfigFile = open(tempFileName, 'w', newline=_targetNewline)
+                    nodesConfigFile.write('[')
+                elif prefix == 'Factories.item.Domain' and event == 'string':
+                    siteName = value.strip().lower()
+                elif prefix == 'Factories.item' and event == 'end_map':
+                    nodesConfigFile.write('\n]\n')
+                    nodesConfigFile.close()
+                    if not siteName:
+                        logging.warning("Factory {0} in the topology has no Domain. Ignoring...".format(factoryIndex))
+                        os.remove(tempFileName)
+                        tempFileName = None
+                        continue
+                    if siteName in sites:
+                        logging.warning("The Domain '{0}' is used by more than one factory. Overwriting its nodes configuration...".format(siteName))
+                    else:
+                        sites.append(siteName)
+                    nodesConfigFileName = '{0}/pn-{1}.json'.format(configDir, siteName)
+                    os.replace(tempFileName, nodesConfigFileName)
+                    tempFileName = None
+                    logging.info("Created '{0}' with {1} endpoint(s) and {2} node(s).".format(nodesConfigFileName, endpointCount, nodeCount))
+        except ijson.JSONError as e:
+            # remove the nodes configuration of the incomplete factory
+            if nodesConfigFile:
+                nodesConfigFile.close()
+            if tempFileName and os.path.exists(tempFileName):
+                os.remove(tempFileName)
+            logging.critical("The topology file '{0}' is not valid JSON: {1}. Exiting...".format(topologyFileName, e))
+            sys.exit(1)
+    return sites
+
+def analyzeNodesConfig(nodesConfigFileName, telemetryConfig):
+    #
+    # estimate the publishing load of a nodes configuration. the endpoints are streamed and the nodes are deduplicated per endpoint
+    # by a digest of their id, so the memory usage grows with the number of distinct nodes, but not with the length of their ids.
+    # the load is an upper bound: each node is expected to change with each sample, but at most once per publishing interval
+    #
+    import ijson
+    analysis = { 'file': nodesConfigFileName, 'entries': 0, 'nodes': 0, 'duplicateNodes': 0, 'sessions': 0, 'subscriptions': 0,
+        'messagesPerSecond': 0.0, 'bytesPerSecond': 0.0, 'groups': [], 'warnings': [] }
+    nodeDigests = {}
+    groups = {}
+    endpointEntries = {}
+    with open(nodesConfigFileName, 'rb') as nodesConfigFile:
+        for entry in ijson.items(nodesConfigFile, 'item', use_float=True):
+            analysis['entries'] += 1
+            endpointUrl = entry.get('EndpointUrl')
+            if not endpointUrl:
+                analysis['warnings'].append("Entry {0} has no EndpointUrl".format(analysis['entries']))
+                continue
+            endpointEntries.setdefault(endpointUrl, 0)
+            endpointEntries[endpointUrl] += 1
+            opcNodes = list(entry.get('OpcNodes') or [])
+            # the legacy format configures one node per entry
+            if 'NodeId' in entry:
+                opcNodes.append({ 'Id': entry['NodeId'].get('Identifier') if isinstance(entry['NodeId'], dict) else entry['NodeId'] })
+            for opcNode in opcNodes:
+                nodeId = opcNode.get('Id') or opcNode.get('ExpandedNodeId')
+                if not nodeId:
+                    analysis['warnings'].append("Entry {0} of endpoint '{1}' has a node without an id".format(analysis['entries'], endpointUrl))
+                    continue
+                analysis['nodes'] += 1
+                nodeDigest = hashlib.blake2b(str(nodeId).encode('utf-8'), digest_size=16).digest()
+                endpointNodeDigests = nodeDigests.setdefault(endpointUrl, set())
+                if nodeDigest in endpointNodeDigests:
+                    analysis['duplicateNodes'] += 1
+                    continue
+                endpointNodeDigests.add(nodeDigest)
+                publishingInterval = opcNode.get('OpcPublishingInterval') or _args.publishinginterval
+                samplingInterval = opcNode.get('OpcSamplingInterval') or _args.samplinginterval
+                group = groups.setdefault((endpointUrl, publishingInterval, samplingInterval), { 'nodes': 0, 'nodeIdLength': 0 })
+                group['nodes'] += 1
+                group['nodeIdLength'] += len(nodeId)
+
+    # the message size depends on the endpoint specific telemetry configuration and the length of the node ids
+    endpointConfigs = dict((endpointConfig['ForEndpointUrl'], endpointConfig) for endpointConfig in telemetryConfig.get('EndpointSpecific', []))
+    endpointIntervals = {}
+    for (endpointUrl, publishingInterval, samplingInterval), group in sorted(groups.items()):
+        sampleValues = dict(TELEMETRY_SAMPLE_VALUES)
+        sampleValues['EndpointUrl'] = endpointUrl
+        sampleValues['NodeId'] = 'x' * (group['nodeIdLength'] // group['nodes'])
+        messageSize = estimateTelemetryPayload(endpointConfigs.get(endpointUrl, telemetryConfig['Defaults']), sampleValues)
+        messagesPerSecond = group['nodes'] * 1000.0 / max(publishingInterval, samplingInterval, 1)
+        analysis['groups'].append({ 'endpoint': endpointUrl, 'publishingInterval': publishingInterval, 'samplingInterval': samplingInterval, 'nodes': group['nodes'],
+            'messageSize': messageSize, 'messagesPerSecond': messagesPerSecond, 'bytesPerSecond': messagesPerSecond * messageSize })
+        analysis['messagesPerSecond'] += messagesPerSecond
+        analysis['bytesPerSecond'] += messagesPerSecond * messageSize
+        endpointIntervals.setdefault(endpointUrl, set()).add(publishingInterval)
+
+    # OPC Publisher opens one session per endpoint and one subscription per publishing interval of an endpoint
+    analysis['sessions'] = len(endpointIntervals)
+    analysis['subscriptions'] = sum(len(intervals) for intervals in endpointIntervals.values())
+    for endpointUrl, entryCount in endpointEntries.items():
+        if entryCount > 1:
+            analysis['warnings'].append("Endpoint '{0}' is configured in {1} entries".format(endpointUrl, entryCount))
+    normalizedEndpoints = {}
+    for endpointUrl in endpointEntries:
+        normalizedEndpoints.setdefault(endpointUrl.lower().rstrip('/'), []).append(endpointUrl)
+    for endpointUrls in normalizedEndpoints.values():
+        if len(endpointUrls) > 1:
+            analysis['warnings'].append("The endpoints {0} differ only in case or a trailing '/' and open separate sessions".format(", ".join("'{0}'".format(endpointUrl) for endpointUrl in endpointUrls)))
+    if analysis['duplicateNodes'] > 0:
+        analysis['warnings'].append("{0} node(s) are configured more than once for the same endpoint".format(analysis['duplicateNodes']))
+    return analysis
+
+def shardNodesConfig(nodesConfigFileName, shardCount):
+    #
+    # split a nodes configuration by endpoint into at most shardCount shards, which are balanced by the estimated message rate.
+    # like in the analysis, a node sends at most one message per sampling and per publishing interval.
+    # all entries of an endpoint are in the same shard, so there is only one session per endpoint.
+    # returns the content of the shards and their message rates
+    #
+    import ijson
+    endpoints = {}
+    with open(nodesConfigFileName, 'rb') as nodesConfigFile:
+        try:
+            for entry in ijson.items(nodesConfigFile, 'item', use_float=True):
+                endpoint = endpoints.setdefault(entry.get('EndpointUrl'), { 'entries': [], 'messageRate': 0.0 })
+                endpoint['entries'].append(entry)
+                # the legacy format configures one node per entry, OPC Publisher uses intervals of 1000 ms by default
+                for opcNode in entry.get('OpcNodes') or [ entry ]:
+                    endpoint['messageRate'] += 1000.0 / max(opcNode.get('OpcPublishingInterval') or 1000, opcNode.get('OpcSamplingInterval') or 1000, 1)
+        except ijson.JSONError as e:
+            raise ValueError(e)
+    shards = [ { 'entries': [], 'messageRate': 0.0 } for shard in range(min(shardCount, len(endpoints))) ]
+    # assign the endpoints with the highest message rate first, each to the shard with the lowest message rate
+    for endpoint in sorted(endpoints.values(), key=lambda endpoint: endpoint['messageRate'], reverse=True):
+        shard = min(shards, key=lambda shard: shard['messageRate'])
+        shard['entries'].extend(endpoint['entries'])
+        shard['messageRate'] += endpoint['messageRate']
+    return [ ('[\n{0}\n]\n'.format(',\n'.join('    {0}'.format(json.dumps(entry)) for entry in shard['entries'])).encode('utf-8'), shard['messageRate']) for shard in shards ]
+
+def logNodesConfigAnalysis(analysis):
+    logging.info('')
+    logging.info("Nodes configuration '{0}': {1} node(s) in {2} entries, {3} session(s), {4} subscription(s)".format(analysis['file'], analysis['nodes'], analysis['entries'], analysis['sessions'], analysis['subscriptions']))
+    logging.info("{0:<60} {1:>10} {2:>10} {3:>8} {4:>8} {5:>10} {6:>12}".format('endpoint', 'publish', 'sample', 'nodes', 'msg[B]', 'msg/s', 'B/s'))
+    for group in analysis['groups']:
+        logging.info("{0:<60} {1:>10} {2:>10} {3:>8} {4:>8} {5:>10.1f} {6:>12.0f}".format(group['endpoint'], group['publishingInterval'], group['samplingInterval'], group['nodes'], group['messageSize'], group['messagesPerSecond'], group['bytesPerSecond']))
+    logging.info("{0:<60} {1:>10} {2:>10} {3:>8} {4:>8} {5:>10.1f} {6:>12.0f}".format('total', '', '', analysis['nodes'] - analysis['duplicateNodes'], '', analysis['messagesPerSecond'], analysis['bytesPerSecond']))
+    for warning in analysis['warnings']:
+        logging.warning(warning)
+
+def getProbeEndpoints(configFileName):
+    # stream the endpoint URLs of a nodes configuration or a topology description
+    import ijson
+    endpointPrefixes = [ 'item.EndpointUrl', 'Factories.item.ProductionLines.item.Stations.item.OpcEndpointUrl' ]
+    endpointUrls = []
+    with open(configFileName, 'rb') as configFile:
+        try:
+            for prefix, event, value in ijson.parse(configFile):
+                if event == 'string' and prefix in endpointPrefixes:
+                    endpointUrls.append(value)
+        except ijson.JSONError as e:
+            raise ValueError(e)
+    return endpointUrls
+
+async def probeEndpoint(target, semaphore, timeout):
+    #
+    # resolve the hostname of an endpoint and connect to it. the extrahosts mapping is used before DNS like in the containers.
+    # the probe only checks the TCP connection, the OPC UA handshake is not done
+    #
+    import asyncio
+    hostName, port = target
+    result = { 'host': hostName, 'port': port, 'address': None, 'resolvedBy': None, 'resolveMs': None, 'connectMs': None, 'outcome': 'ok' }
+    async with semaphore:
+        loop = asyncio.get_running_loop()
+        startTime = time.perf_counter()
+        try:
+            if hostName.lower() in _extraHosts:
+                result['address'] = _extraHosts[hostName.lower()]
+                result['resolvedBy'] = 'extrahosts'
+            else:
+                addresses = await asyncio.wait_for(loop.getaddrinfo(hostName, port, type=socket.SOCK_STREAM), timeout)
+                result['address'] = addresses[0][4][0]
+                result['resolvedBy'] = 'dns'
+        except asyncio.TimeoutError:
+            result['outcome'] = 'resolve timeout'
+        except OSError:
+            result['outcome'] = 'unresolved'
+        result['resolveMs'] = (time.perf_counter() - startTime) * 1000.0
+        if result['outcome'] != 'ok':
+            return result
+        startTime = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(result['address'], port), timeout)
+            result['connectMs'] = (time.perf_counter() - startTime) * 1000.0
+            writer.close()
+            # a reset by the peer while closing does not change the outcome of the probe
+            with contextlib.suppress(OSError):
+                await writer.wait_closed()
+        except asyncio.TimeoutError:
+            result['outcome'] = 'connect timeout'
+        except ConnectionRefusedError:
+            result['outcome'] = 'refused'
+        except OSError as e:
+            result['outcome'] = e.strerror or type(e).__name__
+    return result
+
+async def probeEndpointTargets(targets, concurrency, timeout):
+    import asyncio
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*[ probeEndpoint(target, semaphore, timeout) for target in targets ])
+
+def probeEndpoints(endpointUrls, concurrency, timeout):
+    #
+    # probe all unique endpoints concurrently. endpoints with the same host and port are probed once.
+    # returns the result of each endpoint in the order of the endpoint URLs
+    #
+    import asyncio
+    endpointTargets = {}
+    for endpointUrl in endpointUrls:
+        try:
+            url = urllib.parse.urlsplit(endpointUrl)
+            if url.scheme.lower() != 'opc.tcp' or not url.hostname:
+                raise ValueError
+            endpointTargets[endpointUrl] = (url.hostname, url.port or OPCUA_DEFAULT_PORT)
+        except ValueError:
+            endpointTargets[endpointUrl] = None
+    targets = list(dict.fromkeys(target for target in endpointTargets.values() if target))
+    targetResults = dict(zip(targets, asyncio.run(probeEndpointTargets(targets, concurrency, timeout))))
+    results = []
+    for endpointUrl, target in endpointTargets.items():
+        result = { 'endpoint': endpointUrl, 'outcome': 'invalid url' }
+        if target:
+            result.update(targetResults[target])
+        results.append(result)
+    return results
+
+def logProbeResults(results):
+    logging.info('')
+    logging.info("{0:<60} {1:<40} {2:<10} {3:>12} {4:>12} {5}".format('endpoint', 'address', 'resolved', 'resolve[ms]', 'connect[ms]', 'outcome'))
+    for result in sorted(results, key=lambda result: (result['outcome'] == 'ok', result['endpoint'])):
+        logging.info("{0:<60} {1:<40} {2:<10} {3:>12} {4:>12} {5}".format(result['endpoint'], '{0}:{1}'.format(result['address'], result['port']) if result.get('address') else '',
+            result.get('resolvedBy') or '', '{0:.1f}'.format(result['resolveMs']) if result.get('resolveMs') is not None else '',
+            '{0:.1f}'.format(result['connectMs']) if result.get('connectMs') is not None else '', result['outcome']))
+    connectTimes = sorted(result['connectMs'] for result in results if result['outcome'] == 'ok')
+    if len(connectTimes) > 0:
+        logging.info("{0} of {1} endpoint(s) are reachable, connect time median {2:.1f} ms, max {3:.1f} ms".format(len(connectTimes), len(results), connectTimes[len(connectTimes) // 2], connectTimes[-1]))
+    else:
+        logging.info("None of the {0} endpoint(s) is reachable".format(len(results)))
+
+def createLoadTestSite(siteName, plcCount, nodeCount, changePeriod, samplingInterval, publishingInterval, outDir):
+    #
+    # create a siteconfig with the publisher and plcCount OPC PLC modules, each with nodeCount nodes, which change every changePeriod seconds,
+    # and the publisher nodes configuration, which publishes all nodes. the PLC modules are reached by their module name
+    #
+    siteConfigFileName = os.path.join(outDir, 'loadtest-{0}.yml'.format(siteName))
+    with open(siteConfigFileName, 'w', newline=_targetNewline) as siteConfigFile:
+        siteConfigFile.write("""version: '3'
+
+volumes:
+    cfappdata:
+        external:
+            name: ${SITE}_cfappdata
+
+services:
+    publisher:
+        image: ${OPCPUBLISHER_CONTAINER}
+        restart: always
+        container_name: pub-${SITE}
+        hostname: pub-${SITE}
+        extra_hosts:
+            ${EXTRAHOSTS}
+        volumes:
+            - "${BINDSOURCE}:/d"
+        command: pub-${SITE} --pf /d/pn-${SITE}.json ${TELEMETRYCONFIG_OPTION} --lf /d/${SITE}-pub.log --site ${SITE} --di=60 --tp /d/trusted --rp /d/rejected --ip /d/issuer --to --aa
+""")
+        for plc in range(1, plcCount + 1):
+            siteConfigFile.write("""
+    plc{0}-${{SITE}}:
+        image: ${{OPCPLC_CONTAINER}}
+        restart: always
+        container_name: plc{0}-${{SITE}}
+        hostname: plc{0}-${{SITE}}
+        volumes:
+            - "${{BINDSOURCE}}:/d"
+        expose:
+            - "{1}"
+        command: --pn={1} --fn={2} --fr={3} --sn=0 --lf /d/${{SITE}}-plc{0}.log --tp /d/trusted --rp /d/rejected --ip /d/issuer --to --aa
+""".format(plc, OPCPLC_PORT, nodeCount, changePeriod))
+    # the nodes are written one endpoint at a time, so the memory usage does not depend on the number of nodes
+    nodesConfigFileName = os.path.join(outDir, 'pn-{0}.json'.format(siteName))
+    with open(nodesConfigFileName, 'w', newline=_targetNewline) as nodesConfigFile:
+        nodesConfigFile.write('[')
+        for plc in range(1, plcCount + 1):
+            opcNodes = [ { 'Id': 'ns=2;s=FastUInt{0}'.format(node), 'OpcSamplingInterval': samplingInterval, 'OpcPublishingInterval': publishingInterval } for node in range(1, nodeCount + 1) ]
+            endpointConfig = { 'EndpointUrl': 'opc.tcp://plc{0}-{1}:{2}'.format(plc, siteName, OPCPLC_PORT), 'UseSecurity': False, 'OpcNodes': opcNodes }
+            nodesConfigFile.write('{0}\n    {1}'.format(',' if plc > 1 else '', json.dumps(endpointConfig)))
+        nodesConfigFile.write('\n]\n')
+    return siteConfigFileName, nodesConfigFileName
+
+def getLogFiles(logPaths):
+    #
+    # the files of each log, which is identified by site and log name. a log file given on the command line adds its rotated files,
+    # a directory adds all logs in it. the files of a log are ordered by their modification time, oldest first
+    #
+    logFiles = {}
+    for logPath in logPaths:
+        if os.path.isdir(logPath):
+            directory, prefix = logPath, None
+        else:
+            directory, prefix = os.path.split(logPath)
+            prefix = LOG_FILE_PATTERN.match(prefix).group(0) if LOG_FILE_PATTERN.match(prefix) else prefix
+        for entry in os.scandir(directory or '.'):
+            match = LOG_FILE_PATTERN.match(entry.name)
+            if entry.is_file() and match and (prefix is None or entry.name.startswith(prefix)):
+                logFiles.setdefault((match.group('site'), match.group('log')), set()).add(entry.path)
+    return dict((log, sorted(files, key=os.path.getmtime)) for log, files in sorted(logFiles.items()))
+
+def analyzeLog(log, logFileNames, bucketSeconds):
+    #
+    # stream all files of a log in one pass and aggregate the metrics in time buckets. lines are only matched with the
+    # patterns if they contain their marker and the timestamp is only parsed if it changed, so multi-GB logs are fast to analyze.
+    # the files are read as bytes, so invalid encodings do not fail the analysis
+    #
+    buckets = {}
+    bucket = None
+    linePrefix = None
+    lastTimestamp = None
+    counterValues = {}
+    for logFileName in logFileNames:
+        openLog = gzip.open if logFileName.endswith('.gz') else open
+        with openLog(logFileName, 'rb') as logFile:
+            for line in logFile:
+                # consecutive lines usually have the same timestamp up to the seconds
+                if line[:20] != linePrefix:
+                    linePrefix = line[:20]
+                    timestampMatch = LOG_TIMESTAMP_PATTERN.match(line)
+                else:
+                    timestampMatch = None
+                if timestampMatch and timestampMatch.group(1) != lastTimestamp:
+                    lastTimestamp = timestampMatch.group(1)
+                    seconds = datetime.datetime.fromisoformat(lastTimestamp.decode('ascii').replace(' ', 'T')).replace(tzinfo=datetime.timezone.utc).timestamp()
+                    bucketStart = int(seconds // bucketSeconds * bucketSeconds)
+                    if bucket is None or bucket['start'] != bucketStart:
+                        bucket = buckets.setdefault(bucketStart, dict([ ('start', bucketStart) ] + [ (metric, 0) for metric in LOG_METRICS ] + [ ('sendLatencies', []) ]))
+                if bucket is None or not LOG_MARKER_PATTERN.search(line):
+                    continue
+                for counter, (markers, pattern) in LOG_COUNTERS.items():
+                    if any(marker in line for marker in markers):
+                        match = pattern.search(line)
+                        if match:
+                            # the first value is the base, a lower value means the publisher was restarted
+                            value = int(match.group(1))
+                            lastValue = counterValues.get(counter, value)
+                            bucket[counter] += value - lastValue if value >= lastValue else value
+                            counterValues[counter] = value
+                for event, (markers, pattern) in LOG_EVENTS.items():
+                    if any(marker in line for marker in markers) and pattern.search(line):
+                        bucket[event] += 1
+                if any(marker in line for marker in LOG_SEND_LATENCY[0]):
+                    match = LOG_SEND_LATENCY[1].search(line)
+                    if match:
+                        bucket['sendLatencies'].append(float(match.group(1)))
+    rows = []
+    for bucketStart, bucket in sorted(buckets.items()):
+        row = { 'site': log[0], 'log': log[1], 'start': datetime.datetime.fromtimestamp(bucketStart, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ') }
+        for metric in LOG_METRICS:
+            row[metric] = bucket[metric]
+        row['messagesPerSecond'] = bucket['messagesSent'] / bucketSeconds
+        row['notificationsPerSecond'] = bucket['notifications'] / bucketSeconds
+        latencies = bucket['sendLatencies']
+        row['sendLatencyMeanMs'] = sum(latencies) / len(latencies) if latencies else None
+        row['sendLatencyMaxMs'] = max(latencies) if latencies else None
+        rows.append(row)
+    return rows
+
+def logLogAnalysis(log, logFileNames, rows):
+    logging.info('')
+    logging.info("Log '{0}-{1}' ({2} file(s)): {3} time bucket(s)".format(log[0], log[1], len(logFileNames), len(rows)))
+    if len(rows) == 0:
+        return
+    totals = dict((metric, sum(row[metric] for row in rows)) for metric in LOG_METRICS)
+    latencies = [ row['sendLatencyMaxMs'] for row in rows if row['sendLatencyMaxMs'] is not None ]
+    logging.info("{0:<22} {1:>12} {2:>12} {3:>14} {4:>14} {5:>10} {6:>10} {7:>8}".format('', 'messages', 'msg/s', 'notifications', 'notif/s', 'failures', 'reconnects', 'errors'))
+    logging.info("{0:<22} {1:>12} {2:>12} {3:>14} {4:>14} {5:>10} {6:>10} {7:>8}".format('total', totals['messagesSent'], '', totals['notifications'], '', totals['sendFailures'], totals['reconnects'], totals['errors']))
+    logging.info("{0:<22} {1:>12} {2:>12.1f} {3:>14} {4:>14.1f}".format('peak bucket', max(row['messagesSent'] for row in rows), max(row['messagesPerSecond'] for row in rows),
+        max(row['notifications'] for row in rows), max(row['notificationsPerSecond'] for row in rows)))
+    logging.info("{0:<22} {1} - {2}{3}".format('time range', rows[0]['start'], rows[-1]['start'], ", max send latency {0:.1f} ms".format(max(latencies)) if latencies else ''))
 
 def getLocalIpAddress():
     ipAddress = None
@@ -434,36 +2299,113 @@ def getLocalIpAddress():
     return ipAddress
 
 def getExtraHosts():
+    # read the hosts of the extrahosts file, which has the hosts file syntax with IPv4 or IPv6 addresses
     hosts = []
-    if os.path.exists("{0}/extrahosts".format(_scriptDir)) and os.path.isfile("{0}/extrahosts".format(_scriptDir)):
-        with open("{0}/extrahosts".format(_scriptDir), "r") as hostsfile:
-            hostlines = hostsfile.readlines()
-        hostlines = [line.strip() for line in hostlines
-                    if not line.startswith('#') and line.strip() != '']
-        for line in hostlines:
-            linesplit = line.split('#')[0].split()[:]
-            ipAddress = linesplit[0]
-            try:
-                socket.inet_aton(ipAddress)
-            except:
-                exceptionInfo = sys.exc_info()
-                logging.warning("Exception info:")
-                logging.warning("{0}".format(exceptionInfo))
-                logging.warning("There is an entry in extrahosts with invalid IP address syntax: '{0}'. Ignoring...".format(ipAddress))            
-                continue
-            hostNames = linesplit[1:]
-            for hostName in hostNames:
-                hosts.append({ "host": hostName, "ip": ipAddress })
+    extraHostsFileName = '{0}/extrahosts'.format(_scriptDir)
+    if os.path.isfile(extraHostsFileName):
+        with open(extraHostsFileName, 'r') as hostsFile:
+            for line in hostsFile:
+                lineSplit = line.split('#')[0].split()
+                if len(lineSplit) == 0:
+                    continue
+                ipAddress = lineSplit[0]
+                try:
+                    ipAddress = str(ipaddress.ip_address(ipAddress))
+                except ValueError:
+                    logging.warning("There is an entry in extrahosts with invalid IP address syntax: '{0}'. Ignoring...".format(ipAddress))
+                    continue
+                if len(lineSplit) == 1:
+                    logging.warning("There is an entry in extrahosts without a hostname for IP address '{0}'. Ignoring...".format(ipAddress))
+                for hostName in lineSplit[1:]:
+                    hosts.append({ "host": hostName, "ip": ipAddress })
     return hosts
 
+def createExtraHostsIndex(hosts):
+    # index the hosts by their hostname. like in a hosts file the first entry of a hostname is used
+    extraHosts = {}
+    for host in hosts:
+        hostName = host['host'].lower()
+        if hostName not in extraHosts:
+            extraHosts[hostName] = host['ip']
+        elif extraHosts[hostName] != host['ip']:
+            logging.warning("The host '{0}' is mapped to '{1}' and '{2}'. Using '{1}'...".format(host['host'], extraHosts[hostName], host['ip']))
+    return extraHosts
+
+def formatExtraHosts(extraHosts):
+    # format the hosts of the index as docker extra hosts
+    return [ '{0}:{1}'.format(hostName, ipAddress) for hostName, ipAddress in extraHosts.items() ]
+
+def configureTargetPlatform(targetPlatform):
+    # the names of the scripts and the decoration of their commands for the target platform
+    global _targetPlatform, _targetNewline
+    global _startScriptFileName, _startScriptCmdPrefix, _startScriptCmdPostfix, _stopScriptFileName, _stopScriptCmdPrefix, _stopScriptCmdPostfix
+    global _initScriptFileName, _initScriptCmdPrefix, _initScriptCmdPostfix, _deinitScriptFileName, _deinitScriptCmdPrefix, _deinitScriptCmdPostfix
+    _targetPlatform = targetPlatform
+    if _targetPlatform == 'linux' or _targetPlatform == 'wsl':
+        _startScriptFileName = 'start-iiotedge.sh'
+        _startScriptCmdPrefix = ''
+        _startScriptCmdPostfix = ' &'
+        _stopScriptFileName = 'stop-iiotedge.sh'
+        _stopScriptCmdPrefix = ''
+        _stopScriptCmdPostfix = ''
+        _initScriptFileName = 'init-iiotedge.sh'
+        _initScriptCmdPrefix = ''
+        _initScriptCmdPostfix = ''
+        _deinitScriptFileName = 'deinit-iiotedge.sh'
+        _deinitScriptCmdPrefix = ''
+        _deinitScriptCmdPostfix = ' &'
+        _targetNewline = '\n'
+    elif _targetPlatform == 'windows':
+        _startScriptFileName = 'Start-IIoTEdge.ps1'
+        _startScriptCmdPrefix = 'start '
+        _startScriptCmdPostfix = ''
+        _stopScriptFileName = 'Stop-IIoTEdge.ps1'
+        _stopScriptCmdPrefix = ''
+        _stopScriptCmdPostfix = ''
+        _initScriptFileName = 'Init-IIoTEdge.ps1'
+        _initScriptCmdPrefix = ''
+        _initScriptCmdPostfix = ''
+        _deinitScriptFileName = 'Deinit-IIoTEdge.ps1'
+        _deinitScriptCmdPrefix = ''
+        _deinitScriptCmdPostfix = ''
+        _targetNewline = '\r\n'
+
+def writeSiteScripts(siteScriptsList):
+    # write the scripts. the init script sets up the IoT Edge runtime of the host for the device of one site,
+    # so each site of a multi-site run gets its own scripts
+    for siteName, siteScripts in siteScriptsList:
+        startScript = list(siteScripts['start'])
+        stopScript = list(siteScripts['stop'])
+        initScript = createInitScriptPrologue(siteScripts['images']) + siteScripts['init']
+        # optional: sleep to debug initialization script issues
+        # initScript.append('timeout 60\n')
+        # create script commands to start/stop IoT Edge
+        if _targetPlatform == 'windows':
+            startCmd = "Start-Service iotedge"
+            startScript.append(startCmd + '\n')
+            stopCmd = "Stop-Service iotedge"
+            stopScript.append(stopCmd + '\n')
+        writeScript(getSiteScriptFileName(_startScriptFileName, siteName), startScript)
+        writeScript(getSiteScriptFileName(_stopScriptFileName, siteName), stopScript, reverse = True)
+        writeScript(getSiteScriptFileName(_initScriptFileName, siteName), initScript)
+        writeScript(getSiteScriptFileName(_deinitScriptFileName, siteName), siteScripts['deinit'], reverse = True)
+
+def getSiteScriptFileName(scriptFileBaseName, siteName):
+    # the scripts of a single site keep their names, the scripts of a multi-site run get the site name as suffix
+    if len(_edgeSites) <= 1:
+        return scriptFileBaseName
+    scriptName, scriptExtension = os.path.splitext(scriptFileBaseName)
+    return '{0}-{1}{2}'.format(scriptName, siteName, scriptExtension)
+
 def writeScript(scriptFileBaseName, scriptBuffer, reverse = False):
     scriptFileName = '{0}/{1}'.format(_args.outdir, scriptFileBaseName)
     logging.debug("Write '{0}'{1}".format(scriptFileName, ' in reversed order.' if reverse else '.'))
     if reverse:
         scriptBuffer = scriptBuffer[::-1]
-    with open(scriptFileName, 'w+', newline=_targetNewline) as scriptFile: 
-        for command in scriptBuffer:
-            scriptFile.write(command)   
+    with _tracer.span('script write', None, scriptFileBaseName):
+        with open(scriptFileName, 'w+', newline=_targetNewline) as scriptFile: 
+            for command in scriptBuffer:
+                scriptFile.write(command)   
     os.chmod(scriptFileName, os.stat(scriptFileName).st_mode | stat.S_IXOTH | stat.S_IXGRP | stat.S_IXUSR)
 
 
@@ -476,6 +2418,8 @@ def azureLogin():
         cmdResult = os.popen(cmd).read()
     else:
         try:
+            from azure.common.client_factory import get_client_from_cli_profile
+            from azure.mgmt.resource import ResourceManagementClient
             client = get_client_from_cli_profile(ResourceManagementClient)
         except:
             exceptionInfo = sys.exc_info()
@@ -489,23 +2433,20 @@ def azureGetIotHubCs():
     global _iotHubOwnerConnectionString
     
     # verify IoTHub existence
-    cmd = "az iot hub show --name {0}".format(_args.iothubname)
-    iotHubShowResult = os.popen(cmd).read()
+    with _tracer.span('iothub show', None, 'showIotHub'):
+        iotHubShowResult = _hubBackend.showIotHub()
     if not iotHubShowResult:
         logging.critical("IoTHub '{0}' can not be found. Please verify your Azure login and account settings. Exiting...".format(_args.iothubname))
         sys.exit(1)
-    logging.debug(json.dumps(json.loads(iotHubShowResult), indent=4))           
+    logging.debug(json.dumps(iotHubShowResult, indent=4))           
 
     # fetch the connectionstring
     logging.info("Read IoTHub connectionstring")
-    cmd = "az iot hub show-connection-string --hub-name {0}".format(_args.iothubname)
-    connectionStringResult = os.popen(cmd).read()
-    if not connectionStringResult:
+    with _tracer.span('iothub connection string', None, 'getIotHubConnectionString'):
+        _iotHubOwnerConnectionString = _hubBackend.getIotHubConnectionString()
+    if not _iotHubOwnerConnectionString:
         logging.critical("Can not read IoTHub owner connection string. Please verify your configuration. Exiting...")
         sys.exit(1)
-    connectionStringJson = json.loads(connectionStringResult)
-    logging.debug(json.dumps(connectionStringJson, indent=4))
-    _iotHubOwnerConnectionString = connectionStringJson['cs']
     logging.debug("IoTHub connection string is '{0}'".format(_iotHubOwnerConnectionString))
     
 
@@ -515,335 +2456,571 @@ def azureGetIotHubCs():
 #
 ###############################################################################
 
-# configure script logging
-try:
-    logLevel = getattr(logging, _args.loglevel.upper())
-except:
-    logLevel = logging.INFO
-if not isinstance(logLevel, int):
-    raise( ValueError('Invalid log level: {0}'.format(logLevel)))
-logging.basicConfig(level=logLevel)
+def main():
+    global _args, _targetPlatform, _containerOs, _targetNewline, _platformCpu, _hostDirHost, _outdirConfig, _dockerBindSource
+    global _opcPublisherContainer, _opcProxyContainer, _opcTwinContainer, _opcPlcContainer, _additionalHosts, _extraHosts, _hubBackend, _stateFileName
+    global _tracer, _hubCache
 
-# get path of script
-_scriptDir = sys.path[0]
+    _tracer = Tracer()
+    _args = parser.parse_args()
 
-# CPU specific settings
-if 'intel64' in str(platform.processor()).lower():
-    _platformCpu = 'amd64'
-else:
-    _platformCpu = 'arm32v7'
+    # configure script logging
+    try:
+        logLevel = getattr(logging, _args.loglevel.upper())
+    except:
+        logLevel = logging.INFO
+    if not isinstance(logLevel, int):
+        raise( ValueError('Invalid log level: {0}'.format(logLevel)))
+    logging.basicConfig(level=logLevel)
 
-#
-# OS specific settings
-#
-if not _args.targetplatform:
-    _targetPlatform = str(platform.system()).lower()
-    if _targetPlatform == 'linux':
-        # check if we are on WSL
-        for line in open('/proc/version'):
-            if 'Microsoft' in line:
-                _targetPlatform = 'wsl'
-    elif _targetPlatform == 'windows':
-         pass
+    # CPU specific settings
+    if 'intel64' in str(platform.processor()).lower() or platform.machine().lower() in [ 'x86_64', 'amd64' ]:
+        _platformCpu = 'amd64'
     else:
-        logging.critical("OS is not supported. Exiting...")
-        sys.exit(1)
-else:
-    _targetPlatform = _args.targetplatform
-logging.info("Using targetplatform '{0}'".format(_targetPlatform))
-
-if _targetPlatform == 'linux' or _targetPlatform == 'wsl':
-    _startScriptFileName = 'start-iiotedge.sh'
-    _startScriptCmdPrefix = ''
-    _startScriptCmdPostfix = ' &'
-    _stopScriptFileName = 'stop-iiotedge.sh'
-    _stopScriptCmdPrefix = ''
-    _stopScriptCmdPostfix = ''
-    _initScriptFileName = 'init-iiotedge.sh'
-    _initScriptCmdPrefix = ''
-    _initScriptCmdPostfix = ' &'
-    _deinitScriptFileName = 'deinit-iiotedge.sh'
-    _deinitScriptCmdPrefix = ''
-    _deinitScriptCmdPostfix = ' &'
-    _targetNewline = '\n'
-elif _targetPlatform == 'windows':
-    _startScriptFileName = 'Start-IIoTEdge.ps1'
-    _startScriptCmdPrefix = 'start '
-    _startScriptCmdPostfix = ''
-    _stopScriptFileName = 'Stop-IIoTEdge.ps1'
-    _stopScriptCmdPrefix = ''
-    _stopScriptCmdPostfix = ''
-    _initScriptFileName = 'Init-IIoTEdge.ps1'
-    _initScriptCmdPrefix = ''
-    _initScriptCmdPostfix = ''
-    _deinitScriptFileName = 'Deinit-IIoTEdge.ps1'
-    _deinitScriptCmdPrefix = ''
-    _deinitScriptCmdPostfix = ''
-    _targetNewline = '\r\n'
+        _platformCpu = 'arm32v7'
 
-#
-# validate common arguments
-#
-if _args.lcow:
-    if _targetPlatform == 'windows':
-        _containerOs = 'linux'
-    else:
-        logging.fatal("-lcow is only allowed for a Winodws target")
-        sys.exit(1)
-else:
-    _containerOs = _targetPlatform if _targetPlatform != 'wsl' else 'linux'
-
-if _args.outdir is not None:
-    _args.outdir = _args.outdir.strip()
-    if not os.path.exists(_args.outdir):
-        os.mkdir(_args.outdir)
-    elif not os.path.isdir(_args.outdir):
-        logging.critical("Given outdir '{0} is not a directory. Please check. Exiting...".format(_args.outdir))
-        sys.exit(2)
-    logging.info("Create all generated files in directory '{0}'.".format(_args.outdir))
-
-if _args.hostdir is not None:
-    # the --hostdir parameter specifies where on the docker host the configuration files should be stored.
-    # during docker configuration a volume bind is configured, which points to this directory.
-    # in case of a cross platform generation, the files are put into a config subdirectory of the specified --outdir
-    # and need to be transfered manually to the IoT Edge device.
-    _dockerBindSource = _args.hostdir = _args.hostdir.strip().replace('\\', '/')
-    # The Docker for Windows volume bind syntax has changed over time.
-    # With docker ce 18.03.0-ce-win59 (16762), engine 18.03.0-ce the bind syntax for D:/docker needs to be //d/docker
-
-    if _targetPlatform in [ 'windows', 'wsl']:
-        # we accept only fully qualified windows syntax (starts with <drive>:)
-        if _args.hostdir[1:3] != ':/':
-            logging.fatal("The --hostdir parameter must be using a fully qualified Windows directory syntax.")
+    #
+    # OS specific settings
+    #
+    if not _args.targetplatform:
+        _targetPlatform = str(platform.system()).lower()
+        if _targetPlatform == 'linux':
+            # check if we are on WSL
+            for line in open('/proc/version'):
+                if 'Microsoft' in line:
+                    _targetPlatform = 'wsl'
+        elif _targetPlatform == 'windows':
+             pass
+        else:
+            logging.critical("OS is not supported. Exiting...")
             sys.exit(1)
-    elif _targetPlatform == 'linux':
-        if _args.hostdir[0:1] != '/':
-            logging.fatal("The --hostdir parameter must be using a fully qualified Linux directory syntax.")
+    else:
+        _targetPlatform = _args.targetplatform
+    logging.info("Using targetplatform '{0}'".format(_targetPlatform))
+
+    configureTargetPlatform(_targetPlatform)
+
+    #
+    # validate common arguments
+    #
+    if _args.lcow:
+        if _targetPlatform == 'windows':
+            _containerOs = 'linux'
+        else:
+            logging.fatal("-lcow is only allowed for a Winodws target")
             sys.exit(1)
     else:
-        logging.fatal("Target platform '{0}' is not supported.".format(_targetPlatform))
-        sys.exit(1)
+        _containerOs = _targetPlatform if _targetPlatform != 'wsl' else 'linux'
 
-    if _args.targetplatform:
-        # create a directory for the configuration files, if not running on the IoT Edge device
-        _outdirConfig = _args.outdir + '/config'
-        if not os.path.exists(_outdirConfig):
-            os.mkdir(_outdirConfig)
-            logging.info("Create directory '{0}' for target system configuration files.".format(_outdirConfig))
-        elif not os.path.isdir(_outdirConfig):
-            logging.critical("'{0}' is expected to be a directory to provide configuration files, but it is not. Pls check. Exiting...".format(_outdirConfig))
+    if _args.outdir is not None:
+        _args.outdir = _args.outdir.strip()
+        if not os.path.exists(_args.outdir):
+            os.mkdir(_args.outdir)
+        elif not os.path.isdir(_args.outdir):
+            logging.critical("Given outdir '{0} is not a directory. Please check. Exiting...".format(_args.outdir))
             sys.exit(2)
-        logging.info("Create all generated configuration files in directory '{0}'.".format(_outdirConfig))
-        logging.info("Passing '{0}' to docker as source in bind, maps to '{1}'.".format(_dockerBindSource, _args.hostdir))
-        _hostDirHost = _args.hostdir
-    else:
-        logging.info("--targetplatform was not specified. Assume we run on the IoT Edge device.")
-        if _targetPlatform in [ 'windows', 'linux' ]:
+        logging.info("Create all generated files in directory '{0}'.".format(_args.outdir))
+
+    if _args.hostdir is not None:
+        # the --hostdir parameter specifies where on the docker host the configuration files should be stored.
+        # during docker configuration a volume bind is configured, which points to this directory.
+        # in case of a cross platform generation, the files are put into a config subdirectory of the specified --outdir
+        # and need to be transfered manually to the IoT Edge device.
+        _dockerBindSource = _args.hostdir = _args.hostdir.strip().replace('\\', '/')
+        # The Docker for Windows volume bind syntax has changed over time.
+        # With docker ce 18.03.0-ce-win59 (16762), engine 18.03.0-ce the bind syntax for D:/docker needs to be //d/docker
+
+        if _targetPlatform in [ 'windows', 'wsl']:
+            # we accept only fully qualified windows syntax (starts with <drive>:)
+            if _args.hostdir[1:3] != ':/':
+                logging.fatal("The --hostdir parameter must be using a fully qualified Windows directory syntax.")
+                sys.exit(1)
+        elif _targetPlatform == 'linux':
+            if _args.hostdir[0:1] != '/':
+                logging.fatal("The --hostdir parameter must be using a fully qualified Linux directory syntax.")
+                sys.exit(1)
+        else:
+            logging.fatal("Target platform '{0}' is not supported.".format(_targetPlatform))
+            sys.exit(1)
+
+        if _args.targetplatform:
+            # create a directory for the configuration files, if not running on the IoT Edge device
+            _outdirConfig = _args.outdir + '/config'
+            if not os.path.exists(_outdirConfig):
+                os.mkdir(_outdirConfig)
+                logging.info("Create directory '{0}' for target system configuration files.".format(_outdirConfig))
+            elif not os.path.isdir(_outdirConfig):
+                logging.critical("'{0}' is expected to be a directory to provide configuration files, but it is not. Pls check. Exiting...".format(_outdirConfig))
+                sys.exit(2)
+            logging.info("Create all generated configuration files in directory '{0}'.".format(_outdirConfig))
+            logging.info("Passing '{0}' to docker as source in bind, maps to '{1}'.".format(_dockerBindSource, _args.hostdir))
             _hostDirHost = _args.hostdir
-        if _targetPlatform == 'wsl':
-            _hostDirHost = '/mnt/' + _args.hostdir[0:1] + '/' + _args.hostdir[3:]
-        if not os.path.exists(_hostDirHost):
-            logging.info("Directory '{0}' specified via --hostdir does not exist. Creating it...".format(_args.hostdir))
-            os.mkdir(_hostDirHost)
-        logging.info("Passing '{0}' to docker as source in bind, maps to '{1}'.".format(_dockerBindSource, _hostDirHost))
-else:
-    # use a docker volume
-    # todo verify correct handling with sites
-    _dockerBindSource = 'cfappdata'
-    logging.info("Passing '{0}' (docker volume) to docker as source in bind.".format(_dockerBindSource))
-
-if _args.dockerregistry is None:
-    _args.dockerregistry = 'microsoft'
-else:
-    _args.dockerregistry = _args.dockerregistry.strip().lower()
-    logging.info("Docker container registry to use: '{0}'".format(_args.dockerregistry))
+        else:
+            logging.info("--targetplatform was not specified. Assume we run on the IoT Edge device.")
+            if _targetPlatform in [ 'windows', 'linux' ]:
+                _hostDirHost = _args.hostdir
+            if _targetPlatform == 'wsl':
+                _hostDirHost = '/mnt/' + _args.hostdir[0:1] + '/' + _args.hostdir[3:]
+            if not os.path.exists(_hostDirHost):
+                logging.info("Directory '{0}' specified via --hostdir does not exist. Creating it...".format(_args.hostdir))
+                os.mkdir(_hostDirHost)
+            logging.info("Passing '{0}' to docker as source in bind, maps to '{1}'.".format(_dockerBindSource, _hostDirHost))
+    else:
+        # use a docker volume
+        # todo verify correct handling with sites
+        _dockerBindSource = 'cfappdata'
+        logging.info("Passing '{0}' (docker volume) to docker as source in bind.".format(_dockerBindSource))
 
-#
-# build container names
-#
-_opcProxyContainer = OPCPROXY_CONTAINER_IMAGE if '/' in OPCPROXY_CONTAINER_IMAGE else '{0}/{1}'.format(_args.dockerregistry, OPCPROXY_CONTAINER_IMAGE)
-_opcProxyContainer = '{0}:'.format(_opcProxyContainer) if not OPCPROXY_CONTAINER_VERSION else '{0}:{1}-'.format(_opcProxyContainer, OPCPROXY_CONTAINER_VERSION)
-_opcProxyContainer = '{0}{1}'.format(_opcProxyContainer, 'windows') if _containerOs == 'windows' else '{0}{1}'.format(_opcProxyContainer, 'linux')
-_opcProxyContainer = '{0}-{1}'.format(_opcProxyContainer, 'amd64') if _platformCpu == 'amd64' else '{0}-{1}'.format(_opcProxyContainer, 'arm32v7')
-_opcTwinContainer = OPCTWIN_CONTAINER_IMAGE if '/' in OPCTWIN_CONTAINER_IMAGE else '{0}/{1}'.format(_args.dockerregistry, OPCTWIN_CONTAINER_IMAGE)
-_opcTwinContainer = '{0}:'.format(_opcTwinContainer) if not OPCTWIN_CONTAINER_VERSION else '{0}:{1}-'.format(_opcTwinContainer, OPCTWIN_CONTAINER_VERSION)
-_opcTwinContainer = '{0}{1}'.format(_opcTwinContainer, 'windows') if _containerOs == 'windows' else '{0}{1}'.format(_opcTwinContainer, 'linux')
-_opcTwinContainer = '{0}-{1}'.format(_opcTwinContainer, 'amd64') if _platformCpu == 'amd64' else '{0}{1}'.format(_opcTwinContainer, 'arm32v7')
-_opcPublisherContainer = OPCPUBLISHER_CONTAINER_IMAGE if '/' in OPCPUBLISHER_CONTAINER_IMAGE else '{0}/{1}'.format(_args.dockerregistry, OPCPUBLISHER_CONTAINER_IMAGE)
-_opcPublisherContainer = '{0}:'.format(_opcPublisherContainer) if not OPCPUBLISHER_CONTAINER_VERSION else '{0}:{1}-'.format(_opcPublisherContainer, OPCPUBLISHER_CONTAINER_VERSION)
-_opcPublisherContainer = '{0}{1}'.format(_opcPublisherContainer, 'windows') if _containerOs == 'windows' else '{0}{1}'.format(_opcPublisherContainer, 'linux')
-_opcPublisherContainer = '{0}-{1}'.format(_opcPublisherContainer, 'amd64') if _platformCpu == 'amd64' else '{0}-{1}'.format(_opcPublisherContainer, 'arm32v7')
-_opcPlcContainer = OPCPLC_CONTAINER_IMAGE if '/' in OPCPLC_CONTAINER_IMAGE else '{0}/{1}'.format(_args.dockerregistry, OPCPLC_CONTAINER_IMAGE)
-_opcPlcContainer = '{0}:'.format(_opcPlcContainer) if not OPCPLC_CONTAINER_VERSION else '{0}:{1}-'.format(_opcPlcContainer, OPCPLC_CONTAINER_VERSION)
-_opcPlcContainer = '{0}{1}'.format(_opcPlcContainer, 'windows') if _containerOs == 'windows' else '{0}{1}'.format(_opcPlcContainer, 'linux')
-_opcPlcContainer = '{0}-{1}'.format(_opcPlcContainer, 'amd64') if _platformCpu == 'amd64' else '{0}{1}'.format(_opcPlcContainer, 'arm32v7')
-
-logging.info("Using OpcPublisher container: '{0}'".format(_opcPublisherContainer))
-logging.info("Using OpcProxy container: '{0}'".format(_opcProxyContainer))
-logging.info("Using OpcTwin container: '{0}'".format(_opcTwinContainer))
-logging.info("Using OpcPlc container: '{0}'".format(_opcPlcContainer))
+    if _args.dockerregistry is None:
+        _args.dockerregistry = 'microsoft'
+    else:
+        _args.dockerregistry = _args.dockerregistry.strip().lower()
+        logging.info("Docker container registry to use: '{0}'".format(_args.dockerregistry))
 
-#
-# azure authentication
-#
-if _args.serviceprincipalcert is not None:
-    _args.serviceprincipalcert = _args.serviceprincipalcert.strip()
-    if _targetPlatform == 'windows' and not _args.serviceprincipalcert[1:2] == ':' or _targetPlatform == 'linux' and not _args.serviceprincipalcert.startswith('/'):
-        _args.serviceprincipalcert = '{0}/{1}'.format(os.getcwd(), _args.serviceprincipalcert)
-    logging.info("Setup using service principal cert in file '{0}'".format(_args.serviceprincipalcert))
+    #
+    # build container names
+    #
+    _opcProxyContainer = getContainerImage(OPCPROXY_CONTAINER_IMAGE, OPCPROXY_CONTAINER_VERSION)
+    _opcTwinContainer = getContainerImage(OPCTWIN_CONTAINER_IMAGE, OPCTWIN_CONTAINER_VERSION)
+    _opcPublisherContainer = getContainerImage(OPCPUBLISHER_CONTAINER_IMAGE, OPCPUBLISHER_CONTAINER_VERSION)
+    _opcPlcContainer = getContainerImage(OPCPLC_CONTAINER_IMAGE, OPCPLC_CONTAINER_VERSION)
+
+    logging.info("Using OpcPublisher container: '{0}'".format(_opcPublisherContainer))
+    logging.info("Using OpcProxy container: '{0}'".format(_opcProxyContainer))
+    logging.info("Using OpcTwin container: '{0}'".format(_opcTwinContainer))
+    logging.info("Using OpcPlc container: '{0}'".format(_opcPlcContainer))
+
+    #
+    # azure authentication
+    #
+    if _args.serviceprincipalcert is not None:
+        _args.serviceprincipalcert = _args.serviceprincipalcert.strip()
+        if _targetPlatform == 'windows' and not _args.serviceprincipalcert[1:2] == ':' or _targetPlatform == 'linux' and not _args.serviceprincipalcert.startswith('/'):
+            _args.serviceprincipalcert = '{0}/{1}'.format(os.getcwd(), _args.serviceprincipalcert)
+        logging.info("Setup using service principal cert in file '{0}'".format(_args.serviceprincipalcert))
 
-if _args.tenantid is not None:
-    _args.tenantid = _args.tenantid.strip()
-    logging.info("Setup using tenant id '{0}' to login".format(_args.tenantid))
+    if _args.tenantid is not None:
+        _args.tenantid = _args.tenantid.strip()
+        logging.info("Setup using tenant id '{0}' to login".format(_args.tenantid))
 
-if _args.appid is not None:
-    _args.appid = _args.appid.strip()
-    logging.info("Setup using AppId '{0}' to login".format(_args.appid))
+    if _args.appid is not None:
+        _args.appid = _args.appid.strip()
+        logging.info("Setup using AppId '{0}' to login".format(_args.appid))
 
-if ((_args.serviceprincipalcert is not None or _args.tenantid is not None or _args.appid is not None) and
-    (_args.serviceprincipalcert is None or _args.tenantid is None or _args.appid is None)):
-     logging.critical("serviceprincipalcert, tennantid and appid must all be specified. Exiting...")
-     sys.exit(2)
+    if ((_args.serviceprincipalcert is not None or _args.tenantid is not None or _args.appid is not None) and
+        (_args.serviceprincipalcert is None or _args.tenantid is None or _args.appid is None)):
+         logging.critical("serviceprincipalcert, tennantid and appid must all be specified. Exiting...")
+         sys.exit(2)
 
-_args.subcommand = _args.subcommand.lower()
+    _args.subcommand = _args.subcommand.lower()
 
-#
-# validate all required parameters for gw subcommand
-#
-if _args.subcommand == 'gw':
-    # validate the nodesconfig file 
-    if _args.nodesconfig:
-        # check if file exists
-        if not os.path.exists(_args.nodesconfig) or not os.path.isfile(_args.nodesconfig):
-            logging.critical("The nodesconfig file '{0}' can not be found or is not a file. Exiting...".format(_args.nodesconfig))
-            sys.exit(2) 
-        # to access it we need access to host file system and need a hostdir parameter
-        if not _args.hostdir:
-            logging.critical("If --nodesconfig is specified you need to specify a host directory for --hostdir as well. Exiting...")
-            sys.exit(2) 
-    try:
-        if _args.telemetryconfig:
-            # check if file exists
-            if not os.path.exists(_args.telemetryconfig) or not os.path.isfile(_args.telemetryconfig):
-                logging.critical("The telemetryconfig file '{0}' can not be found or is not a file. Exiting...".format(_args.telemetryconfig))
-                sys.exit(2) 
-            # to access it we need access to host file system and need a hostdir parameter
-            if not _args.hostdir:
-                logging.critical("If --telemetryconfig requires --hostdir as well. Exiting...")
-                sys.exit(2) 
-    except AttributeError:
-        pass
-    _args.site = _args.site.lower() 
-    _edgeSite = _args.site
-
-    # IoT Edge archive
-    if _args.archivepath is not None:
-        _args.archivepath = _args.archivepath.strip()
-        if not os.path.exists(_args.archivepath):
-            logging.critical("The given archive '{0} does not exist. Please check. Exiting...".format(_args.archivepath))
+    #
+    # validate all required parameters for gw subcommand
+    #
+    if _args.subcommand == 'gw':
+        # build the list of sites from the command line and the sites file
+        siteEntries = [ { 'site': siteName } for siteName in _args.site ]
+        if _args.sitesfile:
+            if not os.path.exists(_args.sitesfile) or not os.path.isfile(_args.sitesfile):
+                logging.critical("The sites file '{0}' can not be found or is not a file. Exiting...".format(_args.sitesfile))
+                sys.exit(2)
+            with open(_args.sitesfile, 'r') as sitesFile:
+                sitesJson = json.loads(sitesFile.read())
+            if not isinstance(sitesJson, list):
+                logging.critical("The sites file '{0}' must contain a list of sites. Exiting...".format(_args.sitesfile))
+                sys.exit(2)
+            for siteEntry in sitesJson:
+                siteEntries.append({ 'site': siteEntry } if not isinstance(siteEntry, dict) else siteEntry)
+        if len(siteEntries) == 0:
+            logging.critical("At least one site must be specified on the command line or in a sites file. Exiting...")
+            sys.exit(2)
+        if _args.parallel < 1:
+            logging.critical("The --parallel parameter must be at least 1. Exiting...")
+            sys.exit(2)
+        if _args.pullparallel < 1:
+            logging.critical("The --pullparallel parameter must be at least 1. Exiting...")
+            sys.exit(2)
+        if _args.layered and _args.basedeployment:
+            logging.critical("The --layered and --basedeployment parameters can not be used together. Exiting...")
+            sys.exit(2)
+        if _args.publishershards < 1:
+            logging.critical("The --publishershards parameter must be at least 1. Exiting...")
             sys.exit(2)
+        telemetryConfigs = {}
+        nodesConfigShards = {}
+        for siteEntry in siteEntries:
+            if 'site' not in siteEntry or not str(siteEntry['site']).strip():
+                logging.critical("There is a site without a name in the sites file '{0}'. Exiting...".format(_args.sitesfile))
+                sys.exit(2)
+            site = {}
+            site['site'] = str(siteEntry['site']).strip().lower()
+            if site['site'] in [ edgeSite['site'] for edgeSite in _edgeSites ]:
+                logging.warning("Site '{0}' is specified more than once. Ignoring...".format(site['site']))
+                continue
+            site['nodesconfig'] = siteEntry.get('nodesconfig', _args.nodesconfig)
+            site['telemetryconfig'] = siteEntry.get('telemetryconfig', _args.telemetryconfig)
+            # validate the nodesconfig file
+            if site['nodesconfig']:
+                # check if file exists
+                if not os.path.exists(site['nodesconfig']) or not os.path.isfile(site['nodesconfig']):
+                    logging.critical("The nodesconfig file '{0}' can not be found or is not a file. Exiting...".format(site['nodesconfig']))
+                    sys.exit(2)
+                # to access it we need access to host file system and need a hostdir parameter
+                if not _args.hostdir:
+                    logging.critical("If --nodesconfig is specified you need to specify a host directory for --hostdir as well. Exiting...")
+                    sys.exit(2)
+            if site['telemetryconfig']:
+                # check if file exists
+                if not os.path.exists(site['telemetryconfig']) or not os.path.isfile(site['telemetryconfig']):
+                    logging.critical("The telemetryconfig file '{0}' can not be found or is not a file. Exiting...".format(site['telemetryconfig']))
+                    sys.exit(2)
+                # to access it we need access to host file system and need a hostdir parameter
+                if not _args.hostdir:
+                    logging.critical("If --telemetryconfig requires --hostdir as well. Exiting...")
+                    sys.exit(2)
+                # validate and normalize it, the same file may be used by many sites
+                if site['telemetryconfig'] not in telemetryConfigs:
+                    try:
+                        telemetryConfigs[site['telemetryconfig']] = loadTelemetryConfig(site['telemetryconfig'])
+                    except ValueError as e:
+                        logging.critical("{0}. Exiting...".format(e))
+                        sys.exit(2)
+                    logging.info("Estimated message size per value change of telemetryconfig '{0}': {1}".format(site['telemetryconfig'],
+                        ", ".join("{0} bytes ({1})".format(payloadSize, endpoint) for endpoint, payloadSize in telemetryConfigs[site['telemetryconfig']][1].items())))
+                site['telemetryconfigContent'] = telemetryConfigs[site['telemetryconfig']][0]
+            # split the nodes configuration for a sharded publisher, the same file may be used by many sites
+            if site['nodesconfig'] and _args.publishershards > 1:
+                if site['nodesconfig'] not in nodesConfigShards:
+                    try:
+                        nodesConfigShards[site['nodesconfig']] = shardNodesConfig(site['nodesconfig'], _args.publishershards)
+                    except ImportError:
+                        logging.critical("--publishershards requires the 'ijson' package. Please install the packages listed in requirements.txt. Exiting...")
+                        sys.exit(1)
+                    except ValueError as e:
+                        logging.critical("The nodesconfig file '{0}' is invalid: {1}. Exiting...".format(site['nodesconfig'], e))
+                        sys.exit(2)
+                    logging.info("Split nodesconfig '{0}' into {1} publisher shard(s) with an estimated {2} messages/s".format(site['nodesconfig'], len(nodesConfigShards[site['nodesconfig']]),
+                        ", ".join("{0:.1f}".format(shardMessageRate) for shardContent, shardMessageRate in nodesConfigShards[site['nodesconfig']])))
+                # a single endpoint can not be split
+                if len(nodesConfigShards[site['nodesconfig']]) > 1:
+                    site['publisherShards'] = [ shardContent for shardContent, shardMessageRate in nodesConfigShards[site['nodesconfig']] ]
+            _edgeSites.append(site)
+
+        # recorded IoTHub state for the replay backend
+        if _args.replayfile is not None:
+            if _args.hubbackend != 'replay':
+                logging.critical("--replayfile requires --hubbackend replay. Exiting...")
+                sys.exit(2)
+            if not os.path.isfile(_args.replayfile):
+                logging.critical("The given replay file '{0}' does not exist. Please check. Exiting...".format(_args.replayfile))
+                sys.exit(2)
 
-    # site configuration
-    if _args.siteconfig is not None:
-        _args.siteconfig = _args.siteconfig.strip()
-        if not os.path.exists(_args.siteconfig):
-            logging.critical("The given site config file '{0} does not exist. Please check. Exiting...".format(_args.siteconfig))
+        # IoT Edge archive
+        if _args.archivepath is not None:
+            _args.archivepath = _args.archivepath.strip()
+            if not os.path.exists(_args.archivepath):
+                logging.critical("The given archive '{0} does not exist. Please check. Exiting...".format(_args.archivepath))
+                sys.exit(2)
+
+        # site configuration
+        if _args.siteconfig is not None:
+            _args.siteconfig = _args.siteconfig.strip()
+            if not os.path.exists(_args.siteconfig):
+                logging.critical("The given site config file '{0} does not exist. Please check. Exiting...".format(_args.siteconfig))
+                sys.exit(2)
+
+    # build the list of hostname/IP address mapping to allow the containers to access the local and external hosts, in case there is no DNS (espacially on Windows)
+    # add localhost info if we run on the targetplatform
+    _additionalHosts = []
+    if not _args.targetplatform:
+        ipAddress = getLocalIpAddress()
+        if ipAddress is None:
+            logging.critical("There is not network connection available.")
+            sys.exit(1)
+        hostName = socket.gethostname()
+        fqdnHostName = socket.getfqdn()
+        _additionalHosts.append({ "host": hostName, "ip": ipAddress })
+        if hostName.lower() != fqdnHostName.lower():
+            _additionalHosts.append({ "host": fqdnHostName, "ip": ipAddress })
+        else:
+            print("FQDN '{0}' is equal to hostname '{1}'".format(fqdnHostName, hostName))
+    _additionalHosts.extend(getExtraHosts())
+    _extraHosts = createExtraHostsIndex(_additionalHosts)
+
+    #
+    # gw operation: create all scripts to (de)init and start/stop the site specified on the command line
+    # - copy the configuration files
+    # - create an IoT Edge device and deployment for the site and all OPC components are configured to run as IoT Edge modules
+    #
+    if _args.subcommand == 'gw':
+        # compile the templates up front to fail before any Azure operation
+        try:
+            with _tracer.span('template compile', None, 'compileTemplate'):
+                compileTemplate(os.path.join(_scriptDir, _args.siteconfig))
+                compileTemplate('{0}/site-edge-init.yml'.format(_scriptDir))
+        except ValueError as e:
+            logging.critical("{0}. Exiting...".format(e))
             sys.exit(2)
+        # login to Azure and fetch IoTHub connection string, this is shared by all sites.
+        # the login is not needed, if the IoTHub owner connection string is cached
+        if (_args.hubbackend != 'replay' or _args.pinimages) and _args.cachettl > 0:
+            _hubCache = HubCache(_args.cachefile, _args.cachettl)
+            if _args.force:
+                _hubCache.invalidate('{0}/'.format(_args.iothubname.lower()))
+                _hubCache.invalidate('image:')
+        # pin the images to their digests, so the IoT Edge runtime does not check the registry for newer images with the same tag
+        if _args.pinimages:
+            try:
+                import requests
+            except ImportError:
+                logging.critical("The --pinimages parameter requires the 'requests' package. Please install the packages listed in requirements.txt. Exiting...")
+                sys.exit(1)
+            with _tracer.span('image resolve', None, 'ImageResolver.resolve'):
+                pinnedImages = ImageResolver(_hubCache).resolve([ _opcPublisherContainer, _opcProxyContainer, _opcTwinContainer, _opcPlcContainer ])
+            if None in pinnedImages.values():
+                logging.critical("The digests of the images {0} can not be resolved. Exiting...".format(", ".join("'{0}'".format(image) for image, pinnedImage in pinnedImages.items() if not pinnedImage)))
+                sys.exit(1)
+            _opcPublisherContainer = pinnedImages[_opcPublisherContainer]
+            _opcProxyContainer = pinnedImages[_opcProxyContainer]
+            _opcTwinContainer = pinnedImages[_opcTwinContainer]
+            _opcPlcContainer = pinnedImages[_opcPlcContainer]
+            for pinnedImage in dict.fromkeys(pinnedImages.values()):
+                logging.info("Pinned container image: '{0}'".format(pinnedImage))
+        _hubBackend = createHubBackend()
+        if _hubBackend.loginRequired:
+            with _tracer.span('azure login', None, 'azureLogin'):
+                azureLogin()
+        if _args.bulkdevices and not _hubBackend.supportsBulk:
+            logging.warning("The IoTHub backend does not support bulk device operations. Creating the devices with single operations...")
+            _args.bulkdevices = False
+        azureGetIotHubCs()
+        # read the state of the last run
+        _stateFileName = '{0}/iiotedge-state.json'.format(_args.outdir)
+        with _tracer.span('state load', None, 'loadSiteStates'):
+            loadSiteStates()
+        newSiteStates = dict(_siteStates)
+        # copy the configuration files of all sites
+        syncFiles([ siteConfigFile for site in _edgeSites for siteConfigFile in getSiteConfigFiles(site) ])
+        # the base deployment is shared by all sites
+        if _args.basedeployment:
+            createEdgeBaseDeployment()
+        # create the devices of all changed sites up front
+        if _args.bulkdevices:
+            bulkSites = [ site for site in _edgeSites if not isSiteUnchanged(site) ]
+            if len(bulkSites) > 0:
+                createEdgeDevicesBulk(bulkSites)
+        # provision the sites concurrently, the script commands are collected in the order of the sites
+        logging.info("Provision {0} site(s) with up to {1} in parallel".format(len(_edgeSites), _args.parallel))
+        siteErrors = {}
+        siteScriptsList = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=_args.parallel) as executor:
+            siteFutures = [ executor.submit(provisionSite, site) for site in _edgeSites ]
+            for site, siteFuture in zip(_edgeSites, siteFutures):
+                try:
+                    siteScripts = siteFuture.result()
+                except Exception as e:
+                    logging.error("Provisioning of site '{0}' failed: {1}".format(site['site'], e))
+                    siteErrors[site['site']] = e
+                    newSiteStates.pop(site['site'], None)
+                    continue
+                if not site.get('skipped'):
+                    newSiteStates[site['site']] = { 'inputs': site['inputsHash'], 'manifest': site['manifestHash'], 'layered': site['layered'], 'scripts': siteScripts }
+                siteScriptsList.append((site['site'], siteScripts))
+        with _tracer.span('state save', None, 'saveSiteStates'):
+            saveSiteStates(newSiteStates)
+        if _hubCache:
+            _hubCache.save()
+        if isinstance(_hubBackend, RecordingHubBackend):
+            _hubBackend.save()
+            logging.info("Recorded the IoTHub state to '{0}'.".format(_args.recordfile))
 
-# build the list of hostname/IP address mapping to allow the containers to access the local and external hosts, in case there is no DNS (espacially on Windows)
-# add localhost info if we run on the targetplatform
-_additionalHosts = []
-if not _args.targetplatform:
-    ipAddress = getLocalIpAddress()
-    if ipAddress is None:
-        logging.critical("There is not network connection available.")
-        sys.exit(1)
-    hostName = socket.gethostname()
-    fqdnHostName = socket.getfqdn()
-    _additionalHosts.append({ "host": hostName, "ip": ipAddress })
-    if hostName.lower() != fqdnHostName.lower():
-        _additionalHosts.append({ "host": fqdnHostName, "ip": ipAddress })
-    else:
-        print("FQDN '{0}' is equal to hostname '{1}'".format(fqdnHostName, hostName))
-_additionalHosts.extend(getExtraHosts()[:])
-_extraHosts = []
-if len(_additionalHosts) > 0:
-    _extraHosts.extend('- "{0}:{1}"\n'.format(host['host'], host['ip']) for host in _additionalHosts[0:1])
-    if len(_additionalHosts) > 2:
-        _extraHosts.extend('            - "{0}:{1}"\n'.format(host['host'], host['ip']) for host in _additionalHosts[1:-1])
-    if len(_additionalHosts) >= 2:
-        _extraHosts.extend('            - "{0}:{1}"'.format(host['host'], host['ip']) for host in _additionalHosts[-1:])
 
-#
-# gw operation: create all scripts to (de)init and start/stop the site specified on the command line
-# - copy the configuration files
-# - create an IoT Edge device and deployment for the site and all OPC components are configured to run as IoT Edge modules
-#
-if _args.subcommand == 'gw':
-    # login to Azure and fetch IoTHub connection string
-    azureLogin()
-    azureGetIotHubCs()
-    # copy configuration files to the right directory if we are running on the target, otherwise copy it to the config file directory
-    if _args.targetplatform:
-        if _args.nodesconfig:
-            nodesconfigFileName = 'pn-' + _args.site + '.json'
-            shutil.copyfile(_args.nodesconfig, '{0}/{1}'.format(_outdirConfig, nodesconfigFileName))
+    #
+    # topology operation: create the publisher nodes configuration for all factories of a topology description
+    # - the files are created where gw copies the nodes configuration to
+    #
+    if _args.subcommand == 'topology':
+        if not os.path.exists(_args.topologyfile) or not os.path.isfile(_args.topologyfile):
+            logging.critical("The topology file '{0}' can not be found or is not a file. Exiting...".format(_args.topologyfile))
+            sys.exit(2)
+        if _args.hostdir:
+            configDir = _outdirConfig if _args.targetplatform else _hostDirHost
+        else:
+            configDir = _args.outdir
+        logging.info("Create the publisher nodes configuration for all factories in '{0}'".format(_args.topologyfile))
+        with _tracer.span('topology', None, 'createNodesConfigFromTopology'):
+            topologySites = createNodesConfigFromTopology(_args.topologyfile, configDir)
+        logging.info('')
+        logging.info("Created the publisher nodes configuration for {0} site(s) in '{1}': {2}".format(len(topologySites), configDir, ", ".join(topologySites)))
+        logging.info('')
+
+    #
+    # analyze operation: estimate the publishing load of nodes configurations
+    #
+    if _args.subcommand == 'analyze':
         try:
-            if _args.telemetryconfig:
-                telemetryconfigFileName = 'tc-' + _args.site + '.json'
-                shutil.copyfile(_args.telemetryconfig, '{0}/{1}'.format(_outdirConfig, telemetryconfigFileName))
-        except AttributeError:
-            pass
-    else:
-        if _args.nodesconfig:
-            nodesconfigFileName = 'pn-' + _args.site + '.json'
-            shutil.copyfile(_args.nodesconfig, '{0}/{1}'.format(_hostDirHost, nodesconfigFileName))
+            import ijson
+        except ImportError:
+            logging.critical("The analyze subcommand requires the 'ijson' package. Please install the packages listed in requirements.txt. Exiting...")
+            sys.exit(1)
+        telemetryConfig = normalizeTelemetryConfig({})
         if _args.telemetryconfig:
-            telemetryconfigFileName = 'tc-' + _args.site + '.json'
-            shutil.copyfile(_args.telemetryconfig, '{0}/{1}'.format(_hostDirHost, telemetryconfigFileName))
-    # create site/factory scripts
-    logging.info("Create the site initialization and configuration for '{0}'".format(_args.site))
-    createEdgeSiteConfiguration(_args.site)
-
-
-# optional: sleep to debug initialization script issues
-# _initScript.append('timeout 60\n')
-
-# write the scripts
-writeScript(_startScriptFileName, _startScript)
-writeScript(_stopScriptFileName, _stopScript, reverse = True)
-writeScript(_initScriptFileName, _initScript)
-writeScript(_deinitScriptFileName, _deinitScript, reverse = True)
-
-# todo patch config.yaml if proxy is used
-# copy prerequisites installation scripts
-if _args.targetplatform:
-    if _args.targetplatform in [ 'windows' ]:
-        shutil.copyfile('{0}/Init-IotEdgeService.ps1'.format(_scriptDir), '{0}/Init-IotEdgeService.ps1'.format(_args.outdir))
-        shutil.copyfile('{0}/Deinit-IotEdgeService.ps1'.format(_scriptDir), '{0}/Deinit-IotEdgeService.ps1'.format(_args.outdir))
-        shutil.copyfile('{0}Prepare-IIotHost.ps1'.format(_scriptDir), '{0}/Prepare-IIotHost.ps1'.format(_args.outdir))
-    if _args.targetplatform in [ 'linux', 'wsl' ]:
-        shutil.copyfile('{0}/iiotedge-install-prerequisites.sh'.format(_scriptDir), '{0}/iiotedge-install-prerequisites.sh'.format(_args.outdir))
-        shutil.copyfile('{0}/iiotedge-install-linux-packages.sh'.format(_scriptDir), '{0}/iiotedge-install-linux-packages.sh'.format(_args.outdir))
-    shutil.copyfile('{0}/requirements.txt'.format(_scriptDir), '{0}/requirements.txt'.format(_args.outdir))
-    # inform user when not running on target platform
-    logging.info('')
-    logging.info("Please copy any required script files from '{0}' to your target system.".format(_args.outdir))
-    if _args.hostdir:
-        logging.info("Please copy any required configuration files from '{0}' to your target system to directory '{1}'.".format(_outdirConfig, _args.hostdir))
-elif _targetPlatform == 'windows':
-        shutil.copyfile('{0}/Init-IotEdgeService.ps1'.format(_scriptDir), '{0}/Init-IotEdgeService.ps1'.format(_args.outdir))
-        shutil.copyfile('{0}/Deinit-IotEdgeService.ps1'.format(_scriptDir), '{0}/Deinit-IotEdgeService.ps1'.format(_args.outdir))
-        shutil.copyfile('{0}/Prepare-WindowsGatewayStep1.ps1'.format(_scriptDir), '{0}/Prepare-WindowsGatewayStep1.ps1'.format(_args.outdir))
-        shutil.copyfile('{0}/Prepare-WindowsGatewayStep2.ps1'.format(_scriptDir), '{0}/Prepare-WindowsGatewayStep2.ps1'.format(_args.outdir))
-
-# done
-logging.info('')
-if _args.targetplatform:
-    logging.info("The generated script files can be found in: '{0}'. Please copy them to your target system.".format(_args.outdir))
-else:
-    logging.info("The generated script files can be found in: '{0}'".format(_args.outdir))
-logging.info('')
-logging.info("Operation completed.")
+            try:
+                telemetryConfig = json.loads(loadTelemetryConfig(_args.telemetryconfig)[0].decode('utf-8'))
+            except (IOError, ValueError) as e:
+                logging.critical("{0}. Exiting...".format(e))
+                sys.exit(2)
+        analyses = []
+        for nodesConfigFileName in _args.nodesconfigs:
+            if not os.path.isfile(nodesConfigFileName):
+                logging.critical("The nodesconfig file '{0}' can not be found or is not a file. Exiting...".format(nodesConfigFileName))
+                sys.exit(2)
+            with _tracer.span('nodesconfig analysis', None, os.path.basename(nodesConfigFileName)):
+                try:
+                    analyses.append(analyzeNodesConfig(nodesConfigFileName, telemetryConfig))
+                except ijson.JSONError as e:
+                    logging.critical("The nodesconfig file '{0}' is not valid JSON: {1}. Exiting...".format(nodesConfigFileName, e))
+                    sys.exit(2)
+            logNodesConfigAnalysis(analyses[-1])
+        if _args.json:
+            with open(_args.json, 'w') as analysisFile:
+                json.dump(analyses, analysisFile, indent=4)
+
+    #
+    # probe operation: check that the endpoints of nodes configurations and topology descriptions can be reached
+    #
+    if _args.subcommand == 'probe':
+        try:
+            import ijson
+        except ImportError:
+            logging.critical("The probe subcommand requires the 'ijson' package. Please install the packages listed in requirements.txt. Exiting...")
+            sys.exit(1)
+        if _args.concurrency < 1 or _args.timeout <= 0:
+            logging.critical("The concurrency and the timeout must be greater than 0. Exiting...")
+            sys.exit(2)
+        endpointUrls = []
+        for configFileName in _args.configfiles:
+            if not os.path.isfile(configFileName):
+                logging.critical("The config file '{0}' can not be found or is not a file. Exiting...".format(configFileName))
+                sys.exit(2)
+            try:
+                endpointUrls.extend(getProbeEndpoints(configFileName))
+            except ValueError as e:
+                logging.critical("The config file '{0}' is not valid JSON: {1}. Exiting...".format(configFileName, e))
+                sys.exit(2)
+        endpointUrls = list(dict.fromkeys(endpointUrls))
+        logging.info("Probe {0} endpoint(s) with up to {1} in parallel".format(len(endpointUrls), _args.concurrency))
+        with _tracer.span('probe', None, 'probeEndpoints'):
+            probeResults = probeEndpoints(endpointUrls, _args.concurrency, _args.timeout)
+        logProbeResults(probeResults)
+        if _args.json:
+            with open(_args.json, 'w') as probeFile:
+                json.dump(probeResults, probeFile, indent=4)
+
+    #
+    # loadtest operation: create a siteconfig with simulated PLCs and the nodes configuration to publish all their nodes
+    #
+    if _args.subcommand == 'loadtest':
+        if _args.plcs < 1 or _args.rate < 1 or _args.changeperiod < 1 or (_args.nodes is not None and _args.nodes < 1):
+            logging.critical("The --plcs, --rate, --nodes and --changeperiod parameters must be at least 1. Exiting...")
+            sys.exit(2)
+        loadTestSite = _args.loadtestsite.strip().lower()
+        nodeCount = _args.nodes or -(-_args.rate * _args.changeperiod // _args.plcs)
+        samplingInterval = _args.samplinginterval or _args.changeperiod * 1000
+        with _tracer.span('loadtest', loadTestSite, 'createLoadTestSite'):
+            siteConfigFileName, nodesConfigFileName = createLoadTestSite(loadTestSite, _args.plcs, nodeCount, _args.changeperiod, samplingInterval, _args.publishinginterval, _args.outdir)
+        logging.info("Created the siteconfig '{0}' with {1} PLC(s) and the nodes configuration '{2}' with {3} node(s) per PLC, which change every {4}s".format(siteConfigFileName, _args.plcs, nodesConfigFileName, nodeCount, _args.changeperiod))
+        try:
+            import ijson
+            logNodesConfigAnalysis(analyzeNodesConfig(nodesConfigFileName, normalizeTelemetryConfig({})))
+        except ImportError:
+            pass
+        logging.info('')
+        # gw copies the nodes configuration to the host directory, so it requires one
+        deployCmd = "python iiotedge.py gw {0} --siteconfig {1} --nodesconfig {2} --hostdir {3} --iothubname <iothubname>".format(loadTestSite, os.path.abspath(siteConfigFileName), os.path.abspath(nodesConfigFileName), _args.hostdir or '<hostdir>')
+        if _args.outdir != commonOptArgsParser.get_default('outdir'):
+            deployCmd = deployCmd + " --outdir {0}".format(_args.outdir)
+        logging.info("Deploy the load test with: {0}".format(deployCmd))
+
+    #
+    # logs operation: analyze the publisher and proxy logs of one or more sites
+    #
+    if _args.subcommand == 'logs':
+        if _args.bucket < 1 or _args.parallel < 1:
+            logging.critical("The --bucket and --parallel parameters must be at least 1. Exiting...")
+            sys.exit(2)
+        for logPath in _args.logpaths:
+            if not os.path.exists(logPath):
+                logging.critical("The log path '{0}' can not be found. Exiting...".format(logPath))
+                sys.exit(2)
+        logFiles = getLogFiles(_args.logpaths)
+        if len(logFiles) == 0:
+            logging.critical("There are no publisher or proxy logs (<site>-pub.log, <site>-prx.log) in {0}. Exiting...".format(", ".join("'{0}'".format(logPath) for logPath in _args.logpaths)))
+            sys.exit(2)
+        logging.info("Analyze {0} log(s) with up to {1} in parallel".format(len(logFiles), _args.parallel))
+        # the logs are parsed in processes, because the analysis is CPU bound
+        logRows = []
+        with _tracer.span('logs analysis', None, 'analyzeLog'):
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(_args.parallel, len(logFiles))) as executor:
+                logFutures = [ executor.submit(analyzeLog, log, logFileNames, _args.bucket) for log, logFileNames in logFiles.items() ]
+                for (log, logFileNames), logFuture in zip(logFiles.items(), logFutures):
+                    rows = logFuture.result()
+                    logLogAnalysis(log, logFileNames, rows)
+                    logRows.extend(rows)
+        if _args.csv:
+            import csv
+            with open(_args.csv, 'w', newline='') as csvFile:
+                csvWriter = csv.DictWriter(csvFile, fieldnames=[ 'site', 'log', 'start' ] + LOG_METRICS + [ 'messagesPerSecond', 'notificationsPerSecond', 'sendLatencyMeanMs', 'sendLatencyMaxMs' ])
+                csvWriter.writeheader()
+                csvWriter.writerows(logRows)
+        if _args.json:
+            with open(_args.json, 'w') as logsFile:
+                json.dump(logRows, logsFile, indent=4)
+
+    if _args.subcommand == 'gw':
+        # write the scripts of each site
+        writeSiteScripts(siteScriptsList)
+
+        # todo patch config.yaml if proxy is used
+        # copy prerequisites installation scripts
+        prerequisiteFiles = []
+        if _args.targetplatform:
+            if _args.targetplatform in [ 'windows' ]:
+                prerequisiteFiles.extend([ 'Init-IotEdgeService.ps1', 'Deinit-IotEdgeService.ps1', 'Prepare-IIotHost.ps1' ])
+            if _args.targetplatform in [ 'linux', 'wsl' ]:
+                prerequisiteFiles.extend([ 'iiotedge-install-prerequisites.sh', 'iiotedge-install-linux-packages.sh' ])
+            prerequisiteFiles.append('requirements.txt')
+        elif _targetPlatform == 'windows':
+            prerequisiteFiles.extend([ 'Init-IotEdgeService.ps1', 'Deinit-IotEdgeService.ps1', 'Prepare-WindowsGatewayStep1.ps1', 'Prepare-WindowsGatewayStep2.ps1' ])
+        syncFiles([ ('{0}/{1}'.format(_scriptDir, prerequisiteFile), '{0}/{1}'.format(_args.outdir, prerequisiteFile)) for prerequisiteFile in prerequisiteFiles ])
+        if _args.targetplatform:
+            # inform user when not running on target platform
+            logging.info('')
+            logging.info("Please copy any required script files from '{0}' to your target system.".format(_args.outdir))
+            if _args.hostdir:
+                logging.info("Please copy any required configuration files from '{0}' to your target system to directory '{1}'.".format(_outdirConfig, _args.hostdir))
+
+        # done
+        logging.info('')
+        if _args.targetplatform:
+            logging.info("The generated script files can be found in: '{0}'. Please copy them to your target system.".format(_args.outdir))
+        else:
+            logging.info("The generated script files can be found in: '{0}'".format(_args.outdir))
+        logging.info('')
+
+    # report where the time of the run was spent
+    _tracer.logSummary()
+    if _args.tracefile:
+        _tracer.save(_args.tracefile)
+        logging.info("Wrote {0} span(s) to '{1}'.".format(len(_tracer.spans), _args.tracefile))
+    if _args.subcommand == 'probe' and any(result['outcome'] != 'ok' for result in probeResults):
+        logging.critical("{0} of {1} endpoint(s) can not be reached.".format(sum(1 for result in probeResults if result['outcome'] != 'ok'), len(probeResults)))
+        sys.exit(1)
+    if _args.subcommand == 'gw' and len(siteErrors) > 0:
+        logging.critical("Provisioning failed for {0} of {1} site(s): {2}".format(len(siteErrors), len(_edgeSites), ", ".join(siteErrors.keys())))
+        sys.exit(1)
+    logging.info("Operation completed.")
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#
+# Tests of the HttpHubBackend of iiotedge.py against a local HTTP stand-in of the IoTHub REST API
+#
+# The stand-in records the requests and answers them from a handler, which is set by each test.
+# Run with: python -m pytest -q tests
+#
+import sys
+import os
+import json
+import base64
+import threading
+import unittest
+import urllib.parse
+import http.server
+
+_scriptDir = os.path.dirname(os.path.abspath(__file__))
+_repoDir = os.path.dirname(_scriptDir)
+sys.path.insert(0, _repoDir)
+import iiotedge
+
+CONNECTION_STRING = 'HostName=testhub.azure-devices.net;SharedAccessKeyName=iothubowner;SharedAccessKey={0}'.format(base64.b64encode(b'testkey').decode('utf-8'))
+
+
+class IotHubStandIn(http.server.ThreadingHTTPServer):
+    # records all requests and answers them with the (status, body) returned by respond(method, path, query, body)
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), IotHubStandInHandler)
+        self.requests = []
+        self.respond = lambda method, path, query, body: (200, {})
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class IotHubStandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        contentLength = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(contentLength)) if contentLength else None
+        self.server.requests.append({ 'method': self.command, 'path': url.path, 'query': query, 'headers': dict(self.headers), 'body': body })
+        status, responseBody = self.server.respond(self.command, url.path, query, body)
+        content = json.dumps(responseBody).encode('utf-8') if responseBody is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_PUT = do_POST = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpHubBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.standIn = IotHubStandIn()
+        self.backend = iiotedge.HttpHubBackend('testhub', CONNECTION_STRING, endpoint=self.standIn.endpoint)
+
+    def tearDown(self):
+        self.backend.session.close()
+        self.standIn.close()
+
+    def test_requests_are_sent_to_endpoint_with_sas_token(self):
+        self.standIn.respond = lambda method, path, query, body: (200, { 'deviceId': 'site1' })
+        self.assertEqual(self.backend.showDevice('site1'), { 'deviceId': 'site1' })
+        self.backend.showDevice('site2')
+        request = self.standIn.requests[0]
+        self.assertEqual(request['method'], 'GET')
+        self.assertEqual(request['path'], '/devices/site1')
+        self.assertEqual(request['query']['api-version'], iiotedge.HttpHubBackend.API_VERSION)
+        self.assertTrue(request['headers']['Authorization'].startswith('SharedAccessSignature sr=testhub.azure-devices.net&'))
+        self.assertIn('skn=iothubowner', request['headers']['Authorization'])
+        # the token is reused by later requests
+        self.assertEqual(self.standIn.requests[1]['headers']['Authorization'], request['headers']['Authorization'])
+        self.assertFalse(self.backend.loginRequired)
+
+    def test_create_edge_device(self):
+        self.standIn.respond = lambda method, path, query, body: (200, body)
+        device = self.backend.createEdgeDevice('site1')
+        request = self.standIn.requests[0]
+        self.assertEqual((request['method'], request['path']), ('PUT', '/devices/site1'))
+        self.assertTrue(request['body']['capabilities']['iotEdge'])
+        self.assertEqual(device['deviceId'], 'site1')
+
+    def test_delete_device_matches_any_etag(self):
+        self.standIn.respond = lambda method, path, query, body: (204, None)
+        self.backend.deleteDevice('site1')
+        request = self.standIn.requests[0]
+        self.assertEqual((request['method'], request['path']), ('DELETE', '/devices/site1'))
+        self.assertEqual(request['headers']['If-Match'], '*')
+
+    def test_device_connection_string(self):
+        self.standIn.respond = lambda method, path, query, body: (200, { 'deviceId': 'site1', 'authentication': { 'symmetricKey': { 'primaryKey': 'cHJpbWFyeQ==' } } })
+        self.assertEqual(self.backend.getDeviceConnectionString('site1'), 'HostName=testhub.azure-devices.net;DeviceId=site1;SharedAccessKey=cHJpbWFyeQ==')
+
+    def test_missing_device_returns_none(self):
+        self.standIn.respond = lambda method, path, query, body: (404, { 'Message': 'DeviceNotFound' })
+        self.assertIsNone(self.backend.showDevice('site1'))
+        self.assertIsNone(self.backend.getDeviceConnectionString('site1'))
+        self.assertFalse(self.backend.authFailed)
+
+    def test_rejected_credentials_set_auth_failed(self):
+        self.standIn.respond = lambda method, path, query, body: (401, { 'Message': 'Unauthorized' })
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(self.backend.getDeployment('iiot-deployment-site1'))
+        self.assertTrue(self.backend.authFailed)
+
+    def test_unreachable_endpoint_returns_none(self):
+        self.standIn.close()
+        backend = iiotedge.HttpHubBackend('testhub', CONNECTION_STRING, endpoint=self.standIn.endpoint)
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(backend.showDevice('site1'))
+        self.standIn = IotHubStandIn()
+
+    def test_missing_iothub_returns_none(self):
+        backend = iiotedge.HttpHubBackend('testhub', endpoint=self.standIn.endpoint)
+        backend._getIotHub = lambda: None
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(backend.showDevice('site1'))
+        self.assertEqual(self.standIn.requests, [])
+
+    def test_iothub_keys_are_fetched_once(self):
+        # a stand-in of the IoTHub management client, which counts the key fetches
+        keyFetches = []
+        class IotHubResource:
+            def get_keys_for_key_name(self, resourceGroup, iotHubName, keyName):
+                keyFetches.append(keyName)
+                return type('Key', (), { 'key_name': keyName, 'primary_key': base64.b64encode(b'testkey').decode('utf-8') })
+        iotHub = type('IotHub', (), { 'name': 'testhub', 'properties': type('Properties', (), { 'host_name': 'testhub.azure-devices.net' }) })
+        client = type('Client', (), { 'iot_hub_resource': IotHubResource() })
+        backend = iiotedge.HttpHubBackend('testhub', endpoint=self.standIn.endpoint)
+        backend._getIotHub = lambda: { 'client': client, 'hub': iotHub, 'resourceGroup': 'rg' }
+        threads = [ threading.Thread(target=backend.showDevice, args=('site{0}'.format(index),)) for index in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(backend.getIotHubConnectionString(), CONNECTION_STRING)
+        self.assertEqual(keyFetches, [ 'iothubowner' ])
+        self.assertEqual(len(self.standIn.requests), 8)
+        backend.session.close()
+
+
+class HttpHubBackendBulkTest(unittest.TestCase):
+    def setUp(self):
+        self.standIn = IotHubStandIn()
+        self.backend = iiotedge.HttpHubBackend('testhub', CONNECTION_STRING, endpoint=self.standIn.endpoint)
+
+    def tearDown(self):
+        self.backend.session.close()
+        self.standIn.close()
+
+    def test_list_devices_requests_the_list_limit(self):
+        devices = [ { 'deviceId': 'site{0}'.format(index) } for index in range(3) ]
+        self.standIn.respond = lambda method, path, query, body: (200, devices)
+        self.assertEqual(self.backend.listDevices(), devices)
+        request = self.standIn.requests[0]
+        self.assertEqual((request['method'], request['path']), ('GET', '/devices'))
+        self.assertEqual(request['query']['top'], str(iiotedge.HttpHubBackend.LIST_MAX_DEVICES))
+
+    def test_bulk_update_is_split_into_chunks(self):
+        devices = [ { 'id': 'site{0}'.format(index), 'importMode': 'create' } for index in range(250) ]
+        self.standIn.respond = lambda method, path, query, body: (200, { 'isSuccessful': True, 'errors': [], 'warnings': [] })
+        result = self.backend.bulkUpdateDevices(devices)
+        self.assertTrue(result['isSuccessful'])
+        self.assertEqual([ request['method'] for request in self.standIn.requests ], [ 'POST' ] * 3)
+        self.assertEqual([ request['path'] for request in self.standIn.requests ], [ '/devices' ] * 3)
+        self.assertEqual([ len(request['body']) for request in self.standIn.requests ], [ 100, 100, 50 ])
+        self.assertEqual([ device['id'] for request in self.standIn.requests for device in request['body'] ], [ device['id'] for device in devices ])
+
+    def test_bulk_update_merges_the_failed_devices_of_all_chunks(self):
+        # the IoTHub reports failed devices of a chunk with a bad request
+        def respond(method, path, query, body):
+            errors = [ { 'deviceId': device['id'], 'errorCode': 'DeviceAlreadyExists' } for device in body if device['id'] in [ 'site5', 'site105' ] ]
+            return (400, { 'isSuccessful': False, 'errors': errors, 'warnings': [] }) if errors else (200, { 'isSuccessful': True, 'errors': [], 'warnings': [] })
+        self.standIn.respond = respond
+        result = self.backend.bulkUpdateDevices([ { 'id': 'site{0}'.format(index), 'importMode': 'create' } for index in range(150) ])
+        self.assertFalse(result['isSuccessful'])
+        self.assertEqual([ error['deviceId'] for error in result['errors'] ], [ 'site5', 'site105' ])
+
+    def test_bulk_update_fails_if_a_chunk_fails(self):
+        self.standIn.respond = lambda method, path, query, body: (500, { 'Message': 'ServerError' }) if body[0]['id'] == 'site100' else (200, { 'isSuccessful': True })
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(self.backend.bulkUpdateDevices([ { 'id': 'site{0}'.format(index), 'importMode': 'create' } for index in range(150) ]))
+
+
+if __name__ == '__main__':
+    unittest.main()
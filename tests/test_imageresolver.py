@@ -0,0 +1,168 @@
+#
+# Tests of the ImageResolver of iiotedge.py against a local stand-in of a registry v2 API
+#
+# The stand-in serves the manifests of its repositories only with a bearer token, which it issues itself.
+# Run with: python -m pytest -q tests
+#
+import sys
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import unittest
+import http.server
+
+_scriptDir = os.path.dirname(os.path.abspath(__file__))
+_repoDir = os.path.dirname(_scriptDir)
+sys.path.insert(0, _repoDir)
+import iiotedge
+
+TOKEN = 'pulltoken'
+
+
+class RegistryStandIn(http.server.ThreadingHTTPServer):
+    # manifests maps '<repository>:<tag>' to (manifest, sendDigest), all requests are counted by method
+    def __init__(self, manifests):
+        super().__init__(('127.0.0.1', 0), RegistryStandInHandler)
+        self.manifests = manifests
+        self.counts = { 'HEAD': 0, 'GET': 0, 'token': 0 }
+        self.tokenParameters = []
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    @property
+    def registry(self):
+        return '127.0.0.1:{0}'.format(self.server_address[1])
+
+    @property
+    def endpoint(self):
+        return 'http://{0}'.format(self.registry)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RegistryStandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status, headers={}, content=b'', body=True):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    def _manifest(self, body):
+        if self.headers.get('Authorization') != 'Bearer {0}'.format(TOKEN):
+            challenge = 'Bearer realm="{0}/token",service="standin",scope="repository:{1}:pull"'.format(self.server.endpoint, self.path.split('/manifests/')[0][4:])
+            self._send(401, { 'WWW-Authenticate': challenge }, body=body)
+            return
+        repository, tag = self.path[4:].split('/manifests/')
+        manifestKey = '{0}:{1}'.format(repository, tag)
+        if manifestKey not in self.server.manifests:
+            self._send(404, body=body)
+            return
+        manifest, sendDigest = self.server.manifests[manifestKey]
+        headers = { 'Content-Type': 'application/vnd.docker.distribution.manifest.v2+json' }
+        if sendDigest:
+            headers['Docker-Content-Digest'] = 'sha256:{0}'.format(hashlib.sha256(manifest).hexdigest())
+        self._send(200, headers, manifest, body)
+
+    def do_HEAD(self):
+        self.server.counts['HEAD'] += 1
+        self._manifest(False)
+
+    def do_GET(self):
+        if self.path.startswith('/token'):
+            self.server.counts['token'] += 1
+            self.server.tokenParameters.append(self.path)
+            self._send(200, { 'Content-Type': 'application/json' }, json.dumps({ 'token': TOKEN }).encode('utf-8'))
+            return
+        self.server.counts['GET'] += 1
+        self._manifest(True)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def getManifestDigest(manifest):
+    return 'sha256:{0}'.format(hashlib.sha256(manifest).hexdigest())
+
+
+class ImageResolverTest(unittest.TestCase):
+    def setUp(self):
+        iiotedge._tracer = iiotedge.Tracer()
+        self.manifests = {
+            'iotedge/opc-publisher:linux-amd64': (b'{"schemaVersion":2,"name":"publisher"}', True),
+            'iotedge/opc-proxy:1.0.4-linux-amd64': (b'{"schemaVersion":2,"name":"proxy"}', True),
+            'library/nginx:latest': (b'{"schemaVersion":2,"name":"nginx"}', False),
+        }
+        self.standIn = RegistryStandIn(self.manifests)
+        self.tempDir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.standIn.close()
+        self.tempDir.cleanup()
+
+    def test_resolve_via_endpoint_with_token(self):
+        resolver = self.createResolver(endpoint=self.standIn.endpoint)
+        image = 'mcr.microsoft.com/iotedge/opc-publisher:linux-amd64'
+        pinnedImages = resolver.resolve([ image, image ])
+        self.assertEqual(pinnedImages, { image: '{0}@{1}'.format(image, getManifestDigest(self.manifests['iotedge/opc-publisher:linux-amd64'][0])) })
+        self.assertEqual(self.standIn.counts, { 'HEAD': 2, 'GET': 0, 'token': 1 })
+        self.assertIn('scope=repository%3Aiotedge%2Fopc-publisher%3Apull', self.standIn.tokenParameters[0])
+        self.assertIn('service=standin', self.standIn.tokenParameters[0])
+
+    def test_resolve_localhost_registry_via_http(self):
+        resolver = self.createResolver()
+        image = '{0}/iotedge/opc-proxy:1.0.4-linux-amd64'.format(self.standIn.registry)
+        pinnedImages = resolver.resolve([ image ])
+        self.assertEqual(pinnedImages[image], '{0}@{1}'.format(image, getManifestDigest(self.manifests['iotedge/opc-proxy:1.0.4-linux-amd64'][0])))
+
+    def test_digest_is_hash_of_manifest_without_digest_header(self):
+        resolver = self.createResolver(endpoint=self.standIn.endpoint)
+        pinnedImages = resolver.resolve([ 'nginx' ])
+        self.assertEqual(pinnedImages['nginx'], 'nginx@{0}'.format(getManifestDigest(self.manifests['library/nginx:latest'][0])))
+        self.assertEqual(self.standIn.counts['GET'], 1)
+
+    def test_token_is_shared_per_repository(self):
+        resolver = self.createResolver(endpoint=self.standIn.endpoint)
+        resolver.getDigest('mcr.microsoft.com/iotedge/opc-publisher:linux-amd64')
+        resolver.getDigest('mcr.microsoft.com/iotedge/opc-publisher:linux-amd64')
+        self.assertEqual(self.standIn.counts['token'], 1)
+        # the second request sends the token right away
+        self.assertEqual(self.standIn.counts['HEAD'], 3)
+
+    def test_unknown_image_is_not_pinned(self):
+        resolver = self.createResolver(endpoint=self.standIn.endpoint)
+        with self.assertLogs(level='ERROR'):
+            pinnedImages = resolver.resolve([ 'mcr.microsoft.com/iotedge/opc-twin:linux-amd64' ])
+        self.assertEqual(pinnedImages, { 'mcr.microsoft.com/iotedge/opc-twin:linux-amd64': None })
+
+    def test_pinned_image_is_kept(self):
+        resolver = self.createResolver(endpoint=self.standIn.endpoint)
+        image = 'mcr.microsoft.com/iotedge/opc-publisher@sha256:{0}'.format('0' * 64)
+        self.assertEqual(resolver.resolve([ image ]), { image: image })
+        self.assertEqual(self.standIn.counts['HEAD'], 0)
+
+    def test_digests_are_cached(self):
+        cache = iiotedge.HubCache(os.path.join(self.tempDir.name, 'cache.json'), 60)
+        image = 'mcr.microsoft.com/iotedge/opc-publisher:linux-amd64'
+        firstPinnedImages = self.createResolver(cache, self.standIn.endpoint).resolve([ image ])
+        headCount = self.standIn.counts['HEAD']
+        secondPinnedImages = self.createResolver(cache, self.standIn.endpoint).resolve([ image ])
+        self.assertEqual(firstPinnedImages, secondPinnedImages)
+        self.assertEqual(self.standIn.counts['HEAD'], headCount)
+
+    def createResolver(self, cache=None, endpoint=None):
+        resolver = iiotedge.ImageResolver(cache, endpoint, poolSize=2)
+        self.addCleanup(resolver.session.close)
+        return resolver
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#
+# Tests of the endpoint probe of iiotedge.py against local listening and closed sockets
+#
+# Run with: python -m pytest -q tests
+#
+import sys
+import os
+import json
+import socket
+import tempfile
+import unittest
+import unittest.mock
+
+_scriptDir = os.path.dirname(os.path.abspath(__file__))
+_repoDir = os.path.dirname(_scriptDir)
+sys.path.insert(0, _repoDir)
+import iiotedge
+
+
+class ProbeTest(unittest.TestCase):
+    def setUp(self):
+        # a listening socket accepts the connections in its backlog without an accept call
+        self.listeningSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listeningSocket.bind(('127.0.0.1', 0))
+        self.listeningSocket.listen(16)
+        self.addCleanup(self.listeningSocket.close)
+        self.listeningPort = self.listeningSocket.getsockname()[1]
+        # the port of a closed socket refuses connections
+        closedSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closedSocket.bind(('127.0.0.1', 0))
+        self.closedPort = closedSocket.getsockname()[1]
+        closedSocket.close()
+
+    def test_listening_endpoint_is_reachable(self):
+        results = iiotedge.probeEndpoints([ 'opc.tcp://127.0.0.1:{0}/'.format(self.listeningPort) ], 4, 2.0)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['outcome'], 'ok')
+        self.assertEqual(results[0]['address'], '127.0.0.1')
+        self.assertEqual(results[0]['port'], self.listeningPort)
+        self.assertEqual(results[0]['resolvedBy'], 'dns')
+        self.assertIsNotNone(results[0]['connectMs'])
+
+    def test_closed_endpoint_is_refused(self):
+        results = iiotedge.probeEndpoints([ 'opc.tcp://127.0.0.1:{0}'.format(self.closedPort) ], 4, 2.0)
+        self.assertEqual(results[0]['outcome'], 'refused')
+        self.assertIsNone(results[0]['connectMs'])
+
+    def test_extrahosts_are_used_before_dns(self):
+        with unittest.mock.patch.dict(iiotedge._extraHosts, { 'munich-productionline1-assembly': '127.0.0.1' }):
+            results = iiotedge.probeEndpoints([ 'opc.tcp://Munich-ProductionLine1-Assembly:{0}'.format(self.listeningPort) ], 4, 2.0)
+        self.assertEqual(results[0]['outcome'], 'ok')
+        self.assertEqual(results[0]['resolvedBy'], 'extrahosts')
+
+    def test_unresolved_host(self):
+        results = iiotedge.probeEndpoints([ 'opc.tcp://host.invalid:{0}'.format(self.listeningPort) ], 4, 5.0)
+        self.assertIn(results[0]['outcome'], [ 'unresolved', 'resolve timeout' ])
+        self.assertIsNone(results[0]['address'])
+
+    def test_invalid_urls(self):
+        results = iiotedge.probeEndpoints([ 'http://127.0.0.1:{0}'.format(self.listeningPort), 'opc.tcp://', 'opc.tcp://127.0.0.1:port' ], 4, 2.0)
+        self.assertEqual([ result['outcome'] for result in results ], [ 'invalid url' ] * 3)
+
+    def test_default_port(self):
+        results = iiotedge.probeEndpoints([ 'opc.tcp://127.0.0.1' ], 4, 2.0)
+        self.assertEqual(results[0]['port'], iiotedge.OPCUA_DEFAULT_PORT)
+
+    def test_mixed_endpoints_keep_their_order(self):
+        endpointUrls = [ 'opc.tcp://127.0.0.1:{0}'.format(self.closedPort), 'opc.tcp://127.0.0.1:{0}/a'.format(self.listeningPort),
+            'opc.tcp://127.0.0.1:{0}/b'.format(self.listeningPort) ]
+        results = iiotedge.probeEndpoints(endpointUrls, 1, 2.0)
+        self.assertEqual([ result['endpoint'] for result in results ], endpointUrls)
+        self.assertEqual([ result['outcome'] for result in results ], [ 'refused', 'ok', 'ok' ])
+
+    def test_endpoints_of_nodes_configuration_and_topology(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            nodesConfigFileName = os.path.join(tempDir, 'pn.json')
+            with open(nodesConfigFileName, 'w') as nodesConfigFile:
+                json.dump([ { 'EndpointUrl': 'opc.tcp://a:1', 'OpcNodes': [ { 'Id': 'i=2258' } ] }, { 'EndpointUrl': 'opc.tcp://b:2', 'OpcNodes': [] } ], nodesConfigFile)
+            self.assertEqual(iiotedge.getProbeEndpoints(nodesConfigFileName), [ 'opc.tcp://a:1', 'opc.tcp://b:2' ])
+        topologyEndpoints = iiotedge.getProbeEndpoints(os.path.join(_repoDir, 'testdata', 'ContosoTopologyDescription.json'))
+        self.assertGreater(len(topologyEndpoints), 0)
+        self.assertTrue(all(endpointUrl.startswith('opc.tcp://') for endpointUrl in topologyEndpoints))
+
+
+if __name__ == '__main__':
+    unittest.main()